@@ -1,4 +1,8 @@
 import os
+from concurrent.futures import Executor
+from functools import partial
+from typing import Callable
+
 import PIL.Image
 import numpy as np
 import tifffile as tiff
@@ -6,23 +10,30 @@ from numpy import ndarray
 from scipy import ndimage
 from skimage import morphology, filters
 
+from .._tiles import tile_bounds, read_region, map_tiles
+
 
 def FindMaxima(image: np.ndarray | os.PathLike | str | tiff.TiffFile | PIL.Image.Image,
                maxima_channel: int | str,
                tile_size: tuple[int, int] | None = None,
                noise_tolerance: np.uint8 | int | float | np.uint16 | np.uint32 = np.uint8(20),
-               neighborhood_size: int = 3) -> int | ndarray:
+               neighborhood_size: int = 3,
+               workers: int | None = None,
+               executor: Executor | None = None,
+               max_in_flight: int | None = None) -> int | ndarray:
     """
     OpenCV/NumPy version of the "Find Maxima" function in ImageJ when used to get strictly the *number* of maxima.
     :param maxima_channel:
     :param image:
-    :param tile_size:
+    :param tile_size: if supplied, the image is read in tiles of this size with a halo of *neighborhood_size* pixels;
+    maxima cut by tile borders are only counted once, so the count is identical to the untiled count
     :param noise_tolerance:
     :param neighborhood_size:
+    :param workers: if supplied with *tile_size*, the number of threads the tiles are processed on
+    :param executor: a shared executor to process the tiles on in place of *workers*
+    :param max_in_flight: the maximum number of tiles held in memory at once when processing tiles in parallel
     :return:
     """
-    global data
-
     if isinstance(maxima_channel, str):
         colors = {
             'red': 0,
@@ -36,171 +47,191 @@ def FindMaxima(image: np.ndarray | os.PathLike | str | tiff.TiffFile | PIL.Image
         pass
     else:
         raise TypeError(f'Invalid type for param *maxima_channel* in ImageJ.FindMaxima: {maxima_channel.__class__}')
+    parallel_kwargs = {'workers': workers, 'executor': executor, 'max_in_flight': max_in_flight}
 
     if isinstance(image, (os.PathLike, str)):
         # Tile the image if tile_size is provided
         if tile_size:
             # Create image file link
             with tiff.TiffFile(image) as tif:
-                # get the shape of the image
-                shape = tif.pages[0].shape
-                height, width = (shape[0], shape[1])
-
-                # initialize the count of maxima
-                num_maxima = 0
-
-                # Get number of tiles
-                tiles_tall = np.arange(0, height, tile_size[0])
-                tiles_wide = np.arange(0, width, tile_size[1])
-
-                # loop over the image in chunks
-                for [y, x] in np.ndindex(len(tiles_tall), len(tiles_wide)):
-                    # define tile coordinates
-                    start_height, start_width = (y * tile_size[0], x * tile_size[1])
-                    end_height, end_width = (start_height + tile_size[0], start_width + tile_size[1])
-
-                    # generate tile
-                    img_chunk = tif.pages[0].asarray(out='memmap', squeeze=False)[
-                                ..., start_height:end_height, start_width:end_width, channel]
-
-                    # find local maxima using maximum filter
-                    data_max = ndimage.maximum_filter(img_chunk, size=neighborhood_size, mode='constant')
-
-                    # find maxima above a certain noise tolerance
-                    maxima = (data_max == img_chunk) & (img_chunk > noise_tolerance)
-
-                    # perform non-maximum suppression
-                    maxima = ndimage.maximum_filter(maxima, size=neighborhood_size, mode='constant') == maxima
-
-                    # label the maxima using connected components analysis
-                    _, chunk_num_maxima = ndimage.label(maxima)
-
-                    # add the count of maxima in this chunk to the total count
-                    num_maxima += chunk_num_maxima
-                    pass
-                pass
-            return num_maxima
+                page = tif.pages[0]
+                tif.filehandle.set_lock(True)
+                return _tiled_maxima(partial(read_region, page, channel=channel),
+                                     (page.imagelength, page.imagewidth),
+                                     tile_size, noise_tolerance, neighborhood_size, **parallel_kwargs)
         else:
             data = tiff.imread(image)[..., channel]
         pass
     elif isinstance(image, tiff.TiffFile):
         # Tile the image if tile_size is provided
         if tile_size:
-            # get the shape of the image
-            shape = image.pages[0].shape
-            height, width = (shape[0], shape[1])
-
-            # initialize the count of maxima
-            num_maxima = 0
-
-            # Get number of tiles
-            tiles_tall = np.arange(0, height, tile_size[0])
-            tiles_wide = np.arange(0, width, tile_size[1])
-
-            # loop over the image in chunks
-            for [y, x] in np.ndindex(len(tiles_tall), len(tiles_wide)):
-                # define tile coordinates
-                start_height, start_width = (y * tile_size[0], x * tile_size[1])
-                end_height, end_width = (start_height + tile_size[0], start_width + tile_size[1])
-
-                # generate tile
-                img_chunk = image.pages[0].asarray(out='memmap', squeeze=False)[
-                            ..., start_height:end_height, start_width:end_width, channel]
-
-                # find local maxima using maximum filter
-                data_max = ndimage.maximum_filter(img_chunk, size=neighborhood_size, mode='constant')
-
-                # find maxima above a certain noise tolerance
-                maxima = (data_max == img_chunk) & (img_chunk > noise_tolerance)
-
-                # perform non-maximum suppression
-                maxima = ndimage.maximum_filter(maxima, size=neighborhood_size, mode='constant') == maxima
-
-                # label the maxima using connected components analysis
-                _, chunk_num_maxima = ndimage.label(maxima)
-
-                # add the count of maxima in this chunk to the total count
-                num_maxima += chunk_num_maxima
-                pass
-            return num_maxima
+            page = image.pages[0]
+            image.filehandle.set_lock(True)
+            return _tiled_maxima(partial(read_region, page, channel=channel),
+                                 (page.imagelength, page.imagewidth),
+                                 tile_size, noise_tolerance, neighborhood_size, **parallel_kwargs)
         else:
             data = np.asarray(image.asarray())[..., channel]
             pass
         pass
     elif isinstance(image, PIL.Image.Image):
-        # Tile the image if tile_size is provided
-        if tile_size:
-            # open image with PIL
-            data = np.asarray(image)[..., channel]
+        data = np.asarray(image)[..., channel]
+        pass
+    elif not isinstance(image, np.ndarray):
+        raise TypeError(f'Invalid data type for parameter *image* in ImageJ.FindMaxima: {image.__class__}')
+    else:
+        data = np.asarray(image)[..., channel]
+        pass
 
-            # get the shape of the image
-            shape = data.shape
-            height, width = (shape[0], shape[1])
+    # In-memory images are tiled on views of the channel
+    if tile_size:
+        return _tiled_maxima(lambda y0, y1, x0, x1: data[y0:y1, x0:x1],
+                             data.shape[:2], tile_size, noise_tolerance, neighborhood_size, **parallel_kwargs)
 
-            # initialize the count of maxima
-            num_maxima = 0
+    # label the maxima using connected components analysis
+    _, num_maxima = ndimage.label(_maxima_mask(data, noise_tolerance, neighborhood_size))
 
-            # Get number of tiles
-            tiles_tall = np.arange(0, height, tile_size[0])
-            tiles_wide = np.arange(0, width, tile_size[1])
+    # return the number of maxima
+    return num_maxima
 
-            # loop over the image in chunks
-            for [y, x] in np.ndindex(len(tiles_tall), len(tiles_wide)):
-                # define tile coordinates
-                start_height, start_width = (y * tile_size[0], x * tile_size[1])
-                end_height, end_width = (start_height + tile_size[0], start_width + tile_size[1])
 
-                # generate tile
-                img_chunk = np.asarray(data[..., start_height:end_height, start_width:end_width, channel])
+def _maxima_mask(data: np.ndarray,
+                 noise_tolerance: np.uint8 | int | float | np.uint16 | np.uint32,
+                 neighborhood_size: int) -> np.ndarray:
+    # find local maxima using maximum filter
+    data_max = ndimage.maximum_filter(data, size=neighborhood_size, mode='constant')
 
-                # find local maxima using maximum filter
-                data_max = ndimage.maximum_filter(img_chunk, size=neighborhood_size, mode='constant')
+    # find maxima above a certain noise tolerance
+    maxima = (data_max == data) & (data > noise_tolerance)
 
-                # find maxima above a certain noise tolerance
-                maxima = (data_max == img_chunk) & (img_chunk > noise_tolerance)
+    # perform non-maximum suppression
+    return ndimage.maximum_filter(maxima, size=neighborhood_size, mode='constant') == maxima
 
-                # perform non-maximum suppression
-                maxima = ndimage.maximum_filter(maxima, size=neighborhood_size, mode='constant') == maxima
 
-                # label the maxima using connected components analysis
-                _, chunk_num_maxima = ndimage.label(maxima)
+def _count_tile(read: Callable[[int, int, int, int], np.ndarray],
+                shape: tuple[int, int],
+                bounds: tuple[int, int, int, int],
+                noise_tolerance: np.uint8 | int | float | np.uint16 | np.uint32,
+                neighborhood_size: int) -> tuple[int, dict[str, np.ndarray]]:
+    """
+    Count the maxima of a single tile. The tile is read with a halo of *neighborhood_size* pixels so that the maxima
+    mask inside the tile is identical to the mask of the whole image.
+    :param read: a function returning the channel data of the region (start_height, end_height, start_width, end_width)
+    :param shape: the (height, width) of the whole image
+    :param bounds: the (start_height, end_height, start_width, end_width) of the tile
+    :param noise_tolerance:
+    :param neighborhood_size:
+    :return: the number of labels in the tile and the labels on each of its four borders
+    """
+    halo_bounds = maxima_halo(shape, bounds, neighborhood_size)
+    return maxima_tile(read(*halo_bounds), halo_bounds, bounds, noise_tolerance, neighborhood_size)
 
-                # add the count of maxima in this chunk to the total count
-                num_maxima += chunk_num_maxima
-                pass
-            return num_maxima
-        else:
-            data = np.asarray(image)[..., channel]
-        pass
-    elif not isinstance(image, np.ndarray):
-        raise TypeError(f'Invalid data type for parameter *image* in ImageJ.FindMaxima: {image.__class__}')
-    else:
-        data = np.asarray(image)[..., channel]
-        pass
 
-    # Process separate code if input is a numpy array or if no tile_size
-    if isinstance(image, np.ndarray) or not tile_size:
-        # find local maxima using maximum filter
-        data_max = ndimage.maximum_filter(data, size=neighborhood_size, mode='constant')
+def maxima_halo(shape: tuple[int, int],
+                bounds: tuple[int, int, int, int],
+                neighborhood_size: int) -> tuple[int, int, int, int]:
+    """
+    Get the region that must be read around a tile for *maxima_tile*.
+    :param shape: the (height, width) of the whole image
+    :param bounds: the (start_height, end_height, start_width, end_width) of the tile
+    :param neighborhood_size:
+    :return: the (start_height, end_height, start_width, end_width) of the tile and its halo, clipped to the image
+    """
+    height, width = shape
+    start_height, end_height, start_width, end_width = bounds
+    halo = neighborhood_size
+    return (max(start_height - halo, 0), min(end_height + halo, height),
+            max(start_width - halo, 0), min(end_width + halo, width))
+
+
+def maxima_tile(data: np.ndarray,
+                halo_bounds: tuple[int, int, int, int],
+                bounds: tuple[int, int, int, int],
+                noise_tolerance: np.uint8 | int | float | np.uint16 | np.uint32 = np.uint8(20),
+                neighborhood_size: int = 3) -> tuple[int, dict[str, np.ndarray]]:
+    """
+    Label the maxima of a single tile from the channel data of the tile and its halo. The results of all the tiles of
+    an image are combined with *merge_maxima_tiles*.
+    :param data: the channel data of the region *halo_bounds*
+    :param halo_bounds: the region of *data*, see *maxima_halo*
+    :param bounds: the (start_height, end_height, start_width, end_width) of the tile
+    :param noise_tolerance:
+    :param neighborhood_size:
+    :return: the number of labels in the tile and the labels on each of its four borders
+    """
+    halo_height, _, halo_width, _ = halo_bounds
+    start_height, end_height, start_width, end_width = bounds
 
-        # find maxima above a certain noise tolerance
-        maxima = (data_max == data) & (data > noise_tolerance)
+    # find the maxima on the tile and its halo, then keep the tile itself
+    maxima = _maxima_mask(data, noise_tolerance, neighborhood_size)[
+             start_height - halo_height:end_height - halo_height,
+             start_width - halo_width:end_width - halo_width]
 
-        # perform non-maximum suppression
-        maxima = ndimage.maximum_filter(maxima, size=neighborhood_size, mode='constant') == maxima
+    # label the maxima using connected components analysis
+    labels, num_maxima = ndimage.label(maxima)
+    edges = {'top': labels[0, :], 'bottom': labels[-1, :], 'left': labels[:, 0], 'right': labels[:, -1]}
+    return num_maxima, {k: np.array(v) for k, v in edges.items()}
 
-        # label the maxima using connected components analysis
-        _, num_maxima = ndimage.label(maxima)
 
-        # return the number of maxima
-        return num_maxima
+def merge_maxima_tiles(tiles: dict[tuple[int, int], tuple[int, dict[str, np.ndarray]]]) -> int:
+    """
+    Combine the per-tile counts into the count of the whole image. A component cut by a tile border is labeled once in
+    every tile it touches, so the labels that meet across a border are joined and each join removes one count.
+    :param tiles: the results of *maxima_tile* keyed by (tile_row, tile_column)
+    :return: the number of maxima in the whole image
+    """
+    # make the labels of every tile unique
+    offsets, total = ({}, 0)
+    for index in sorted(tiles):
+        offsets[index] = total
+        total += tiles[index][0]
+        pass
 
-        # # Find local maxima
-        # local_max = morphology.local_maxima(data, connectivity=neighborhood_size)
-        #
-        # # Threshold the image
-        # threshold = noise_tolerance
-        #
-        # return np.count_nonzero(local_max & data > threshold)
-    else:
-        raise Exception(f'Unknown Error')
+    parent = {}
+
+    def find(label):
+        root = label
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while label != root:
+            parent[label], label = root, parent.get(label, label)
+        return root
+
+    joins = 0
+    for (y, x), (_, edges) in tiles.items():
+        for neighbor, edge, neighbor_edge in (((y + 1, x), 'bottom', 'top'), ((y, x + 1), 'right', 'left')):
+            if neighbor not in tiles:
+                continue
+            a, b = (edges[edge], tiles[neighbor][1][neighbor_edge])
+            touching = (a > 0) & (b > 0)
+            pairs = set(zip((a[touching] + offsets[(y, x)]).tolist(),
+                            (b[touching] + offsets[neighbor]).tolist()))
+            for p, q in pairs:
+                p, q = (find(p), find(q))
+                if p != q:
+                    parent[p] = q
+                    joins += 1
+                pass
+            pass
+        pass
+    return total - joins
+
+
+def _tiled_maxima(read: Callable[[int, int, int, int], np.ndarray],
+                  shape: tuple[int, int],
+                  tile_size: tuple[int, int],
+                  noise_tolerance: np.uint8 | int | float | np.uint16 | np.uint32,
+                  neighborhood_size: int,
+                  workers: int | None = None,
+                  executor: Executor | None = None,
+                  max_in_flight: int | None = None) -> int:
+    def count(tile):
+        return _count_tile(read, shape, tile[2:], noise_tolerance, neighborhood_size)
+
+    # collect the tile results as they finish
+    tiles = {}
+    for tile, result in map_tiles(count, tile_bounds(*shape, tile_size),
+                                  workers=workers, executor=executor, max_in_flight=max_in_flight):
+        tiles[tile[:2]] = result
+        pass
+    return merge_maxima_tiles(tiles)
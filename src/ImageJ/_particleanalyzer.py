@@ -17,7 +17,7 @@ def options(image: str | os.PathLike | np.ndarray, option: Literal['erode', 'dil
 
     if isinstance(image, (str, os.PathLike)):
         image = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
-    elif not isinstance(image, np.ndarry):
+    elif not isinstance(image, np.ndarray):
         raise TypeError(f'Invalid type for *image*!')
 
     for i in range(iterations):
@@ -110,7 +110,7 @@ class ParticleAnalyzer:
     def detect(self, image: str | os.PathLike | np.ndarray, update_keypoints: bool = True) -> list:
         if isinstance(image, (str, os.PathLike)):
             image = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
-        elif not isinstance(image, np.ndarry):
+        elif not isinstance(image, np.ndarray):
             raise TypeError(f'Invalid type for *image*!')
 
         keypoints = self.simpleblobdetector.detect(image)
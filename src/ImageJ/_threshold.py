@@ -1,21 +1,61 @@
+import math
 import os
+import tempfile
+from typing import Literal
 
 import numpy as np
 import tifffile as tiff
 
+from .._histogram import channel_histograms, _values
+from .._tiles import tile_bounds, read_region
+
 
 def threshold_huang(
         image: os.PathLike | str,
         threshold_channel: int | str,
         tile_size: tuple[int, int] | None = None,
-        white_background: bool = True
+        white_background: bool = True,
+        out: os.PathLike | str | np.ndarray | None = None
 ) -> np.ndarray:
     """
 
     :param white_background:
     :param image:
     :param threshold_channel:
-    :param tile_size:
+    :param tile_size: if supplied, the image is streamed in tiles of this size: the first pass builds one histogram of
+    the whole channel and the second pass applies the resulting threshold to every tile, so the mask is identical to
+    the untiled mask
+    :param out: where the mask is written: an array or memmap of shape (height, width), or a path for a new TIFF file.
+    When tiling without *out*, the mask is memmapped to a temporary file instead of being held in memory
+    :return:
+    """
+    return auto_threshold(image, threshold_channel, method='huang', tile_size=tile_size,
+                          white_background=white_background, out=out)
+
+
+def auto_threshold(
+        image: os.PathLike | str,
+        threshold_channel: int | str,
+        method: Literal['huang', 'otsu', 'triangle', 'li', 'isodata', 'default'] = 'huang',
+        tile_size: tuple[int, int] | None = None,
+        white_background: bool = True,
+        out: os.PathLike | str | np.ndarray | None = None,
+        hist: np.ndarray | None = None
+) -> np.ndarray:
+    """
+    Threshold a channel of an image with one of ImageJ's automatic thresholding methods. As in ImageJ, pixels at or
+    below the threshold are the foreground on a white background, and pixels above it on a dark background.
+    :param image:
+    :param threshold_channel:
+    :param method: the name of the method, see *threshold_from_histogram*
+    :param tile_size: if supplied, the image is streamed in tiles of this size: the first pass builds one histogram of
+    the whole channel and the second pass applies the resulting threshold to every tile, so the mask is identical to
+    the untiled mask
+    :param white_background:
+    :param out: where the mask is written: an array or memmap of shape (height, width), or a path for a new TIFF file.
+    When tiling without *out*, the mask is memmapped to a temporary file instead of being held in memory
+    :param hist: a precomputed 256-bin histogram of the channel, e.g. from *channel_histogram*; the histogram pass is
+    skipped if supplied
     :return:
     """
     if isinstance(threshold_channel, str):
@@ -32,83 +72,256 @@ def threshold_huang(
     else:
         raise TypeError(f'Invalid type for param *threshold_channel* in ImageJ.threshold: {threshold_channel.__class__}')
 
-    # get shape of array
-    shape = tiff.TiffFile(image).pages[0].shape
     if tile_size:
-        # get the shape of the image
-        height, width = (shape[0], shape[1])
+        with tiff.TiffFile(image) as tif:
+            page = tif.pages[0]
+            height, width = (page.imagelength, page.imagewidth)
+
+            # first pass: build one histogram over all tiles
+            if hist is None:
+                hist = channel_histograms(tif, [channel], tile_size=tile_size)[0][0]
+            best_thresh = threshold_from_histogram(hist, method=method)
 
-        # generate blank output matrix
-        binary = np.zeros(shape=(height, width), dtype=bool)
+            # generate the output mask on disk
+            binary = _output_mask(out, (height, width))
 
-        # Get number of tiles
-        tiles_tall = np.arange(0, height, tile_size[0])
-        tiles_wide = np.arange(0, width, tile_size[1])
+            # second pass: apply the global threshold to every tile
+            for [_, _, start_height, end_height, start_width, end_width] in tile_bounds(height, width, tile_size):
+                data = read_region(page, start_height, end_height, start_width, end_width, channel)
+                binary[start_height:end_height, start_width:end_width] = \
+                    data <= best_thresh if white_background else data > best_thresh
+                pass
+            pass
+        if isinstance(binary, np.memmap):
+            binary.flush()
+    else:
+        data = tiff.imread(image)[..., channel]
+
+        # apply the thresholding method to the histogram of the channel
+        best_thresh = threshold_from_histogram(_histogram(data) if hist is None else hist, method=method)
+
+        if out is None:
+            binary = data <= best_thresh if white_background else data > best_thresh
+        else:
+            binary = _output_mask(out, data.shape[:2])
+            binary[...] = data <= best_thresh if white_background else data > best_thresh
+            pass
+    return binary
 
-        # Load the TIFF image into memory-mapped data
-        mmap_data = np.memmap(image, shape=shape, mode='r')
 
-        # loop over the image in chunks
-        for [y, x] in np.ndindex(len(tiles_tall), len(tiles_wide)):
-            # define tile coordinates
-            start_height, start_width = (y * tile_size[0], x * tile_size[1])
-            end_height, end_width = (start_height + tile_size[0], start_width + tile_size[1])
+def channel_histogram(image: os.PathLike | str | np.ndarray,
+                      channel: int | str,
+                      tile_size: tuple[int, int] | None = None) -> np.ndarray:
+    """
+    Get the 256-bin histogram of a channel in a single pass over the pixels. The histogram can be passed to
+    *threshold_from_histogram* for any number of methods.
+    :param image: a path to a TIFF image or an array
+    :param channel: the channel number or color
+    :param tile_size: the size of the tiles the image is read in (default 1024x1024)
+    :return: the histogram as an array of 256 counts
+    """
+    return channel_histograms(image, [channel], tile_size=tile_size if tile_size else (1024, 1024))[0][0]
 
-            data = mmap_data[start_height:end_height, start_width:end_width, channel]
 
-            # apply Huang's thresholding method
-            hist, bins = np.histogram(data.astype(np.uint8).ravel(), 256, [0, 256])
-            hist_norm = hist.astype('float') / hist.max()
+def threshold_from_histogram(hist: np.ndarray,
+                             method: Literal['huang', 'otsu', 'triangle', 'li', 'isodata', 'default'] = 'huang') -> int:
+    """
+    Ports of ImageJ's automatic thresholding methods (ij.process.AutoThresholder) working on a 256-bin histogram.
+    The cost of every method is independent of the number of pixels.
+    :param hist: a 256-bin histogram
+    :param method: 'huang' (fuzzy entropy), 'otsu', 'triangle', 'li' (minimum cross entropy), 'isodata' (iterative
+    intermeans) or 'default' (ImageJ's variant of IsoData)
+    :return: the threshold; pixels at or below it form one class and pixels above it the other
+    """
+    methods = {
+        'huang': _huang,
+        'otsu': _otsu,
+        'triangle': _triangle,
+        'li': _li,
+        'default': _default,
+        'isodata': _isodata
+    }
+    try:
+        func = methods[method.lower()]
+    except KeyError:
+        raise ValueError(f'Invalid thresholding method: {method}')
+    hist = np.asarray(hist, dtype=np.int64)
+    if hist.shape != (256,):
+        raise ValueError(f'*hist* must have 256 bins, not {hist.shape}!')
+    return int(func(hist))
 
-            omega = np.cumsum(hist_norm)
-            mu = np.cumsum(hist_norm * np.arange(0, 256))
-            mu_t = mu[-1]
 
-            # avoid divide by zero warning
-            eps = np.finfo(float).eps
-            omega[omega == 0] = eps
-            omega[omega == 1] = 1 - eps
+def _huang(hist: np.ndarray) -> int:
+    # L-K. Huang and M-J.J. Wang, "Image Thresholding by Minimizing the Measures of Fuzziness", 1995
+    levels = np.arange(256)
+    nonzero = np.flatnonzero(hist)
+    if len(nonzero) == 0:
+        return 0
+    first_bin, last_bin = (nonzero[0], nonzero[-1])
+    if first_bin == last_bin:
+        return int(first_bin)
+    term = 1.0 / (last_bin - first_bin)
 
-            # calculate the between-class variance
-            i = np.arange(0, 256)
-            w0 = omega[i]
-            w1 = 1 - w0
-            mu_0 = mu[i] / w0
-            mu_1 = (mu_t - mu[i]) / w1
-            s = w0 * w1 * ((mu_0 - mu_1) ** 2)
-            best_thresh = np.argmax(s)
+    # mean of the levels at or below (mu_0) and above (mu_1) each threshold
+    mu_0 = np.zeros(256)
+    mu_0[first_bin:] = np.cumsum((levels * hist)[first_bin:]) / np.cumsum(hist[first_bin:])
+    mu_1 = np.zeros(256)
+    mu_1[:last_bin] = (np.cumsum((levels * hist)[last_bin:0:-1]) / np.cumsum(hist[last_bin:0:-1]))[::-1]
 
-            print(best_thresh)
+    # membership of every level (columns) for every threshold (rows)
+    mu = np.where(levels[None, :] <= levels[:, None], mu_0[:, None], mu_1[:, None])
+    mu_x = 1.0 / (1.0 + term * np.abs(levels[None, :] - mu))
 
-            binary[start_height:end_height, start_width:end_width] = \
-                data < best_thresh if white_background else data > best_thresh
-            pass
-        del mmap_data
+    # Shannon's entropy function of the memberships
+    valid = (mu_x >= 1e-06) & (mu_x <= 0.999999)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = np.where(valid, -mu_x * np.log(mu_x) - (1.0 - mu_x) * np.log(1.0 - mu_x), 0.0)
+    return int(np.argmin(entropy @ hist))
+
+
+def _otsu(hist: np.ndarray) -> int:
+    # N. Otsu, "A threshold selection method from gray-level histograms", 1979
+    levels = np.arange(256)
+    total, intensity = (hist.sum(), (levels * hist).sum())
+    k = levels[1:-1]
+    n1 = np.cumsum(hist)[1:-1].astype(float)
+    sk = np.cumsum(levels * hist)[1:-1].astype(float)
+
+    # between class variance of every threshold, the last maximum is kept
+    denom = n1 * (total - n1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bcv = np.where(denom != 0, ((n1 / total) * intensity - sk) ** 2 / denom, 0.0)
+    return int(k[len(k) - 1 - np.argmax(bcv[::-1])])
+
+
+def _triangle(hist: np.ndarray) -> int:
+    # G.W. Zack, W.E. Rogers and S.A. Latt, "Automatic measurement of sister chromatid exchange frequency", 1977
+    nonzero = np.flatnonzero(hist)
+    if len(nonzero) == 0:
+        return 0
+    low, high = (max(nonzero[0] - 1, 0), min(nonzero[-1] + 1, 255))
+    peak = int(np.argmax(hist))
+
+    # use the side of the peak that is furthest from the data
+    inverted = (peak - low) < (high - peak)
+    if inverted:
+        hist = hist[::-1]
+        low, peak = (255 - high, 255 - peak)
+    if low == peak:
+        return int(low)
+
+    # distance of every level between the ends of the histogram to the line from (low, 0) to the peak
+    nx, ny = (float(hist[peak]), float(low - peak))
+    d = math.sqrt(nx * nx + ny * ny)
+    nx, ny = (nx / d, ny / d)
+    d = nx * low + ny * hist[low]
+    levels = np.arange(low + 1, peak + 1)
+    distance = nx * levels + ny * hist[low + 1:peak + 1] - d
+    split = int(levels[np.argmax(distance)]) if distance.max() > 0 else low
+    split -= 1
+    return 255 - split if inverted else split
+
+
+def _li(hist: np.ndarray) -> int:
+    # C.H. Li and P.K.S. Tam, "An iterative algorithm for minimum cross entropy thresholding", 1998
+    levels = np.arange(256)
+    counts = np.cumsum(hist)
+    sums = np.cumsum(levels * hist)
+    tolerance = 0.5
+    if counts[-1] == 0:
+        return 0
+
+    new_thresh = sums[-1] / counts[-1]
+    for _ in range(256):
+        old_thresh = new_thresh
+        threshold = int(old_thresh + 0.5)
+
+        # means of the background and object pixels
+        num_back, sum_back = (counts[threshold], sums[threshold])
+        num_obj, sum_obj = (counts[-1] - num_back, sums[-1] - sum_back)
+        mean_back = sum_back / num_back if num_back else 0.0
+        mean_obj = sum_obj / num_obj if num_obj else 0.0
+
+        # new threshold, equation (7) of the reference
+        with np.errstate(divide='ignore', invalid='ignore'):
+            temp = (mean_back - mean_obj) / (np.log(mean_back) - np.log(mean_obj))
+        if not np.isfinite(temp):
+            break
+        new_thresh = math.trunc(temp - 0.5) if temp < -2.220446049250313e-16 else math.trunc(temp + 0.5)
+        if abs(new_thresh - old_thresh) <= tolerance:
+            break
         pass
-    else:
-        data = tiff.imread(image)[..., channel]
+    return threshold
 
-        # apply Huang's thresholding method
-        hist, bins = np.histogram(data.astype(np.uint8).ravel(), 256, [0, 256])
-        hist_norm = hist.astype('float') / hist.max()
-
-        omega = np.cumsum(hist_norm)
-        mu = np.cumsum(hist_norm * np.arange(0, 256))
-        mu_t = mu[-1]
-
-        # avoid divide by zero warning
-        eps = np.finfo(float).eps
-        omega[omega == 0] = eps
-        omega[omega == 1] = 1 - eps
-
-        # calculate the between-class variance
-        i = np.arange(0, 256)
-        w0 = omega[i]
-        w1 = 1 - w0
-        mu_0 = mu[i] / w0
-        mu_1 = (mu_t - mu[i]) / w1
-        s = w0 * w1 * ((mu_0 - mu_1) ** 2)
-        best_thresh = np.argmax(s)
-
-        binary = data < best_thresh if white_background else data > best_thresh
-    return binary
+
+def _isodata(hist: np.ndarray) -> int:
+    # T.W. Ridler and S. Calvard, "Picture thresholding using an iterative selection method", 1978 (intermeans)
+    levels = np.arange(256)
+    counts = np.cumsum(hist)
+    sums = np.cumsum(levels * hist)
+
+    # start above the first non-empty bin after the first bin
+    nonzero = np.flatnonzero(hist[1:])
+    start = nonzero[0] + 2 if len(nonzero) else 0
+
+    # the first threshold equal to the rounded mean of the (integer) means of the two classes
+    for g in range(start, 255):
+        below_count, above_count = (counts[g], counts[-1] - counts[g])
+        if below_count > 0 and above_count > 0:
+            below_mean, above_mean = (sums[g] // below_count, (sums[-1] - sums[g]) // above_count)
+            if g == math.floor((below_mean + above_mean) / 2.0 + 0.5):
+                return g
+        pass
+    # ImageJ reports that no threshold was found
+    return 0
+
+
+def _default(hist: np.ndarray) -> int:
+    # ImageJ's "Default" method, a variant of the IsoData method which ignores the two extreme bins
+    hist = hist.copy()
+    hist[0], hist[-1] = (0, 0)
+    nonzero = np.flatnonzero(hist)
+    if len(nonzero) == 0 or nonzero[0] >= nonzero[-1]:
+        return 128
+    low, high = (nonzero[0], nonzero[-1])
+    levels = np.arange(256)
+    counts = np.cumsum(hist)
+    sums = np.cumsum(levels * hist)
+
+    # move the threshold up until it passes the mean of the two class means
+    moving_index = low
+    while True:
+        below_sum, below_count = (sums[moving_index], counts[moving_index])
+        above_sum, above_count = (sums[high] - below_sum, counts[high] - below_count)
+        result = (below_sum / below_count + above_sum / above_count) / 2.0
+        moving_index += 1
+        if not ((moving_index + 1) <= result and moving_index < high - 1):
+            break
+        pass
+    return int(math.floor(result + 0.5))
+
+
+def _histogram(data: np.ndarray) -> np.ndarray:
+    # 256-bin histogram of the 8-bit values of a single channel, which rejects other data types like the tiled path
+    return np.bincount(_values(data, 0), minlength=256)
+
+
+def _output_mask(out: os.PathLike | str | np.ndarray | None, shape: tuple[int, int]) -> np.ndarray:
+    """
+    Get the array the binary mask is written to.
+    :param out: an existing array or memmap, a path for a new TIFF file, or None for a temporary file
+    :param shape: the (height, width) of the mask
+    :return: a boolean array of the given shape
+    """
+    if out is None:
+        # the temporary file is removed as soon as the memmap is closed
+        return np.memmap(tempfile.TemporaryFile(), dtype=bool, mode='w+', shape=shape)
+    elif isinstance(out, (os.PathLike, str)):
+        # TIFF files cannot store booleans, so the mask is stored as 0 and 1
+        return tiff.memmap(out, shape=shape, dtype=np.uint8, photometric='minisblack').view(bool)
+    elif isinstance(out, np.ndarray):
+        if out.shape[:2] != tuple(shape):
+            raise ValueError(f'*out* has shape {out.shape} but the mask has shape {shape}!')
+        return out
+    else:
+        raise TypeError(f'Invalid type for param *out* in ImageJ.threshold: {out.__class__}')
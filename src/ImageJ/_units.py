@@ -4,12 +4,16 @@ import numpy as np
 import tifffile as tiff
 
 
-def pixels_per_micron(image: os.PathLike | str,
+def pixels_per_micron(image: os.PathLike | str | tiff.TiffFile,
                       xResolution_tag: int | str | None = 282,
                       yResolution_tag: int | str | None = 283,
                       ResolutionUnit_tag: int | str | None = 296,
                       collapse_resolutions: bool = True) -> tuple[float, float] | float:
-    tags = tiff.TiffFile(image).pages[0].tags
+    if not isinstance(image, tiff.TiffFile):
+        with tiff.TiffFile(image) as tif:
+            return pixels_per_micron(tif, xResolution_tag=xResolution_tag, yResolution_tag=yResolution_tag,
+                                     ResolutionUnit_tag=ResolutionUnit_tag, collapse_resolutions=collapse_resolutions)
+    tags = image.pages[0].tags
     # Get Resolution Units
     units = tags[ResolutionUnit_tag].value
     xres = tags[yResolution_tag].value
@@ -33,22 +37,26 @@ def pixels_per_micron(image: os.PathLike | str,
         return (yres[0] / yres[1]) / microns_per_unit, (xres[0] / xres[1]) / microns_per_unit
 
 
-def image_size_microns(image: os.PathLike | str,
+def image_size_microns(image: os.PathLike | str | tiff.TiffFile,
                        xResolution_tag: int | str | None = 282,
                        yResolution_tag: int | str | None = 283,
                        ResolutionUnit_tag: int | str | None = 296,
                        collapse_resolutions: bool = True) -> tuple[float, float]:
+    if not isinstance(image, tiff.TiffFile):
+        with tiff.TiffFile(image) as tif:
+            return image_size_microns(tif, xResolution_tag=xResolution_tag, yResolution_tag=yResolution_tag,
+                                      ResolutionUnit_tag=ResolutionUnit_tag, collapse_resolutions=collapse_resolutions)
     ppm = pixels_per_micron(image, xResolution_tag=xResolution_tag,
                             yResolution_tag=yResolution_tag, ResolutionUnit_tag=ResolutionUnit_tag,
                             collapse_resolutions=collapse_resolutions)
-    shape = tiff.TiffFile(image).pages[0].shape
+    shape = image.pages[0].shape
     pixel_height, pixel_width = (shape[0], shape[1])
     y_ppm, x_ppm = (ppm, ppm) if collapse_resolutions else ppm
     return pixel_height / y_ppm, pixel_width / x_ppm
 
 
 def convert_pixel_to_area(pixel_area: int,
-                          image: os.PathLike | str | None = None,
+                          image: os.PathLike | str | tiff.TiffFile | None = None,
                           xResolution_tag: int | str | None = 282,
                           yResolution_tag: int | str | None = 283,
                           ResolutionUnit_tag: int | str | None = 296,
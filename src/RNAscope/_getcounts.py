@@ -1,29 +1,31 @@
 import csv
 import logging
 import os.path
+import tempfile
 from contextlib import redirect_stdout, redirect_stderr
+from functools import partial
 from glob import glob
-from typing import Literal, Any, Callable
+from multiprocessing import Pool
+from typing import Literal, Any, Callable, Iterable, Iterator
 
 import imagej
 import numpy as np
+import psutil
 import scyjava
+import tifffile as tiff
 import time
 
 from tqdm import tqdm
-from PIL import Image
 
-from ..ImageJ import FindMaxima, ParticleAnalyzer, threshold_huang, image_size_microns, \
-    convert_pixel_to_area, options
+from .._tiles import tile_bounds, read_region, map_tiles
+from ..ImageJ import convert_pixel_to_area, options, pixels_per_micron, threshold_from_histogram, maxima_halo, \
+    maxima_tile, merge_maxima_tiles
 
 # this code runs using the basic pyimagej environment created using
 #   conda install mamba -n base -c conda-forge
 #   mamba create -n pyimagej -c conda-forge pyimagej openjdk=8
 #   conda activate pyimagej
 
-scyjava.config.add_option('-Xmx24g')
-# scyjava.config.add_option(r'-Dplugins.dir=E:\Aaron Y\Fiji.app\plugins')
-
 default_macro = """
 #@ String imagepath
 #@output String results
@@ -96,101 +98,226 @@ def getcounts(inputdir: str | os.PathLike,
               *,
               algorithm: Literal['opencv', 'imagej'] = 'opencv',
               header: list = None,
+              output_file: str | None = None,
+              processes: int | None = None,
+              chunksize: int = 1,
               **kwargs):
+    """
+    Count the RNAscope dots and measure the tissue area of every TIFF image in *inputdir* and its subdirectories. Each
+    row is written to the CSV as soon as its image is done, so an interrupted run can be resumed by passing the same
+    *output_file*: the images already in the file are skipped and the new rows are appended.
+    :param inputdir: the directory of images
+    :param outputdir: the directory to write the CSV file to
+    :param algorithm: 'opencv' or 'imagej'
+    :param header: the header of the CSV file (only written to a new file)
+    :param output_file: the name of the CSV file in *outputdir* (default Counts_<time>.csv)
+    :param processes: the number of processes to analyze the images on (for 'imagej', each process runs its own JVM,
+    and the *memory* kwarg is the heap of each JVM, by default half of the physical memory divided by *processes*, up
+    to 24 GB); images are analyzed serially if None or 1
+    :param chunksize: the number of images sent to a process at once
+    :param kwargs: the kwargs passed to the algorithm
+    :return:
+    """
+    if not output_file:
+        output_file = f'Counts_{time.time_ns()}.csv'
+    # Skip the images already in the output file of an interrupted run
+    completed = _completed_images(os.path.join(outputdir, output_file))
+
     if algorithm == 'opencv':
         opencv_keys = ['save_threshold_image_dir', 'func']
         opencv_kwargs = {k: kwargs.pop(k) for k in opencv_keys if k in kwargs}
-        results = _batch_getcounts_opencv(inputdir, **opencv_kwargs, **kwargs)
+        results = _batch_getcounts_opencv(inputdir, skip=completed, processes=processes, chunksize=chunksize,
+                                          **opencv_kwargs, **kwargs)
         pass
     elif algorithm == 'imagej':
-        imagej_keys = ['fiji_version', 'macro']
+        imagej_keys = ['fiji_version', 'memory', 'macro']
         imagej_kwargs = {k: v for k, v in kwargs.items() if k in imagej_keys}
-        results = _batch_getcounts_imagej(inputdir, **imagej_kwargs)
+        results = _batch_getcounts_imagej(inputdir, skip=completed, processes=processes, chunksize=chunksize,
+                                          **imagej_kwargs)
         pass
     else:
         raise ValueError(f'Invalid value for *algorithm*!')
     if not header:
         header = default_header
-    _write(results, outputdir, header=header)
+    _write(results, outputdir, header=header, output_file=output_file)
     pass
 
 
+def _find_images(inputdir: str | os.PathLike, skip: set[str] = frozenset()) -> list[str]:
+    inputDir = os.path.abspath(inputdir)
+
+    # Ensure input and output are properly defined
+    if inputDir != '':
+        imagepaths = [image
+                      for root, dirs, files in os.walk(inputDir)
+                      for image in glob(os.path.join(root, '*.[Tt][Ii][Ff]'))
+                      if not os.path.islink(image)]
+        if len(imagepaths) == 0:
+            raise ValueError(f'*inputdir* is empty!')
+    else:
+        raise ValueError(f'*inputdir* is not properly defined!')
+    return [imagepath for imagepath in imagepaths if os.path.normpath(imagepath) not in skip]
+
+
+def _completed_images(outputpath: str | os.PathLike, /, *, delimiter: str = '\t') -> set[str]:
+    """
+    Read the images already counted in an existing CSV file.
+    :param outputpath: the path to the CSV file
+    :param delimiter:
+    :return: the normalized paths (directory path joined with image name) of the complete rows in the file
+    """
+    completed = set()
+    if not os.path.exists(outputpath):
+        return completed
+    with open(outputpath, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader, None)
+        for row in reader:
+            # A row cut short by a crash is not complete, so its image is counted again
+            if header and len(row) == len(header):
+                completed.add(os.path.normpath(os.path.join(row[1], row[0])))
+            pass
+        pass
+    return completed
+
+
+# The PyImageJ handle of the current process; each worker of the pool starts its own JVM once and keeps it
+_imagej_instance = None
+
+
+def _init_imagej(fiji_version: str = 'native',
+                 memory: str | None = None,
+                 mode: str = 'interactive') -> Any:
+    """
+    Start the JVM and ImageJ of the current process, or return the handle if it is already started. The JVM can only
+    be started once per process, so *memory* only applies to the first call.
+    :param fiji_version: 'native' for the local Fiji installation or a version of sc.fiji:fiji
+    :param memory: the maximum heap size of the JVM of this process (e.g. '8g'), passed as -Xmx; the JVM's own default
+    if None
+    :param mode: the PyImageJ mode
+    :return: the PyImageJ handle
+    """
+    global _imagej_instance
+    if _imagej_instance is None:
+        if memory:
+            scyjava.config.add_option(f'-Xmx{memory}')
+        # scyjava.config.add_option(r'-Dplugins.dir=E:\Aaron Y\Fiji.app\plugins')
+        fiji = r'E:\Aaron Y\Fiji.app' if fiji_version == 'native' else f'sc.fiji:fiji:{fiji_version}'
+        _imagej_instance = imagej.init(fiji, mode=mode)
+    return _imagej_instance
+
+
+# The share of the physical memory given to the JVM heaps, leaving the rest for Python, the OS, the non-heap memory of
+# the JVMs and the image buffers, and the largest heap of a single JVM
+_JVM_MEMORY_FRACTION = 0.5
+_JVM_MAX_MEMORY = 24 * 2 ** 30
+
+
+def _worker_memory(processes: int | None, total: int | None = None) -> str:
+    """
+    Divide half of the physical memory of the machine between the JVMs of *processes* workers, up to 24 GB each.
+    :param processes: the number of workers, each running its own JVM (one if None)
+    :param total: the physical memory in bytes (default read with *psutil*)
+    :return: the heap size of each JVM in megabytes (e.g. '6144m')
+    """
+    if total is None:
+        total = psutil.virtual_memory().total
+    memory = min(int(total * _JVM_MEMORY_FRACTION) // max(processes or 1, 1), _JVM_MAX_MEMORY)
+    return f'{max(memory // 2 ** 20, 1)}m'
+
+
 def _getcounts_imagej(imagepath: str | os.PathLike,
                       /,
                       *,
                       imagej_object: Any | None = None,
                       fiji_version: str | None = None,
+                      memory: str | None = None,
                       macro: str = None) -> list:
     if not imagej_object:
         if fiji_version:
-            fiji = r'E:\Aaron Y\Fiji.app' if fiji_version == 'native' else f'sc.fiji:fiji:{fiji_version}'
-            ij = imagej.init(fiji, mode='interactive')
+            ij = _init_imagej(fiji_version, memory=memory)
         else:
             raise KeyError(f'A version for *fiji_version* must be specified if a PyImageJ handler is not supplied!')
     else:
         ij = imagej_object
-        args = {'imagepath': os.path.abspath(imagepath)}
-        try:
-            logging.basicConfig(level=logging.ERROR)
-            with redirect_stdout(os.devnull), redirect_stderr(os.devnull):
-                if not macro:
-                    macro = default_macro
-                pyimagej_results = ij.py.run_macro(macro, args)
-                result = str(pyimagej_results.getOutput('results')).split('\t')
-        except Exception as e:
-            print(e)
-            result = None
+    args = {'imagepath': os.path.abspath(imagepath)}
+    try:
+        logging.basicConfig(level=logging.ERROR)
+        with redirect_stdout(os.devnull), redirect_stderr(os.devnull):
+            if not macro:
+                macro = default_macro
+            pyimagej_results = ij.py.run_macro(macro, args)
+            result = str(pyimagej_results.getOutput('results')).split('\t')
+    except Exception as e:
+        print(e)
+        result = []
     return list(result)
 
 
 def _batch_getcounts_imagej(inputdir: str | os.PathLike,
                             /,
                             *,
+                            skip: set[str] = frozenset(),
+                            processes: int | None = None,
+                            chunksize: int = 1,
                             fiji_version: str = 'native',
-                            macro: str = default_macro) -> list:
-    inputDir = os.path.abspath(inputdir)
+                            memory: str | None = None,
+                            macro: str = default_macro) -> Iterator[list]:
+    imagepaths = _find_images(inputdir, skip)
+    # *memory* is the heap of each JVM, so by default half of the physical memory is shared between the workers
+    if memory is None:
+        memory = _worker_memory(processes)
+    getcounts_image = partial(_getcounts_imagej, fiji_version=fiji_version, memory=memory, macro=macro)
 
-    # Ensure input and output are properly defined
-    if inputDir != '':
-        imagepaths = [image
-                      for root, dirs, files in os.walk(inputDir)
-                      for image in glob(os.path.join(root, '*.[Tt][Ii][Ff]'))
-                      if not os.path.islink(image)]
-        if len(imagepaths) == 0:
-            raise ValueError(f'*inputdir* is empty!')
+    def run():
+        if processes and processes > 1:
+            # Each worker starts its own JVM with *memory* once and runs the macro on every image it is sent
+            with Pool(processes=processes, initializer=_init_imagej,
+                      initargs=(fiji_version, memory)) as pool:
+                yield from tqdm(pool.imap(getcounts_image, imagepaths, chunksize=max(chunksize, 1)),
+                                total=len(imagepaths))
+                pass
+        else:
+            _init_imagej(fiji_version, memory=memory)
+            for imagepath in tqdm(imagepaths):
+                yield getcounts_image(imagepath)
+            pass
+        pass
 
-        results = []
-        fiji = r'E:\Aaron Y\Fiji.app' if fiji_version == 'native' else f'sc.fiji:fiji:{fiji_version}'
-        ij = imagej.init(fiji, mode='interactive')
-        # ij = imagej.init('sc.fiji:fiji:2.5.0', mode='interactive')
-        for imagepath in tqdm(imagepaths):
-            result = []
-            try:
-                logging.basicConfig(level=logging.ERROR)
-                with redirect_stdout(os.devnull), redirect_stderr(os.devnull):
-                    result = _getcounts_imagej(imagepath, imagej_object=ij, macro=macro)
-            except Exception as e:
-                print(e)
-            finally:
-                results.append(result)
-    else:
-        raise ValueError(f'*inputdir* is not properly defined!')
-    return results
+    return run()
 
 
-def _write(results: list | Any,
+def _write(results: Iterable[list],
            outputdir: str | os.PathLike,
            /,
            *,
            header: list = None,
-           delimiter: str = '\t'):
-    with open(os.path.join(outputdir, f'Counts_{time.time_ns()}.csv'), 'w', encoding='utf-8', newline='\n') as f:
+           delimiter: str = '\t',
+           output_file: str | None = None):
+    if not output_file:
+        output_file = f'Counts_{time.time_ns()}.csv'
+    outputpath = os.path.join(outputdir, output_file)
+    # Append to the file of an interrupted run
+    new_file = not os.path.exists(outputpath) or os.path.getsize(outputpath) == 0
+    # A row cut short by a crash does not end the line, so the next row must start on a new line
+    if not new_file:
+        with open(outputpath, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            truncated = f.read(1) not in b'\r\n'
+    with open(outputpath, 'a', encoding='utf-8', newline='\n') as f:
         writer = csv.writer(f, delimiter=delimiter)
-        if not header:
-            header = default_header
-        writer.writerow(header)
-        writer.writerows(results)
-        f.close()
+        if new_file:
+            if not header:
+                header = default_header
+            writer.writerow(header)
+        elif truncated:
+            f.write('\n')
+        # Write each row as soon as it is done so that a crash only loses the images still being analyzed
+        for result in results:
+            if result:
+                writer.writerow(result)
+                f.flush()
+            pass
         pass
     pass
 
@@ -210,8 +337,6 @@ def _getcounts_opencv(imagepath: str | os.PathLike,
             threshold_kwargs = {k: v for k, v in kwargs.items() if k in threshold_keys}
             if 'threshold_channel' not in threshold_kwargs.keys():
                 raise KeyError(f'Must specify a channel to be thresholded for the area!')
-            particleanalyzer_keys = ['area', 'threshold', 'threshold_step', 'circularity', 'convexity', 'inertia_ratio']
-            particleanalyzer_kwargs = {k: v for k, v in kwargs.items() if k in particleanalyzer_keys}
             findmaxima_keys = ['maxima_channel', 'tile_size', 'noise_tolerance', 'neighborhood_size']
             findmaxima_kwargs = {k: v for k, v in kwargs.items() if k in findmaxima_keys}
             if 'maxima_channel' not in findmaxima_kwargs.keys():
@@ -220,76 +345,200 @@ def _getcounts_opencv(imagepath: str | os.PathLike,
             units_kwargs = {k: v for k, v in kwargs.items() if k in units_keys}
             options_keys = ['options_size', 'iterations']
             options_kwargs = {k: v for k, v in kwargs.items() if k in options_keys}
+            # The ParticleAnalyzer kwargs are accepted but not used: the tissue area is the number of nonzero pixels
+            # of the threshold mask
 
-            # Threshold the image on the selected channel
-            threshold_array = threshold_huang(imagepath, **threshold_kwargs)
-            # Use Particle Analyzer to get standard tissue outlines
-            analyzer = ParticleAnalyzer(**particleanalyzer_kwargs)
-            # Dilate and close to connect any difficult areas and ensure the tissue is enclosing itself
-            threshold_array = options(threshold_array, option='dilate', **options_kwargs)  # Dilate
-            threshold_array = options(threshold_array, option='dilate', **options_kwargs)  # Close
-            if save_threshold_image_dir:
-                filename = os.path.basename(imagepath)
-                filebase, ext = os.path.splitext(filename)
-                newfilepath = os.path.join(save_threshold_image_dir, f'{filebase}_THRESHOLD{ext}')
-                Image.fromarray(threshold_array).save(newfilepath)
-                pass
-            # Use Particle Analyzer to get the tissues in new threshold matrix
-            # might not have to. might not be able to get area using cv2.KeyPoints
-            # instead try just counting nonzero pixels?
-            # particles = analyzer.detect(threshold_array)
-            # Get tissue area
-            tissue_pixels = np.count_nonzero(threshold_array)
-            tissue_area = convert_pixel_to_area(tissue_pixels, image=imagepath, **units_kwargs)
-            # Get image area
-            image_height, image_width = image_size_microns(imagepath, **units_kwargs)
-            # Get dot counts
-            num_maxima = FindMaxima(imagepath, **findmaxima_kwargs)
-
-            result = []
-            result[0] = os.path.basename(imagepath)  # Image name
-            result[1] = os.path.dirname(imagepath)  # Image path
-            result[2] = num_maxima  # Dot Count
-            result[3] = tissue_area  # Tissue area
-            result[4] = image_height * image_width  # Image Area
-            result[5] = result[2] / result[3]  # Dots per unit area
-            result[6] = result[3] / result[4]  # Tissue to image area ratio (for QC)
+            # Threshold, count the dots and read the resolution tags from a single pass over the image
+            result = _getcounts_fused(imagepath,
+                                      save_threshold_image_dir=save_threshold_image_dir,
+                                      workers=kwargs.get('workers'),
+                                      **{**threshold_kwargs, **findmaxima_kwargs, **units_kwargs, **options_kwargs})
             pass
         pass
     except Exception as e:
         print(e)
-        result = None
+        result = []
     return list(result)
 
 
-def _batch_getcounts_opencv(inputdir: str | os.PathLike, 
+def _getcounts_fused(imagepath: str | os.PathLike,
+                     /,
+                     *,
+                     threshold_channel: int | str,
+                     maxima_channel: int | str,
+                     tile_size: tuple[int, int] | None = None,
+                     white_background: bool = True,
+                     noise_tolerance: np.uint8 | int | float | np.uint16 | np.uint32 = np.uint8(20),
+                     neighborhood_size: int = 3,
+                     options_size: int = 1,
+                     iterations: int = 1,
+                     save_threshold_image_dir: str | os.PathLike | None = None,
+                     workers: int | None = None,
+                     collapse_resolutions: bool = True,
+                     **units_kwargs) -> list:
+    """
+    Count the dots and measure the tissue area of an image while decoding every tile of the image only once. Each tile
+    is read with the halo needed by FindMaxima, and the same decoded pixels feed the histogram of the area channel and
+    the maxima detection. The resolution tags are read once.
+    :param imagepath: the path to the TIFF image
+    :param threshold_channel: the channel number or color to be used for thresholding the tissue area (Huang)
+    :param maxima_channel: the channel number or color to be used for maxima identification
+    :param tile_size: the size of the tiles (default 4096x4096); the results do not depend on the tile size
+    :param white_background:
+    :param noise_tolerance:
+    :param neighborhood_size:
+    :param options_size: the size of the kernel used to dilate the threshold mask
+    :param iterations: the number of iterations of each dilation
+    :param save_threshold_image_dir: if supplied, the threshold mask is saved as a TIFF in this directory
+    :param workers: the number of threads to process the tiles on
+    :param collapse_resolutions:
+    :param units_kwargs: the resolution tags passed to *pixels_per_micron*
+    :return: the row of results for the image
+    """
+    colors = {'red': 0, 'green': 1, 'blue': 2}
+    area_channel = colors[threshold_channel] if isinstance(threshold_channel, str) else threshold_channel
+    dot_channel = colors[maxima_channel] if isinstance(maxima_channel, str) else maxima_channel
+    if not tile_size:
+        tile_size = (4096, 4096)
+    # Dilation with a 1x1 kernel leaves the mask unchanged, so the tissue area comes straight from the histogram
+    dilate = options_size > 1 and iterations > 0
+
+    with tiff.TiffFile(imagepath) as tif:
+        tif.filehandle.set_lock(True)
+        page = tif.pages[0]
+        shape = (page.imagelength, page.imagewidth)
+
+        # Read the resolution tags once
+        ppm = pixels_per_micron(tif, collapse_resolutions=collapse_resolutions, **units_kwargs)
+
+        # Keep the decoded area channel if the mask is needed after the threshold is known
+        area_data = None
+        if dilate or save_threshold_image_dir:
+            area_data = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=shape)
+
+        def process(tile):
+            bounds = tile[2:]
+            start_height, end_height, start_width, end_width = bounds
+            halo_bounds = maxima_halo(shape, bounds, neighborhood_size)
+            data = read_region(page, *halo_bounds)
+
+            # Histogram of the area channel inside the tile
+            area = data[start_height - halo_bounds[0]:end_height - halo_bounds[0],
+                        start_width - halo_bounds[2]:end_width - halo_bounds[2], area_channel]
+            hist = np.bincount(area.astype(np.uint8, copy=False).ravel(), minlength=256)
+            if area_data is not None:
+                area_data[start_height:end_height, start_width:end_width] = area
+
+            # Maxima of the dot channel of the tile and its halo
+            return hist, maxima_tile(data[..., dot_channel], halo_bounds, bounds, noise_tolerance, neighborhood_size)
+
+        hist = np.zeros(256, dtype=np.int64)
+        maxima = {}
+        for tile, (tile_hist, tile_maxima) in map_tiles(process, tile_bounds(*shape, tile_size), workers=workers):
+            hist += tile_hist
+            maxima[tile[:2]] = tile_maxima
+            pass
+        pass
+
+    # Get dot counts
+    num_maxima = merge_maxima_tiles(maxima)
+
+    # Threshold the area channel with Huang's method on the histogram of the whole image
+    threshold = threshold_from_histogram(hist, method='huang')
+    if area_data is None:
+        tissue_pixels = int(hist[:threshold + 1].sum() if white_background else hist[threshold + 1:].sum())
+    else:
+        out = None
+        if save_threshold_image_dir:
+            filebase, ext = os.path.splitext(os.path.basename(imagepath))
+            newfilepath = os.path.join(save_threshold_image_dir, f'{filebase}_THRESHOLD{ext}')
+            out = tiff.memmap(newfilepath, shape=shape, dtype=np.uint8, photometric='minisblack')
+        tissue_pixels = _tissue_pixels(area_data, threshold, white_background, tile_size,
+                                       options_size=options_size, iterations=iterations if dilate else 0, out=out)
+        if out is not None:
+            out.flush()
+            del out
+        del area_data
+
+    # Get tissue and image areas
+    tissue_area = convert_pixel_to_area(tissue_pixels, ppm=ppm, collapse_resolutions=collapse_resolutions)
+    y_ppm, x_ppm = (ppm, ppm) if collapse_resolutions else ppm
+    image_area = (shape[0] / y_ppm) * (shape[1] / x_ppm)
+
+    return [os.path.basename(imagepath),  # Image name
+            os.path.dirname(imagepath),  # Image path
+            num_maxima,  # Dot Count
+            tissue_area,  # Tissue area
+            image_area,  # Image Area
+            num_maxima / tissue_area,  # Dots per unit area
+            tissue_area / image_area]  # Tissue to image area ratio (for QC)
+
+
+def _tissue_pixels(area_data: np.ndarray,
+                   threshold: int,
+                   white_background: bool,
+                   tile_size: tuple[int, int],
+                   /,
+                   *,
+                   options_size: int = 1,
+                   iterations: int = 1,
+                   out: np.ndarray | None = None) -> int:
+    """
+    Count the pixels of the dilated threshold mask tile by tile. Each tile is dilated with a halo wide enough that the
+    result inside the tile is identical to dilating the whole mask.
+    :param area_data: the area channel of the whole image
+    :param threshold:
+    :param white_background:
+    :param tile_size:
+    :param options_size:
+    :param iterations: the number of iterations of each of the two dilations, 0 to not dilate
+    :param out: if supplied, the mask is written into this array as 0 and 255
+    :return: the number of pixels in the mask
+    """
+    height, width = area_data.shape
+    halo = 2 * iterations * options_size
+    tissue_pixels = 0
+    for [_, _, start_height, end_height, start_width, end_width] in tile_bounds(height, width, tile_size):
+        halo_height, halo_width = (max(start_height - halo, 0), max(start_width - halo, 0))
+        data = area_data[halo_height:min(end_height + halo, height), halo_width:min(end_width + halo, width)]
+        mask = (data <= threshold) if white_background else (data > threshold)
+        mask = mask.astype(np.uint8) * np.uint8(255)
+        if iterations:
+            # Dilate and close to connect any difficult areas and ensure the tissue is enclosing itself
+            mask = options(mask, option='dilate', options_size=options_size, iterations=iterations)  # Dilate
+            mask = options(mask, option='dilate', options_size=options_size, iterations=iterations)  # Close
+        mask = mask[start_height - halo_height:end_height - halo_height,
+                    start_width - halo_width:end_width - halo_width]
+        tissue_pixels += int(np.count_nonzero(mask))
+        if out is not None:
+            out[start_height:end_height, start_width:end_width] = mask
+        pass
+    return tissue_pixels
+
+
+def _batch_getcounts_opencv(inputdir: str | os.PathLike,
                             /,
                             *,
+                            skip: set[str] = frozenset(),
+                            processes: int | None = None,
+                            chunksize: int = 1,
                             save_threshold_image_dir: str | os.PathLike | None = None,
-                            func: Callable | None = None, 
-                            **kwargs) -> list:
-    inputDir = os.path.abspath(inputdir)
+                            func: Callable | None = None,
+                            **kwargs) -> Iterator[list]:
+    imagepaths = _find_images(inputdir, skip)
+    getcounts_image = partial(_getcounts_opencv, save_threshold_image_dir=save_threshold_image_dir, func=func, **kwargs)
 
-    # Ensure input and output are properly defined
-    if inputDir != '':
-        imagepaths = [image
-                      for root, dirs, files in os.walk(inputDir)
-                      for image in glob(os.path.join(root, '*.[Tt][Ii][Ff]'))
-                      if not os.path.islink(image)]
-        if len(imagepaths) == 0:
-            raise ValueError(f'*inputdir* is empty!')
-        results = []
-        for imagepath in tqdm(imagepaths):
-            result = []
-            try:
-                result = _getcounts_opencv(imagepath,
-                                           save_threshold_image_dir=save_threshold_image_dir,
-                                           func=func,
-                                           **kwargs)
-            except Exception as e:
-                print(e)
-            finally:
-                results.append(result)
-    else:
-        raise ValueError(f'*inputdir* is not properly defined!')
-    return results
+    def run():
+        if processes and processes > 1:
+            # Images are sent to the pool in order and the rows come back in the same order as soon as they are done
+            with Pool(processes=processes) as pool:
+                yield from tqdm(pool.imap(getcounts_image, imagepaths, chunksize=max(chunksize, 1)),
+                                total=len(imagepaths))
+                pass
+        else:
+            for imagepath in tqdm(imagepaths):
+                yield getcounts_image(imagepath)
+            pass
+        pass
+
+    return run()
@@ -1,8 +1,10 @@
-import itertools
+from functools import lru_cache, partial
+from typing import Callable
 
 import numpy as np
 
-from .. import ImageTIFF
+from .. import ImageTIFF, compile_lut, apply_lut
+from .._lut import _CHUNK_PIXELS, _classify_chunks
 
 
 def thresholdchannel(img: ImageTIFF | np.ndarray,
@@ -10,155 +12,271 @@ def thresholdchannel(img: ImageTIFF | np.ndarray,
                      C2channel='green',
                      C3channel='blue',
                      whitebackground=True,
-                     loop=True):
+                     loop=True,
+                     classifier: Callable[..., np.ndarray] | None = None,
+                     classifier_params: dict | None = None,
+                     out: np.ndarray | None = None,
+                     inplace: bool = False):
     """
     Thresholds the corresponding channel color and returns an image with the thresholded channel above background
-    according to whitebackground. Performs the operation faster due to NumPy's broadcasting features.
+    according to whitebackground. The channel is thresholded in place one band of rows (or one tile) at a time, reusing
+    the same scratch mask, so no full-size temporaries are allocated.
     :param loop: If True, analyze tiles using for loops. If False, analyze using NumPy's broadcasting features.
     :param img:
     :param mainchannel: usually red
     :param C2channel: usually green
     :param C3channel: usually blue
     :param whitebackground: True if background colors are brighter than signal colors
+    :param classifier: a vectorized per-pixel predicate classifier(main, C2, C3, **classifier_params) deciding which
+    pixels are kept (default *redish*); it is compiled once into a lookup table over every RGB color
+    :param classifier_params: the parameters of the classifier (e.g. {'cutoff': 90})
+    :param out: for arrays, a buffer or memmap of the shape of *img* to write the result into (*img* is copied into it
+    first unless it is *img*)
+    :param inplace: for arrays, write the result into *img* itself
     :return:
     """
 
-    # function to decide if red color is dominant
-    def redish(r, g, b):
-        # Global color cutoff so that pixels are not too dark
-        cutoff = np.uint(85)
-
-        # Create cutoff mask for later faster processing
-        red_mask = r > cutoff
-
-        def isnotred_greencorrection(red, green, blue, mask):
-            c1factor = 1
-            c2factor = 1.15
-            condition2 = green[mask] > cutoff
-            condition3 = blue[mask] > cutoff
-            condition4 = red[mask] > green[mask] * c1factor
-            condition5 = green[mask] > blue[mask] * c2factor
-
-            result = np.zeros_like(red, dtype=bool)
-            result[mask] = np.logical_and.reduce([condition2, condition3, condition4, condition5])
-            return result
-
-        def isred_bluecorrection(red, green, blue, mask):
-            green_factor = 1.1
-            red_blue_offset_ratio = 0.15
-            red_blue_max = np.maximum(red[mask], blue[mask])
-            condition2 = red[mask] > green[mask] * green_factor
-            condition3 = red[mask] > blue[mask] * green_factor
-            condition4 = 1 - (red[mask] / red_blue_max) <= red_blue_offset_ratio
-            condition5 = 1 - (blue[mask] / red_blue_max) <= red_blue_offset_ratio
-
-            result = np.zeros_like(red, dtype=bool)
-            result[mask] = np.logical_and.reduce([condition2, condition3, condition4, condition5])
-            return result
-
-        def isred(red, green, blue, mask):
-            factor1 = 1.3
-            factor2 = 1.15
-            mean_offset_ratio = 0.15
-
-            # Calculate mean and differences from mean
-            mean = np.mean(np.stack((green[mask], blue[mask]), axis=-1), axis=-1)
-            green_diff = np.abs(green[mask] - mean)
-            blue_diff = np.abs(blue[mask] - mean)
-
-            red_green_condition = np.logical_and(red[mask] > green[mask] * factor1,
-                                                 red[mask] > blue[mask] * factor1)
-            red_offset_condition = np.logical_and.reduce([green_diff < mean * mean_offset_ratio,
-                                                          blue_diff < mean * mean_offset_ratio,
-                                                          red[mask] > green[mask] * factor2,
-                                                          red[mask] > blue[mask] * factor2])
-
-            result = np.zeros_like(red, dtype=bool)
-            result[mask] = np.logical_or(red_green_condition, red_offset_condition)
-            return result
-
-        # Logical processing to determine if color is red
-        return np.logical_and(np.logical_not(isnotred_greencorrection(r, g, b, red_mask)),
-                              np.logical_or(isred(r, g, b, red_mask), isred_bluecorrection(r, g, b, red_mask)))
+    if classifier is None and not classifier_params:
+        classify = _redish
+    else:
+        classify = partial(apply_lut, compile_lut(classifier if classifier else redish,
+                                                  **(classifier_params if classifier_params else {})))
+    threshold = partial(_threshold_inplace, classify=classify, whitebackground=whitebackground)
 
     if isinstance(img, np.ndarray):
         channel_map = {'red': 0,
                        'green': 1,
                        'blue': 2}
-        out = np.array(img)
-        channel = out[..., channel_map[mainchannel]]
-        channel2 = out[..., channel_map[C2channel]]
-        channel3 = out[..., channel_map[C3channel]]
-
-        if whitebackground:
-            out[..., channel_map[mainchannel]] = np.where(redish(channel, channel2, channel3),
-                                                          np.uint8(255) - channel,
-                                                          np.uint8(0)).astype(np.uint8)
-            pass
+        if inplace:
+            out = img
+        elif out is not None:
+            if out.shape != img.shape:
+                raise ValueError('*out* must have the same shape as *img*!')
+            if out is not img and not _same_view(out, img):
+                if np.shares_memory(out, img):
+                    raise ValueError('*out* overlaps *img* without being the same array!')
+                out[...] = img
         else:
-            out[..., channel_map[mainchannel]] = np.where(redish(channel, channel2, channel3),
-                                                          channel,
-                                                          np.uint8(0)).astype(np.uint8)
-            pass
+            out = np.array(img)
+        threshold(out[..., channel_map[mainchannel]], out[..., channel_map[C2channel]], out[..., channel_map[C3channel]])
         return out
     elif isinstance(img, ImageTIFF):
-        if loop:
-            # Create iterable of all combinations of [0, 1,..., x-1] and [0, 1,..., y-1]
-            y, x = img.num_tiles
-            indices = itertools.product(range(x), range(y))
-
-            # Loop through each index
-            if whitebackground:
-                for index in indices:
-                    # Get initial channels data
-                    channel = img.getChannel(mainchannel)[index[0], index[1], ...]
-                    channel2 = img.getChannel(C2channel)[index[0], index[1], ...]
-                    channel3 = img.getChannel(C3channel)[index[0], index[1], ...]
-
-                    # Generate and assign the new red image/tiles data
-                    img.image[index[0], index[1], ..., img.colors[mainchannel]] = np.where(
-                        redish(channel, channel2, channel3),
-                        np.uint8(255) - channel,
-                        np.uint8(0)).astype(np.uint8)
-
-                    pass
-                pass
-            else:
-                for index in indices:
-                    # Get initial channels data
-                    channel = img.getChannel(mainchannel)[index[0], index[1], ...]
-                    channel2 = img.getChannel(C2channel)[index[0], index[1], ...]
-                    channel3 = img.getChannel(C3channel)[index[0], index[1], ...]
-
-                    # Generate and assign the new red image/tiles data
-                    img.image[index[0], index[1], ..., img.colors[mainchannel]] = np.where(
-                        redish(channel, channel2, channel3),
-                        channel,
-                        np.uint8(0)).astype(np.uint8)
-
-                    pass
+        if loop and img.tile and img.image_library == 'pil':
+            # Loop through each tile of the tile view; writing to a tile writes to the image
+            tiles = img.tiles
+            scratch = np.empty(tiles.shape[2:4], dtype=bool)
+            for index in np.ndindex(*img.num_tiles):
+                tile = tiles[index]
+                threshold(tile[..., img.colors[mainchannel]],
+                          tile[..., img.colors[C2channel]],
+                          tile[..., img.colors[C3channel]],
+                          scratch=scratch)
                 pass
         else:
-            # Get initial channels data
-            channel = img.getChannel(mainchannel)
-            channel2 = img.getChannel(C2channel)
-            channel3 = img.getChannel(C3channel)
-
-            # Generate the new red image/tiles data
-            # Use advanced indexing and slicing to assign the new tiles to the old tiles
-            if whitebackground:
-                img.image[..., img.colors[mainchannel]] = np.where(redish(channel, channel2, channel3),
-                                                                   np.uint8(255) - channel,
-                                                                   np.uint8(0)).astype(np.uint8)
-                pass
-            else:
-                img.image[..., img.colors[mainchannel]] = np.where(redish(channel, channel2, channel3),
-                                                                   channel,
-                                                                   np.uint8(0)).astype(np.uint8)
-                pass
+            # Threshold the whole image in place
+            image = img.image
+            threshold(image[..., img.colors[mainchannel]],
+                      image[..., img.colors[C2channel]],
+                      image[..., img.colors[C3channel]])
             pass
         pass
     else:
         raise TypeError(
             f'"img" of class {img.__class__} is not supported! Supported classes are *ImageTiff* and *numpy.ndarray*.')
     return img
+
+
+def redish(red: np.ndarray,
+           green: np.ndarray,
+           blue: np.ndarray,
+           cutoff: int = 85,
+           c1factor: float = 1,
+           c2factor: float = 1.15,
+           green_factor: float = 1.1,
+           red_blue_offset_ratio: float = 0.15,
+           factor1: float = 1.3,
+           factor2: float = 1.15,
+           mean_offset_ratio: float = 0.15) -> np.ndarray:
+    """
+    Decide for every pixel whether red is the dominant color. This is the reference per-pixel classifier; with the
+    default parameters *thresholdchannel* uses the equivalent *_redish*, and with other parameters it compiles this
+    function into a lookup table with *compile_lut*.
+    :param red: the red channel
+    :param green: the green channel
+    :param blue: the blue channel
+    :param cutoff: global color cutoff so that pixels are not too dark
+    :param c1factor: red must exceed green by this factor for the green correction
+    :param c2factor: green must exceed blue by this factor for the green correction
+    :param green_factor: red must exceed green and blue by this factor for the blue correction
+    :param red_blue_offset_ratio: red and blue must be within this ratio of their maximum for the blue correction
+    :param factor1: red must exceed green and blue by this factor to be red
+    :param factor2: red must exceed green and blue by this factor to be red if green and blue are close to their mean
+    :param mean_offset_ratio: green and blue must be within this ratio of their mean
+    :return: a boolean array of the shape of the channels
+    """
+    cutoff = np.uint(cutoff)
+
+    # Create cutoff mask for later faster processing
+    mask = red > cutoff
+    r, g, b = (red[mask], green[mask], blue[mask])
+
+    # Not red if green is also bright and dominant over blue
+    green_correction = np.logical_and.reduce([g > cutoff, b > cutoff, r > g * c1factor, g > b * c2factor])
+
+    # Red if red and blue are close but red dominates green
+    red_blue_max = np.maximum(r, b)
+    blue_correction = np.logical_and.reduce([r > g * green_factor,
+                                             r > b * green_factor,
+                                             1 - (r / red_blue_max) <= red_blue_offset_ratio,
+                                             1 - (b / red_blue_max) <= red_blue_offset_ratio])
+
+    # Red if red dominates both, or dominates slightly while green and blue are close to their mean
+    mean = np.mean(np.stack((g, b), axis=-1), axis=-1)
+    red_condition = np.logical_or(np.logical_and(r > g * factor1, r > b * factor1),
+                                  np.logical_and.reduce([np.abs(g - mean) < mean * mean_offset_ratio,
+                                                         np.abs(b - mean) < mean * mean_offset_ratio,
+                                                         r > g * factor2,
+                                                         r > b * factor2]))
+
+    result = np.zeros(np.shape(red), dtype=bool)
+    result[mask] = np.logical_and(np.logical_not(green_correction), np.logical_or(red_condition, blue_correction))
+    return result
+
+
+@lru_cache(maxsize=None)
+def _redish_tables() -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Build the lookup tables of the red classifier. Every condition of the classifier only depends on a pair of channels,
+    so each pair (red, green), (red, blue) and (green, blue) gets a 256x256 table of condition bits. The bits of a pixel
+    are the AND of its three table entries:
+        1: red > green and the green correction applies (green > cutoff, blue > cutoff, green > blue * 1.15)
+        2: red > green * 1.3 and red > blue * 1.3
+        4: red > green * 1.15, red > blue * 1.15 and green and blue are within 15% of their mean
+        8: the blue correction applies (red > green * 1.1, red > blue * 1.1, red and blue within 15% of their maximum)
+        16: red > cutoff
+    The conditions are evaluated with the same arithmetic as the per-pixel classifier, so the tables are exact.
+    :return: the flattened (red, green), (red, blue) and (green, blue) tables indexed by (first << 8) | second, and the
+    256-entry table mapping the bits to the classification
+    """
+    # Global color cutoff so that pixels are not too dark
+    cutoff = np.uint(85)
+    first, second = np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8), indexing='ij')
+
+    # (red, green) conditions
+    red, green = (first, second)
+    red_green = ((red > green * 1).astype(np.uint8) * 1 |
+                 (red > green * 1.3).astype(np.uint8) * 2 |
+                 (red > green * 1.15).astype(np.uint8) * 4 |
+                 (red > green * 1.1).astype(np.uint8) * 8 |
+                 (red > cutoff).astype(np.uint8) * 16)
+
+    # (red, blue) conditions
+    red, blue = (first, second)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        red_blue_max = np.maximum(red, blue)
+        blue_correction = np.logical_and.reduce([red > blue * 1.1,
+                                                 1 - (red / red_blue_max) <= 0.15,
+                                                 1 - (blue / red_blue_max) <= 0.15])
+    red_blue = (np.uint8(1) |
+                (red > blue * 1.3).astype(np.uint8) * 2 |
+                (red > blue * 1.15).astype(np.uint8) * 4 |
+                blue_correction.astype(np.uint8) * 8 |
+                np.uint8(16))
+
+    # (green, blue) conditions
+    green, blue = (first, second)
+    mean = np.mean(np.stack((green, blue), axis=-1), axis=-1)
+    green_correction = np.logical_and.reduce([green > cutoff, blue > cutoff, green > blue * 1.15])
+    mean_condition = np.logical_and(np.abs(green - mean) < mean * 0.15, np.abs(blue - mean) < mean * 0.15)
+    green_blue = (green_correction.astype(np.uint8) * 1 |
+                  np.uint8(2) |
+                  mean_condition.astype(np.uint8) * 4 |
+                  np.uint8(8) |
+                  np.uint8(16))
+
+    # Red if bright enough, not corrected by green, and red by any of the three classifiers
+    bits = np.arange(256)
+    classification = ((bits & 16) != 0) & ((bits & 1) == 0) & ((bits & 14) != 0)
+    return red_green.ravel(), red_blue.ravel(), green_blue.ravel(), classification
+
+
+def _redish(red: np.ndarray, green: np.ndarray, blue: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """
+    Decide for every pixel whether red is the dominant color. The pixels are classified in chunks with three table
+    lookups each, reusing the same scratch buffers, so every pixel is read once. The tables only cover 8-bit channels,
+    so other channels are classified with *redish*.
+    :param red: the red channel
+    :param green: the green channel
+    :param blue: the blue channel
+    :param out: a boolean array to write the classification into
+    :return: a boolean array of the shape of the channels
+    """
+    if not all(channel.dtype == np.uint8 for channel in (red, green, blue)):
+        mask = redish(red, green, blue)
+        if out is None:
+            return mask
+        out[...] = mask
+        return out
+    red_green, red_blue, green_blue, classification = _redish_tables()
+
+    def classify(r, g, b, result, i, t, u):
+        np.left_shift(r, 8, out=i, dtype=np.uint16)
+        np.bitwise_or(i, g, out=i)
+        np.take(red_green, i, out=t, mode='clip')
+        np.bitwise_and(i, 0xFF00, out=i)
+        np.bitwise_or(i, b, out=i)
+        np.take(red_blue, i, out=u, mode='clip')
+        np.bitwise_and(t, u, out=t)
+        np.left_shift(g, 8, out=i, dtype=np.uint16)
+        np.bitwise_or(i, b, out=i)
+        np.take(green_blue, i, out=u, mode='clip')
+        np.bitwise_and(t, u, out=t)
+        np.take(classification, t, out=result, mode='clip')
+        pass
+
+    return _classify_chunks(classify, red, green, blue, out, (np.uint16, np.uint8, np.uint8))
+
+
+def _same_view(a: np.ndarray, b: np.ndarray) -> bool:
+    # Two arrays viewing the same pixels in the same layout
+    return (a.__array_interface__['data'][0] == b.__array_interface__['data'][0] and a.strides == b.strides and
+            a.dtype == b.dtype)
+
+
+def _threshold_inplace(channel: np.ndarray,
+                       channel2: np.ndarray,
+                       channel3: np.ndarray,
+                       /,
+                       *,
+                       classify: Callable[..., np.ndarray],
+                       whitebackground: bool = True,
+                       scratch: np.ndarray | None = None):
+    """
+    Threshold *channel* in place one band of rows at a time: classified pixels are kept (inverted on a white
+    background) and all other pixels are cleared.
+    :param channel: the writable channel to threshold
+    :param channel2: the second channel
+    :param channel3: the third channel
+    :param classify: the classifier classify(channel, channel2, channel3, out=mask)
+    :param whitebackground: True if background colors are brighter than signal colors
+    :param scratch: a boolean array at least the size of a band, reused as the mask
+    :return:
+    """
+    if channel.ndim != 2:
+        channel, channel2, channel3 = [np.atleast_2d(c) for c in (channel, channel2, channel3)]
+    height, width = channel.shape
+    rows = max(1, 4 * _CHUNK_PIXELS // max(width, 1))
+    if scratch is None or scratch.size < min(rows, height) * width:
+        scratch = np.empty((min(rows, height), width), dtype=bool)
+    scratch = scratch.reshape(-1)[:min(rows, height) * width].reshape(-1, width)
+
+    for start in range(0, height, rows):
+        c, c2, c3 = [x[start:start + rows] for x in (channel, channel2, channel3)]
+        mask = scratch[:c.shape[0]]
+        classify(c, c2, c3, out=mask)
+        if whitebackground:
+            np.subtract(np.uint8(255), c, out=c, where=mask)
+        np.logical_not(mask, out=mask)
+        np.copyto(c, 0, where=mask)
+        pass
+    pass
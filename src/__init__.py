@@ -1,4 +1,7 @@
+from ._tilecache import *
 from ._imagetiff import *
+from ._histogram import *
+from ._lut import *
 from ._subtractmedian import *
 from ._processimage import *
 from ._decompress import *
@@ -4,20 +4,39 @@ import subprocess
 import os
 import zlib
 import mmap
-from os.path import exists, basename, join, dirname, splitext, isfile
+from os.path import basename, join, dirname, splitext, isfile
+from typing import Any, Callable
 
 import numpy as np
 import tifffile
 from PIL import Image
 from tqdm import tqdm
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+from ._tiles import map_tiles, read_region, resolution_kwargs, tile_bounds
+
 
 def decompress(input_file: str | os.PathLike,
                output_dir: str | os.PathLike | None = None,
                /,
                *,
-               chunk_size=int(2**22),
+               workers: int | None = None,
                use_tqdm=True) -> str:
+    """
+    Decompress a TIFF image into an uncompressed, contiguous BigTIFF that can be mapped with *map_contiguous*. The
+    tiles or strips of the image are decoded (LZW, Deflate, JPEG, ZSTD, etc.) on a thread pool and written straight to
+    their place in the pre-sized output file, so only the segments being decoded are held in memory.
+    :param input_file: the path to the TIFF image
+    :param output_dir: the directory of the decompressed image (default the directory of the image)
+    :param workers: the number of threads decoding the segments (default the number of CPUs)
+    :param use_tqdm: show the progress of the decoded segments
+    :return: the path of the decompressed image
+    """
     filename = basename(input_file)
     if not output_dir:
         output_dir = dirname(input_file)
@@ -26,42 +45,79 @@ def decompress(input_file: str | os.PathLike,
     filebase, ext = [splitext(filename)[0], '.tif']
     output_file = f"{join(output_dir, filebase)}_UNCOMPRESSED{ext}"
 
-    with open(input_file, 'rb') as f_in:
-        mm = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
-        shape = tifffile.TiffFile(f_in).pages[0].shape
-        if not exists(output_file):
-            with tifffile.TiffWriter(output_file, bigtiff=True) as file:
-                file.write(shape=shape, dtype=np.dtype(np.uint8))
-                pass
-            pass
-        with open(output_file, 'r+b') as f_out:
-            out = mmap.mmap(f_out.fileno(), 0, access=mmap.ACCESS_WRITE)
-            total = math.ceil((out.size() / (3*chunk_size)))
+    out = _decompress_file(input_file, output_file, workers=workers, use_tqdm=use_tqdm)
+    del out
+    return output_file
+
+
+def _decompress_file(input_file: str | os.PathLike,
+                     output_file: str | os.PathLike,
+                     /,
+                     *,
+                     workers: int | None = None,
+                     use_tqdm=False) -> np.memmap:
+    """
+    Decompress the first page of a TIFF image into an uncompressed, contiguous BigTIFF and return the memmap of its
+    pixels with shape (height, width) or (height, width, samples).
+    """
+    with tifffile.TiffFile(input_file) as tif:
+        page = tif.pages[0]
+        height, width, samples = (page.imagelength, page.imagewidth, page.samplesperpixel)
+        separate = samples > 1 and page.planarconfig == tifffile.PLANARCONFIG.SEPARATE
+
+        # Pre-size the output so every segment can be written at its offset
+        out = tifffile.memmap(output_file,
+                              shape=(height, width, samples) if samples > 1 else (height, width),
+                              dtype=page.dtype,
+                              photometric='rgb' if samples in (3, 4) else 'minisblack',
+                              bigtiff=True,
+                              **resolution_kwargs(page))
+        pixels = out if samples > 1 else out[..., np.newaxis]
+
+        with open(input_file, 'rb') as f_in, mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            def decode(index):
+                # Segments that were never written stay blank
+                offset, bytecount = (page.dataoffsets[index], page.databytecounts[index])
+                if not bytecount:
+                    return index
+                # Slicing the map reads the bytes of the segment without sharing a file position between threads
+                segment, (plane, _, y, x, _), _ = page.decode(mm[offset:offset + bytecount], index,
+                                                              jpegtables=page.jpegtables)
+                segment = segment[0]
+
+                # Crop the padding of the segments at the right and bottom edges of the image
+                rows, cols = (min(segment.shape[0], height - y), min(segment.shape[1], width - x))
+                target = slice(plane, plane + 1) if separate else slice(None)
+                pixels[y:y + rows, x:x + cols, target] = segment[:rows, :cols]
+                return index
+
+            segments = range(len(page.dataoffsets))
+            done = map_tiles(decode, segments, workers=workers if workers else os.cpu_count())
             if use_tqdm:
-                for data in tqdm(iter(lambda: mm.read(chunk_size), b''), total=total, unit='chunks'):
-                    out.write(data)
-                    out.flush()
-                    pass
-                out.close()
-                pass
-            else:
-                for data in iter(lambda: mm.read(chunk_size), b''):
-                    out.write(data)
-                    out.flush()
-                    pass
-                out.close()
+                done = tqdm(done, total=len(segments), unit='segment', desc=f'Decompressing {basename(input_file)}')
+            for _ in done:
                 pass
-        mm.close()
+            pass
         pass
-    return output_file
+    out.flush()
+    return out
 
 
 def copy(src_file_path: str | os.PathLike,
          dest_dir: str | os.PathLike | None = None,
          /,
          *,
-         chunk_size=1024,
+         chunk_size=int(2**24),
          use_tqdm=True) -> str:
+    """
+    Copy the bytes of a file at disk speed. The copy is cloned (reflink) where the filesystem supports it, otherwise the
+    bytes are copied in the kernel with *os.copy_file_range* or *os.sendfile*, and otherwise in large buffered chunks.
+    :param src_file_path: the path to the file
+    :param dest_dir: the directory of the copy; a file in the same directory is suffixed with '_COPY'
+    :param chunk_size: the number of bytes copied at once, which is also the step of the progress bar
+    :param use_tqdm: show the progress of the copied bytes
+    :return: the path of the copy
+    """
     filename = basename(src_file_path)
     if not dest_dir:
         dest_dir = dirname(src_file_path)
@@ -71,75 +127,194 @@ def copy(src_file_path: str | os.PathLike,
         filebase, ext = splitext(filename)
         filename = f'{filebase}_COPY{ext}'
     copy_file = join(dest_dir, filename)
+    size = os.path.getsize(src_file_path)
     with open(src_file_path, 'rb') as src_file, open(copy_file, 'wb') as dest_file:
         if use_tqdm:
-            with tqdm(total=os.path.getsize(src_file_path), unit='bytes') as pbar:
-                while True:
-                    chunk = src_file.read(chunk_size)
-                    if not chunk:
-                        break
-                    dest_file.write(chunk)
-                    pbar.update(len(chunk))
+            with tqdm(total=size, unit='bytes', unit_scale=True) as pbar:
+                _copy_bytes(src_file, dest_file, size, chunk_size, pbar.update)
+                pass
+            pass
         else:
-            while True:
-                chunk = src_file.read(chunk_size)  # read a chunk of bytes from source file
-                if not chunk:
-                    break  # end of file reached
-                dest_file.write(chunk)  # write chunk to destination file
+            _copy_bytes(src_file, dest_file, size, chunk_size)
+            pass
     return copy_file
 
 
+# The Linux ioctl cloning a whole file (FICLONE) on filesystems that support reflinks (Btrfs, XFS, etc.)
+_FICLONE = 0x40049409
+
+
+def _copy_bytes(src_file,
+                dest_file,
+                size: int,
+                chunk_size: int,
+                progress: Callable[[int], Any] = lambda n: None):
+    """
+    Copy *size* bytes from the start of *src_file* to *dest_file* with the fastest method available, reporting the
+    number of bytes copied at each step to *progress*. Each method falls back to the next one from where it stopped.
+    """
+    src_fd, dest_fd = (src_file.fileno(), dest_file.fileno())
+    copied = 0
+
+    # Clone the file, which shares the blocks of the source until either file is modified
+    if fcntl is not None and size:
+        try:
+            fcntl.ioctl(dest_fd, _FICLONE, src_fd)
+            progress(size)
+            return
+        except OSError:
+            pass
+
+    # Copy in the kernel, without moving the bytes through user space
+    for method in ('copy_file_range', 'sendfile'):
+        if copied >= size or not hasattr(os, method):
+            continue
+        try:
+            while copied < size:
+                count = min(chunk_size, size - copied)
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(src_fd, dest_fd, count, copied, copied)
+                else:
+                    os.lseek(dest_fd, copied, os.SEEK_SET)
+                    n = os.sendfile(dest_fd, src_fd, copied, count)
+                if not n:
+                    break
+                copied += n
+                progress(n)
+                pass
+        except OSError:
+            # e.g. unsupported between these filesystems, or sendfile to a file on macOS
+            pass
+        pass
+
+    # Copy the remaining bytes in large chunks through a single reused buffer
+    src_file.seek(copied)
+    dest_file.seek(copied)
+    buffer = memoryview(bytearray(min(chunk_size, max(size - copied, 1))))
+    while True:
+        n = src_file.readinto(buffer)
+        if not n:
+            break
+        dest_file.write(buffer[:n])
+        progress(n)
+        pass
+    pass
+
+
 def copy_image(src_image: str | os.PathLike,
                dest: str | os.PathLike | None = None,
                /,
                *,
                tile_size: int | None = 1024,
+               compression: str | None = 'zlib',
+               workers: int | None = None,
+               max_in_flight: int | None = None,
                use_tqdm=True) -> str:
+    """
+    Copy the pixels of a TIFF image into a tiled BigTIFF, re-tiling and re-encoding them, e.g. to re-tile vendor TIFFs
+    into a layout suited to the tiled engines. The tiles of the copy are read from the tiles or strips of the image on
+    a thread pool and handed to the writer in order through a bounded queue, so only *max_in_flight* tiles are held in
+    memory, and the writer compresses them on several threads. Every page of the image is copied in order with its
+    SubIFDs, so pyramid levels and associated images (e.g. the label and macro of SVS files) are kept, and each page
+    keeps its ImageDescription (which holds the MPP of SVS files), subfile type, resolution, Software and DateTime.
+    Other tags, such as private vendor tags, are not copied.
+    :param src_image: the path to the TIFF image
+    :param dest: the directory or the path of the copy; a copy in the same directory is suffixed with '_COPY'
+    :param tile_size: the size of the tiles of the copy, a multiple of 16; None keeps the tiles of each page
+    :param compression: the codec of the tiles of the copy (e.g. 'zlib', 'lzw', 'zstd', 'jpeg'), or None
+    :param workers: the number of threads reading and compressing the tiles (default the number of CPUs)
+    :param max_in_flight: the maximum number of tiles read ahead of the writer (default twice the number of workers)
+    :param use_tqdm: show the progress of the copied tiles
+    :return: the path of the copy
+    """
     filename = basename(src_image)
+    # A destination ending in a TIFF extension is the path of the copy
+    dest_is_file = bool(dest) and (isfile(dest) or splitext(dest)[1].lower() in ['.tif', '.tiff'])
     if not dest:
         dest = dirname(src_image)
-    else:
+    elif not dest_is_file:
         os.makedirs(dest, exist_ok=True)
     if dirname(src_image) == dest:
         filebase, ext = splitext(filename)
         filename = f'{filebase}_COPY{ext}'
-    if isfile(dest):
-        copy_file = dest
-    else:
-        copy_file = join(dest, filename)
-    shape = tifffile.TiffFile(src_image).pages[0].shape
-    with tifffile.TiffWriter(copy_file, bigtiff=True) as tiff:
-        tiff.write(shape=shape, dtype='bool')
-    src_memmap = np.memmap(src_image, dtype=np.dtype(np.uint8), mode='r', shape=shape)
-    out_memmap = np.memmap(copy_file, dtype=np.dtype(np.uint8), mode='r+', shape=shape)
-    if tile_size:
-        height, width = (shape[0], shape[1])
-        tiles_tall = np.arange(0, height, tile_size)
-        tiles_wide = np.arange(0, width, tile_size)
-        tqdm_iter = np.ndindex(len(tiles_tall), len(tiles_wide))
-        if use_tqdm:
-            total = len(tiles_tall) * len(tiles_wide)
-            for [y, x] in tqdm(tqdm_iter, total=total, unit='tile', desc='Copying image contents'):
-                start_height, start_width = (y * tile_size, x * tile_size)
-                end_height, end_width = (start_height + tile_size, start_width + tile_size)
-                tile = src_memmap[start_height:end_height, start_width:end_width, ...]
-                out_memmap[start_height:end_height, start_width:end_width, ...] = tile
-                pass
+    copy_file = dest if dest_is_file else join(dest, filename)
+    if not workers:
+        workers = os.cpu_count()
+    if isinstance(tile_size, (int, np.integer)):
+        tile_size = (int(tile_size), int(tile_size))
+    if tile_size and (tile_size[0] % 16 or tile_size[1] % 16):
+        raise ValueError('\'tile_size\' must be a multiple of 16!')
+
+    with tifffile.TiffFile(src_image) as tif:
+        # The pages in the order they are written, each followed by its SubIFDs
+        pages = []
+        for page in tif.pages:
+            pages.append((page, _page_tile_size(page, tile_size)))
+            pages.extend((subifd, _page_tile_size(subifd, tile_size)) for subifd in page.pages or [])
             pass
-        else:
-            for [y, x] in tqdm_iter:
-                start_height, start_width = (y * tile_size, x * tile_size)
-                end_height, end_width = (start_height + tile_size, start_width + tile_size)
-                tile = src_memmap[start_height:end_height, start_width:end_width, ...]
-                out_memmap[start_height:end_height, start_width:end_width, ...] = tile
-                out_memmap.flush()
+
+        # The tiles of the image are read on several threads
+        tif.filehandle.set_lock(True)
+        pbar = None
+        if use_tqdm:
+            pbar = tqdm(total=sum(math.ceil(page.imagelength / size[0]) * math.ceil(page.imagewidth / size[1])
+                                  for page, size in pages), unit='tile', desc='Copying image contents')
+        try:
+            with tifffile.TiffWriter(copy_file, bigtiff=True) as out_tif:
+                for page, page_tile_size in pages:
+                    _copy_page(page, page_tile_size, out_tif, compression, workers, max_in_flight, pbar)
+                    pass
                 pass
-            pass
-        pass
-    else:
-        out_memmap[...] = src_memmap[...]
+        finally:
+            if pbar is not None:
+                pbar.close()
         pass
-    out_memmap.flush()
-    del out_memmap
-    del src_memmap
     return copy_file
+
+
+def _page_tile_size(page: tifffile.TiffPage, tile_size: tuple[int, int] | None) -> tuple[int, int]:
+    # The tiles of the page are kept if no tile size is given
+    if tile_size:
+        return tile_size
+    return (page.tilelength, page.tilewidth) if page.is_tiled else (1024, 1024)
+
+
+def _copy_page(page: tifffile.TiffPage,
+               tile_size: tuple[int, int],
+               out_tif: tifffile.TiffWriter,
+               compression: str | None,
+               workers: int,
+               max_in_flight: int | None,
+               pbar: tqdm | None):
+    """
+    Write the tiles of a TIFF page as the next page of *out_tif*, with the description and metadata tags of the page.
+    """
+    height, width, samples = (page.imagelength, page.imagewidth, page.samplesperpixel)
+
+    def read(bounds):
+        return read_region(page, *bounds[2:])
+
+    def written():
+        for _, tile in map_tiles(read, tile_bounds(height, width, tile_size), workers=workers,
+                                 max_in_flight=max_in_flight, ordered=True):
+            if pbar is not None:
+                pbar.update(1)
+            yield tile
+        pass
+
+    metadata = {name: page.tags[tag].value
+                for name, tag in [('software', 'Software'), ('datetime', 'DateTime')] if tag in page.tags}
+    out_tif.write(written(),
+                  shape=(height, width, samples) if samples > 1 else (height, width),
+                  dtype=page.dtype,
+                  tile=tile_size,
+                  photometric='rgb' if samples in (3, 4) else 'minisblack',
+                  compression=compression,
+                  maxworkers=workers,
+                  subifds=len(page.subifds) if page.subifds else None,
+                  subfiletype=page.subfiletype,
+                  description=page.description if page.description else None,
+                  metadata=None,
+                  **metadata,
+                  **resolution_kwargs(page))
+    pass
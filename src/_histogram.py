@@ -0,0 +1,138 @@
+import os
+from concurrent.futures import Executor
+from typing import Sequence
+
+import numpy as np
+import tifffile
+
+from ._imagetiff import ImageTIFF
+from ._tiles import tile_bounds, map_tiles, open_tiles
+
+
+class HistogramAccumulator:
+    def __init__(self, channels: Sequence[int], joint: tuple[int, int] | None = None):
+        """
+        Accumulate the 256-bin histograms of several channels, and optionally the 256x256 joint histogram of a pair of
+        channels, one tile at a time.
+        :param channels: the channel numbers to build 1-D histograms of
+        :param joint: a pair of channel numbers (channel1, channel2) to build the joint histogram of
+        :return:
+        """
+        self.channels = list(channels)
+        self.joint_channels = joint
+        self._histograms = np.zeros((len(self.channels), 256), dtype=np.int64)
+        self._joint = np.zeros((256, 256), dtype=np.int64) if joint else None
+        pass
+
+    @property
+    def histograms(self) -> np.ndarray:
+        # array of shape (len(channels), 256)
+        return self._histograms
+
+    @property
+    def joint(self) -> np.ndarray | None:
+        # array of shape (256, 256) indexed by [channel1 value, channel2 value]
+        return self._joint
+
+    @property
+    def pixels(self) -> int:
+        return int(self._histograms[0].sum()) if self.channels else 0
+
+    def update(self, tile: np.ndarray):
+        """
+        Add the pixels of a tile of shape (rows, columns, samples) to the histograms.
+        """
+        histograms, joint = self.count(tile)
+        self.add(histograms, joint)
+        pass
+
+    def count(self, tile: np.ndarray) -> tuple[np.ndarray, np.ndarray | None]:
+        """
+        Count the pixels of a tile without adding them, so tiles can be counted on several threads.
+        :param tile: an 8-bit array of shape (rows, columns, samples), or (rows, columns) for single-channel images
+        :return: the histograms and joint histogram of the tile
+        """
+        histograms = np.empty_like(self._histograms)
+        for i, channel in enumerate(self.channels):
+            histograms[i] = np.bincount(_values(tile, channel), minlength=256)
+            pass
+        joint = None
+        if self.joint_channels:
+            channel1, channel2 = self.joint_channels
+            index = _values(tile, channel1).astype(np.uint16) << 8
+            index |= _values(tile, channel2)
+            joint = np.bincount(index, minlength=65536).reshape(256, 256)
+        return histograms, joint
+
+    def add(self, histograms: np.ndarray, joint: np.ndarray | None = None):
+        self._histograms += histograms
+        if joint is not None:
+            self._joint += joint
+        pass
+
+    pass
+
+
+def _values(tile: np.ndarray, channel: int) -> np.ndarray:
+    # the 8-bit values of a channel of a tile as a flat array
+    if tile.dtype != np.uint8:
+        raise TypeError(f'Histograms can only be built from 8-bit images, not {tile.dtype}!')
+    if tile.ndim == 2:
+        # single-channel images are read as 2-D tiles
+        if channel != 0:
+            raise IndexError(f'Channel {channel} does not exist in a single-channel image!')
+        return tile.ravel()
+    return tile[..., channel].ravel()
+
+
+def _channel_number(channel: int | str, colors: dict) -> int:
+    if isinstance(channel, str):
+        try:
+            return colors[channel]
+        except KeyError:
+            raise IndexError('Invalid channel color name!')
+    elif isinstance(channel, (int, np.integer)):
+        return int(channel)
+    else:
+        raise TypeError('\'channel\' must be an integer or string!')
+
+
+def channel_histograms(image: os.PathLike | str | tifffile.TiffFile | np.ndarray | ImageTIFF,
+                       channels: Sequence[int | str],
+                       /,
+                       *,
+                       joint: tuple[int | str, int | str] | None = None,
+                       tile_size: tuple[int, int] | int = (1024, 1024),
+                       workers: int | None = None,
+                       executor: Executor | None = None) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    Build the 256-bin histograms of several channels and the joint histogram of a pair of channels in a single pass
+    over the image. Tiles are read from the TIFF (or sliced from the array or memmap) one at a time, so only one tile
+    per worker is ever held in memory.
+    :param image: a path to a TIFF image, an open TiffFile, an array or memmap of shape (height, width, samples), or
+    an ImageTIFF
+    :param channels: the channel numbers or colors to build 1-D histograms of
+    :param joint: a pair of channel numbers or colors (channel1, channel2) to build the joint histogram of
+    :param tile_size: the size of the tiles
+    :param workers: the number of threads to count the tiles on
+    :param executor: a shared executor to count the tiles on in place of *workers*
+    :return: the histograms as an array of shape (len(channels), 256) and the joint histogram as an array of shape
+    (256, 256) indexed by [channel1 value, channel2 value], or None
+    """
+    colors = image.colors if isinstance(image, ImageTIFF) else {'red': 0, 'green': 1, 'blue': 2}
+    accumulator = HistogramAccumulator([_channel_number(c, colors) for c in channels],
+                                       joint=tuple(_channel_number(c, colors) for c in joint) if joint else None)
+
+    if isinstance(image, ImageTIFF):
+        image = image.lazyArray()
+
+    with open_tiles(image) as (read, shape):
+        def count(tile):
+            return accumulator.count(read(*tile[2:]))
+
+        for _, (histograms, joint_histogram) in map_tiles(count, tile_bounds(*shape, tile_size),
+                                                          workers=workers, executor=executor):
+            accumulator.add(histograms, joint_histogram)
+            pass
+        pass
+    return accumulator.histograms, accumulator.joint
@@ -1,3 +1,5 @@
+import os
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from functools import partial
@@ -5,76 +7,70 @@ from os.path import join
 from typing import Callable
 
 import cv2 as cv
+import dask
 import dask.array as da
-import dask_image.imread
-
 import numpy as np
+import tifffile
 from PIL import Image
-from osgeo import gdal
+from osgeo import gdal, gdal_array
+
+from ._tiles import TiffArray, resolution_kwargs, _index_window
 
 Image.MAX_IMAGE_PIXELS = None
 
 
 class ImageTIFF:
     def __init__(self, path: str, isbgr=True, tilesize: int = 0, image_library: str = 'Dask'):
+        """
+        A lazy handle on a TIFF image. Only the header is read when the handle is created; the pixels are read from the
+        TIFF on demand (see *getChannel*, *getTile* and *lazyArray*) or loaded in full the first time *image* is used.
+        :param path: the path to the image
+        :param isbgr: whether the samples of the image are in BGR order
+        :param tilesize: the size of the tiles, or 0 to not tile the image
+        :param image_library: 'Dask', 'PIL' or 'GDAL' for tiled images
+        :return:
+        """
         self.path = path
         self.isRGB = isbgr
+        # The lazy array the image is read from, if any
+        self.source = None
+        self._image = None
+        self._maxvalue = None
+        self.tilesize = tilesize
         self.tile = (tilesize != 0)
         if tilesize < 0:
             raise ValueError('\'tilesize\' must be an non-negative whole number!')
-        if not self.tile:
-            with Image.open(path) as img:
-                self.image = np.array(img, dtype=np.uint8)
-                pass
+        # Define image library type
+        self.image_library = image_library.lower() if self.tile else None
+
+        if not self.tile or self.image_library == 'pil':
+            try:
+                self.source = TiffArray(path)
+            except tifffile.TiffFileError:
+                # Images that are not TIFFs are loaded with PIL when they are first used
+                self.source = None
+            if self.tile:
+                # Calculate the number of tiles in each dimension, including the partial tiles at the edges
+                height, width = self._size()
+                self.num_tiles = (-(-height // tilesize), -(-width // tilesize))
+            self._tiles = None
+            pass
+        elif self.image_library == 'dask':
+            # Each block is read from the TIFF on demand when the graph is computed
+            self.source = TiffArray(path)
+            chunks = (tilesize, tilesize, -1)[:self.source.ndim]
+            self._image = da.from_array(self.source, chunks=chunks, asarray=True)
+            pass
+        elif self.image_library == 'gdal':
+            # Open the image using GDAL and read windows aligned to its blocks on demand
+            self.source = _GDALArray(path)
+            block_height, block_width = self.source.blocksize
+            chunks = (-(-tilesize // block_height) * block_height, -(-tilesize // block_width) * block_width, -1)
+            self._image = da.from_array(self.source, chunks=chunks[:self.source.ndim], asarray=True)
             pass
         else:
-            # Define image library type
-            self.image_library = image_library.lower()
+            raise ValueError('Not a valid image library name')
 
-            if image_library.lower() == 'dask':
-                chunks = (tilesize, tilesize, -1)
-                self.image = da.from_array(dask_image.imread.imread(path), chunks=chunks)
-                pass
-            elif image_library.lower() == 'pil':
-                with Image.open(path) as img:
-                    # Define the tile size
-                    tile_size = (tilesize, tilesize)
-
-                    # Get the size of the input image
-                    img_size = img.size
-
-                    # Calculate the number of tiles in each dimension
-                    self.num_tiles = (img_size[0] // tile_size[0], img_size[1] // tile_size[1])
-
-                    # Split the image into tiles using numpy
-                    # input_array = np.array(img, dtype=np.uint8)
-                    # self.image = np.array([np.array(
-                    #     [input_array[j * tile_size[1]:(j + 1) * tile_size[1], i * tile_size[0]:(i + 1) * tile_size[0], :]
-                    #      for i in range(self.num_tiles[0])], dtype=np.uint8) for j in range(self.num_tiles[1])])
-                    self.image = np.asarray(
-                        [np.asarray(
-                            [np.asarray(
-                                img.crop(
-                                    (j * tile_size[1],
-                                     i * tile_size[0],
-                                     (j + 1) * tile_size[1],
-                                     (i + 1) * tile_size[0])))
-                                for i in range(self.num_tiles[0])
-                            ], dtype=np.uint8)
-                            for j in range(self.num_tiles[1])
-                        ])
-                pass
-            elif image_library.lower() == 'gdal':
-                # Open the image using GDAL
-                with gdal.Open('large_image.tif') as ds:
-                    pass
-                # Close the dataset
-                ds = None
-                pass
-            else:
-                raise ValueError('Not a valid image library name')
-
-        self.maxvalue = np.amax(self.image)
         if isbgr:
             self.colors = {'red': 2,
                            'green': 1,
@@ -85,6 +81,143 @@ class ImageTIFF:
                            'blue': 2}
         pass
 
+    @property
+    def image(self):
+        # The pixels are only loaded the first time they are used
+        if self._image is None:
+            self._image = self._load()
+        return self._image
+
+    @image.setter
+    def image(self, value):
+        self._image = value
+        pass
+
+    @property
+    def maxvalue(self) -> int:
+        # The maximum value is only computed the first time it is used
+        if self._maxvalue is None:
+            self._maxvalue = self._max()
+        return self._maxvalue
+
+    @maxvalue.setter
+    def maxvalue(self, value: int):
+        self._maxvalue = value
+        pass
+
+    def isLoaded(self) -> bool:
+        return self._image is not None
+
+    def close(self):
+        """
+        Close the file the pixels are read from. It is reopened if more pixels are read.
+        """
+        if self.source is not None:
+            self.source.close()
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        pass
+
+    def lazyArray(self):
+        """
+        The image as an array that can be sliced without loading the whole image: the loaded or Dask image if there is
+        one, otherwise an array reading the requested region from the TIFF.
+        """
+        if self._image is None and self.source is not None:
+            return self.source
+        return self.image
+
+    def _size(self) -> tuple[int, int]:
+        # (height, width) of the image from the header
+        if self.source is not None:
+            return self.source.shape[:2]
+        with Image.open(self.path) as img:
+            return img.size[1], img.size[0]
+
+    def _load(self) -> np.ndarray:
+        if not self.tile:
+            if self.source is not None:
+                return np.asarray(self.source[...], dtype=np.uint8)
+            with Image.open(self.path) as img:
+                return np.array(img, dtype=np.uint8)
+        # Load the image into a single buffer padded to a whole number of tiles, so every tile (including the tiles at
+        # the edges) is a view of the buffer
+        height, width = self._size()
+        tiles_tall, tiles_wide = self.num_tiles
+        samples = self.source.shape[2:] if self.source is not None else ()
+        if self.source is None:
+            with Image.open(self.path) as img:
+                data = np.asarray(img, dtype=np.uint8)
+                samples = data.shape[2:]
+            pass
+        buffer = np.zeros((tiles_tall * self.tilesize, tiles_wide * self.tilesize) + samples, dtype=np.uint8)
+        if self.source is None:
+            buffer[:height, :width] = data
+            del data
+        else:
+            # Read the TIFF one row of tiles at a time
+            for start_height in range(0, height, self.tilesize):
+                end_height = min(start_height + self.tilesize, height)
+                buffer[start_height:end_height, :width] = self.source[start_height:end_height]
+                pass
+            pass
+
+        # View the buffer as an array of shape (tiles_tall, tiles_wide, tilesize, tilesize, samples)
+        row_stride, column_stride = buffer.strides[:2]
+        self._tiles = np.lib.stride_tricks.as_strided(
+            buffer,
+            shape=(tiles_tall, tiles_wide, self.tilesize, self.tilesize) + samples,
+            strides=(self.tilesize * row_stride, self.tilesize * column_stride) + buffer.strides,
+            writeable=True)
+        return buffer[:height, :width]
+
+    @property
+    def tiles(self) -> np.ndarray:
+        """
+        A view of the image as an array of shape (tiles_tall, tiles_wide, tilesize, tilesize, samples). Writing to a tile
+        writes to the image. The tiles at the bottom and right edges are padded past the edges of the image.
+        """
+        if not self.tile or self.image_library != 'pil':
+            raise ValueError('Tiles are only viewed for images tiled with \'PIL\'!')
+        if self._tiles is None:
+            self._image = self._load()
+        return self._tiles
+
+    def _max(self) -> int:
+        if self._image is not None or self.source is None:
+            if isinstance(self.image, da.Array):
+                return int(self.image.max().compute())
+            return int(np.amax(self.image))
+        # Use the MaxSampleValue tag only if it was written explicitly
+        with tifffile.TiffFile(self.path) as tif:
+            tags = tif.pages[0].tags
+            if 'MaxSampleValue' in tags:
+                return int(np.max(tags['MaxSampleValue'].value))
+            pass
+        # Otherwise stream the image one band of rows at a time
+        height = self.source.shape[0]
+        band_height = max(1, 2 ** 24 // max(int(np.prod(self.source.shape[1:])), 1))
+        return int(max(np.amax(self.source[start:start + band_height]) for start in range(0, height, band_height)))
+
+    def getTile(self, y: int, x: int, channel: int | str | None = None) -> np.ndarray:
+        """
+        Read a single tile, including the partial tiles at the edges of the image.
+        :param y: the row of the tile
+        :param x: the column of the tile
+        :param channel: the channel number or color, or None for all channels
+        :return: the tile
+        """
+        tilesize = self.tilesize if self.tilesize else max(self._size())
+        rows = slice(y * tilesize, (y + 1) * tilesize)
+        cols = slice(x * tilesize, (x + 1) * tilesize)
+        key = (rows, cols) if channel is None else (rows, cols, self._channelNumber(channel))
+        return np.asarray(self.lazyArray()[key])
+
     def copyArray(self):
         return deepcopy(self.image)
 
@@ -92,9 +225,13 @@ class ImageTIFF:
         return self.image
 
     def getChannel(self, channel: int | str):
-        # The number of dimensions of the tiles (excluding the channel dimension)
-        n = self.image.ndim - 1
+        channelnumber = self._channelNumber(channel)
+        if self._image is None and self.source is not None and not self.tile:
+            # Read only the channel from the TIFF
+            return self.source[..., channelnumber]
+        return self.image[..., channelnumber]
 
+    def _channelNumber(self, channel: int | str) -> int:
         # Get channel number based on type of channel
         if isinstance(channel, int):
             try:
@@ -110,12 +247,12 @@ class ImageTIFF:
             pass
         else:
             raise TypeError('\'channel\' must be an integer or string!')
-        pass
-
-        return self.image[..., channelnumber]
+        return channelnumber
 
     # returns the shape in the order (x, y, z)
     def shape(self):
+        if self._image is None and not self.tile and self.source is not None:
+            return self.source.shape
         return np.shape(self.image)
 
     def imshow(self, color=''):
@@ -128,11 +265,11 @@ class ImageTIFF:
         pass
 
     def collapse(self, channel: str | int = 'all'):
-        # Get channel number based on type of channel
+        # The tiles are views of the image, so the image is returned without copying
         if channel == 'all':
-            final_array = np.concatenate(np.concatenate(self.image, axis=1), axis=1, dtype=np.uint8)
+            final_array = self.image
         elif isinstance(channel, (int, str)):
-            final_array = np.concatenate(np.concatenate(self.getChannel(channel), axis=1), axis=1, dtype=np.uint8)
+            final_array = self.getChannel(channel)
             pass
         else:
             raise TypeError('\'channel\' must be a valid integer or string!')
@@ -150,7 +287,21 @@ class ImageTIFF:
         else:
             if isinstance(channel, (int, str)):
                 final_array = self.collapse(channel=channel)
-                Image.fromarray(final_array).save(join(dirpath, name) + ext)
+                # Write the image one tile at a time from the view, never copying the whole image
+                tile_size = -(-self.tilesize // 16) * 16
+                height, width = final_array.shape[:2]
+                tiles = (final_array[start_height:start_height + tile_size, start_width:start_width + tile_size]
+                         for start_height in range(0, height, tile_size)
+                         for start_width in range(0, width, tile_size))
+                samples = final_array.shape[2] if final_array.ndim == 3 else 1
+                tifffile.imwrite(join(dirpath, name) + ext, tiles,
+                                 shape=final_array.shape,
+                                 dtype=final_array.dtype,
+                                 tile=(tile_size, tile_size),
+                                 photometric='rgb' if samples in (3, 4) else 'minisblack',
+                                 bigtiff=True,
+                                 compression='zlib',
+                                 **self._resolution())
             else:
                 raise TypeError('\'channel\' must be a valid integer or string!')
         pass
@@ -164,15 +315,229 @@ class ImageTIFF:
         self.save(dirpath, name, 'all', ext=ext)
         pass
 
-    def map_blocks(self, func: Callable, **kwargs):
-        self.image = da.map_blocks(partial(func, **kwargs), self.image)
+    def map_blocks(self, func: Callable, depth: int = 0, boundary: str = 'none', **kwargs):
+        """
+        Lazily apply *func* to every block of the Dask image.
+        :param func: the function applied to each block
+        :param depth: the number of neighboring pixels each block is extended by (e.g. for neighborhood filters); the
+        overlap is trimmed from the results
+        :param boundary: how blocks at the edges of the image are extended, as in *dask.array.map_overlap*
+        :param kwargs: the kwargs passed to *func*
+        :return:
+        """
+        if depth:
+            # Only overlap the rows and columns, never the channels
+            depths = {axis: depth if axis < 2 else 0 for axis in range(self.image.ndim)}
+            self.image = da.map_overlap(partial(func, **kwargs), self.image, depth=depths, boundary=boundary,
+                                        dtype=self.image.dtype)
+        else:
+            self.image = da.map_blocks(partial(func, **kwargs), self.image, dtype=self.image.dtype)
         pass
 
-    def saveDask(self, dirpath: str, name: str, ext='.tif'):
+    def saveDask(self,
+                 dirpath: str,
+                 name: str,
+                 ext='.tif',
+                 scheduler: str = 'threads',
+                 num_workers: int | None = None,
+                 max_in_flight: int | None = None,
+                 compression: str | None = 'zlib'):
+        """
+        Compute the Dask image block by block and stream the blocks into a tiled BigTIFF. Blocks are computed in groups of
+        at most *max_in_flight* blocks, so only those blocks are ever held in memory.
+        :param dirpath: the output directory
+        :param name: the output file name
+        :param ext: the extension appended to *name*
+        :param scheduler: the Dask scheduler, 'threads' or 'processes'
+        :param num_workers: the number of threads or processes of the scheduler
+        :param max_in_flight: the maximum number of blocks computed at once (default twice the number of workers)
+        :param compression: the compression of the output tiles
+        :return:
+        """
+        if not isinstance(self.image, da.Array):
+            raise TypeError('The image must be a Dask array to be saved with *saveDask*!')
+        image, (tile_height, tile_width) = _tile_chunks(self.image)
+        tiles = (block for _, block in _computed_blocks(image, scheduler, num_workers, max_in_flight))
 
+        samples = image.shape[2] if image.ndim == 3 else 1
+        with tifffile.TiffWriter(join(dirpath, name) + ext, bigtiff=True) as tif:
+            tif.write(tiles,
+                      shape=image.shape,
+                      dtype=image.dtype,
+                      tile=(tile_height, tile_width),
+                      photometric='rgb' if samples in (3, 4) else 'minisblack',
+                      compression=compression,
+                      **self._resolution())
+            pass
+        # Every block has been read from the source
+        self.close()
         pass
 
+    def saveGDAL(self,
+                 dirpath: str,
+                 name: str,
+                 ext='.tif',
+                 scheduler: str = 'threads',
+                 num_workers: int | None = None,
+                 max_in_flight: int | None = None,
+                 creation_options: list[str] | None = None):
+        """
+        Compute the image block by block and write the blocks as windows of a tiled, compressed GeoTIFF created by GDAL.
+        :param dirpath: the output directory
+        :param name: the output file name
+        :param ext: the extension appended to *name*
+        :param scheduler: the Dask scheduler, 'threads' or 'processes'
+        :param num_workers: the number of threads or processes of the scheduler
+        :param max_in_flight: the maximum number of blocks computed at once (default twice the number of workers)
+        :param creation_options: the GTiff creation options (default tiled, DEFLATE-compressed BigTIFF with tiles of the
+        size of the blocks)
+        :return:
+        """
+        image = self.image if isinstance(self.image, da.Array) else da.from_array(self.image)
+        image, (tile_height, tile_width) = _tile_chunks(image)
+        if creation_options is None:
+            creation_options = ['TILED=YES', f'BLOCKXSIZE={tile_width}', f'BLOCKYSIZE={tile_height}',
+                                'COMPRESS=DEFLATE', 'BIGTIFF=YES', 'NUM_THREADS=ALL_CPUS']
+        samples = image.shape[2] if image.ndim == 3 else 1
+        if samples in (3, 4):
+            creation_options = creation_options + ['PHOTOMETRIC=RGB']
+
+        # Create the output dataset with the same size, bands and resolution as the image
+        driver = gdal.GetDriverByName('GTiff')
+        ds = driver.Create(join(dirpath, name) + ext, image.shape[1], image.shape[0], samples,
+                           gdal_array.NumericTypeCodeToGDALTypeCode(image.dtype), options=creation_options)
+        if isinstance(self.source, _GDALArray):
+            ds.SetMetadata(self.source.metadata)
+        try:
+            for index, block in _computed_blocks(image, scheduler, num_workers, max_in_flight):
+                yoff, xoff = (sum(image.chunks[0][:index[0]]), sum(image.chunks[1][:index[1]]))
+                block = block.reshape(block.shape[:2] + (samples,))
+                for band in range(samples):
+                    ds.GetRasterBand(band + 1).WriteArray(block[..., band], xoff, yoff)
+                    pass
+                pass
+            ds.FlushCache()
+        finally:
+            # Close the dataset
+            ds = None
+        pass
+
+    def _resolution(self) -> dict:
+        # The resolution of the source image, so that saved images keep their physical pixel size
+        try:
+            with tifffile.TiffFile(self.path) as tif:
+                return resolution_kwargs(tif.pages[0])
+        except (OSError, tifffile.TiffFileError):
+            return {}
+
     def asarray(self):
         return np.asarray(self.image)
 
     pass
+
+
+def _tile_chunks(image: da.Array) -> tuple[da.Array, tuple[int, int]]:
+    """
+    Rechunk a Dask array so that its blocks can be written as TIFF tiles, whose sizes must be multiples of 16.
+    :param image: the Dask array
+    :return: the array, rechunked only if its blocks are not already tiles, and the (height, width) of the tiles
+    """
+    tile_height, tile_width = (-(-image.chunksize[0] // 16) * 16, -(-image.chunksize[1] // 16) * 16)
+    if image.chunks[0][:-1] != (tile_height,) * (image.numblocks[0] - 1) or \
+            image.chunks[1][:-1] != (tile_width,) * (image.numblocks[1] - 1):
+        image = image.rechunk((tile_height, tile_width) + (-1,) * (image.ndim - 2))
+    return image, (tile_height, tile_width)
+
+
+def _computed_blocks(image: da.Array,
+                     scheduler: str = 'threads',
+                     num_workers: int | None = None,
+                     max_in_flight: int | None = None):
+    """
+    Compute the blocks of a Dask array in the row-major order of its rows and columns of blocks. Blocks are computed in
+    groups of at most *max_in_flight* blocks, so only those blocks are ever held in memory.
+    :param image: the Dask array, chunked only along its rows and columns
+    :param scheduler: the Dask scheduler, 'threads' or 'processes'
+    :param num_workers: the number of threads or processes of the scheduler
+    :param max_in_flight: the maximum number of blocks computed at once (default twice the number of workers)
+    :return: an iterator of ((row, column), block)
+    """
+    if not max_in_flight:
+        max_in_flight = 2 * (num_workers if num_workers else os.cpu_count() or 1)
+    indices = list(np.ndindex(*image.numblocks[:2]))
+    for i in range(0, len(indices), max_in_flight):
+        group = indices[i:i + max_in_flight]
+        blocks = dask.compute(*[image.blocks[index] for index in group], scheduler=scheduler, num_workers=num_workers)
+        yield from zip(group, blocks)
+        pass
+    pass
+
+
+class _GDALArray:
+    def __init__(self, path: str, num_threads: int | str = 'ALL_CPUS'):
+        """
+        A lazy array over a raster opened with GDAL. Indexing reads a window of the raster with *ReadAsArray*, so GDAL's
+        block cache and multithreaded decompression are used. The dataset is reopened in each process, so the array can
+        be pickled.
+        :param path: the path to the image
+        :param num_threads: the number of threads GDAL decompresses the blocks of this dataset on, passed as its
+        NUM_THREADS open option rather than the process-wide GDAL_NUM_THREADS
+        :return:
+        """
+        self.path = path
+        self.num_threads = num_threads
+        self._ds = None
+        self._lock = threading.Lock()
+        ds = self._dataset()
+        band = ds.GetRasterBand(1)
+        block_width, block_height = band.GetBlockSize()
+        self.blocksize = (block_height, block_width)
+        self.shape = (ds.RasterYSize, ds.RasterXSize, ds.RasterCount) if ds.RasterCount > 1 else (ds.RasterYSize,
+                                                                                                   ds.RasterXSize)
+        self.dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+        self.metadata = ds.GetMetadata()
+        pass
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def _dataset(self):
+        if self._ds is None:
+            self._ds = gdal.OpenEx(self.path, gdal.OF_RASTER | gdal.OF_READONLY,
+                                   open_options=[f'NUM_THREADS={self.num_threads}'])
+            if self._ds is None:
+                raise OSError(f'GDAL could not open \'{self.path}\'!')
+        return self._ds
+
+    def __getitem__(self, key) -> np.ndarray:
+        bounds, rest = _index_window(key, self.shape, 'a GDAL raster', negative_steps=False)
+        yoff, yend, xoff, xend = bounds
+        if yend == yoff or xend == xoff:
+            # GDAL cannot read an empty window
+            return np.empty((yend - yoff, xend - xoff) + self.shape[2:], dtype=self.dtype)[rest]
+
+        # GDAL datasets must not be read from several threads at once; decompression is threaded by GDAL itself
+        with self._lock:
+            window = self._dataset().ReadAsArray(xoff, yoff, xend - xoff, yend - yoff)
+        if window.ndim == 3:
+            window = np.moveaxis(window, 0, -1)
+        return window[rest]
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_ds'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        pass
+
+    def close(self):
+        with self._lock:
+            self._ds = None
+        pass
+
+    pass
@@ -0,0 +1,167 @@
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+from types import CodeType
+from typing import Callable
+
+import numpy as np
+
+# The number of pixels classified at once, so that the scratch buffers stay in cache
+_CHUNK_PIXELS = int(2 ** 18)
+
+# The directory the compiled tables are cached in
+lut_cache_dir = os.environ.get('IMAGEPROCESSING_LUT_CACHE',
+                               os.path.join(os.path.expanduser('~'), '.cache', 'ImageProcessing', 'lut'))
+
+
+def compile_lut(predicate: Callable[..., np.ndarray],
+                /,
+                *,
+                cache_dir: str | os.PathLike | None = None,
+                version: str | int | None = None,
+                **params) -> np.ndarray:
+    """
+    Compile a per-pixel RGB predicate into a lookup table over every 8-bit RGB color. The table holds one bit per color
+    (2^24 bits, 2 MiB) and is cached in memory and on disk, keyed by the predicate and its parameters, so each
+    classifier is only evaluated once. The key covers the code, defaults and closure of the predicate itself but not
+    the functions it calls, so change *version* (or clear the cache) when a helper of the predicate changes.
+    :param predicate: a vectorized function predicate(red, green, blue, **params) of uint8 arrays returning a boolean
+    array
+    :param cache_dir: the directory the table is cached in (default *lut_cache_dir*); '' disables the disk cache
+    :param version: a salt added to the key of the table
+    :param params: the parameters of the predicate (e.g. cutoff=85, c2factor=1.15)
+    :return: the packed table, a uint8 array of 2^21 bytes indexed by ((red << 16) | (green << 8) | blue) >> 3
+    """
+    args = (predicate, lut_cache_dir if cache_dir is None else str(cache_dir), version, tuple(sorted(params.items())))
+    try:
+        hash(args)
+    except TypeError:
+        # Unhashable parameters (e.g. lists) cannot key the memory cache, but can still key the disk cache
+        return _compile_lut.__wrapped__(*args)
+    return _compile_lut(*args)
+
+
+@lru_cache(maxsize=32)
+def _compile_lut(predicate: Callable[..., np.ndarray], cache_dir: str, version: str | int | None,
+                 params: tuple) -> np.ndarray:
+    # Key the table by the code, defaults and closure of the predicate and the values of its parameters, so lambdas,
+    # closures and edited predicates never share a table
+    key = _predicate_key(predicate)
+    path = None
+    if cache_dir and key is not None:
+        digest = hashlib.sha1(repr((key, version, params)).encode('utf-8')).hexdigest()
+        path = os.path.join(cache_dir, f'{predicate.__name__}-{digest}.npy')
+    if path and os.path.exists(path):
+        lut = np.load(path)
+        if lut.shape == (2 ** 21,) and lut.dtype == np.uint8:
+            lut.flags.writeable = False
+            return lut
+
+    # Evaluate the predicate on 16 values of red at a time
+    green, blue = [c.ravel() for c in np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8),
+                                                  indexing='ij')]
+    green, blue = (np.tile(green, 16), np.tile(blue, 16))
+    bits = np.empty(2 ** 24, dtype=bool)
+    for start in range(0, 256, 16):
+        red = np.repeat(np.arange(start, start + 16, dtype=np.uint8), 2 ** 16)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bits[start << 16:(start + 16) << 16] = np.asarray(predicate(red, green, blue, **dict(params)), dtype=bool)
+        pass
+    lut = np.packbits(bits, bitorder='little')
+
+    if path:
+        # Write to a temporary file first so that concurrent processes never read a partial table
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npy', delete=False) as f:
+            np.save(f, lut)
+            pass
+        os.replace(f.name, path)
+    lut.flags.writeable = False
+    return lut
+
+
+def _predicate_key(predicate: Callable[..., np.ndarray]) -> tuple | None:
+    # A description of the predicate that is the same across runs, or None if it cannot be described (e.g. a closure
+    # over an object without a stable repr), in which case the table is not cached on disk
+    code = getattr(predicate, '__code__', None)
+    if code is None:
+        return None
+    closure = tuple(cell.cell_contents for cell in predicate.__closure__) if predicate.__closure__ else ()
+    key = (f'{predicate.__module__}.{predicate.__qualname__}', _code_key(code), predicate.__defaults__,
+           predicate.__kwdefaults__, closure)
+    return None if ' at 0x' in repr(key) else key
+
+
+def _code_key(code: CodeType) -> tuple:
+    return (code.co_code, code.co_names,
+            tuple(_code_key(const) if isinstance(const, CodeType) else const for const in code.co_consts))
+
+
+def apply_lut(lut: np.ndarray,
+              red: np.ndarray,
+              green: np.ndarray,
+              blue: np.ndarray,
+              out: np.ndarray | None = None) -> np.ndarray:
+    """
+    Classify every pixel with a table from *compile_lut*. The pixels are classified in chunks with a single gather
+    each, reusing the same scratch buffers.
+    :param lut: the packed table
+    :param red: the red channel
+    :param green: the green channel
+    :param blue: the blue channel
+    :param out: a boolean array to write the classification into
+    :return: a boolean array of the shape of the channels
+    """
+    def classify(r, g, b, result, i, s, p):
+        # Index of the color in the table
+        np.left_shift(r, 16, out=i, dtype=np.uint32)
+        np.left_shift(g, 8, out=s, dtype=np.uint32)
+        np.bitwise_or(i, s, out=i)
+        np.bitwise_or(i, b, out=i)
+
+        # Gather the byte holding the bit of the color, then select the bit
+        np.right_shift(i, 3, out=s)
+        np.take(lut, s, out=p, mode='clip')
+        np.bitwise_and(i, 7, out=i)
+        np.right_shift(p, i, out=s)
+        np.bitwise_and(s, 1, out=s)
+        result[...] = s
+        pass
+
+    return _classify_chunks(classify, red, green, blue, out, (np.uint32, np.uint32, np.uint8))
+
+
+def _classify_chunks(classify: Callable[..., None],
+                     red: np.ndarray,
+                     green: np.ndarray,
+                     blue: np.ndarray,
+                     out: np.ndarray | None,
+                     scratch_dtypes: tuple) -> np.ndarray:
+    """
+    Classify every pixel in chunks of whole rows of about *_CHUNK_PIXELS* pixels, calling
+    classify(red, green, blue, result, *scratch) on each chunk with scratch buffers of *scratch_dtypes* that are reused
+    for every chunk.
+    """
+    if out is None:
+        out = np.empty(np.shape(red), dtype=bool)
+    if out.size == 0:
+        return out
+
+    # Classify whole rows at a time
+    channels = [np.asarray(c).reshape(-1, np.shape(red)[-1]) for c in (red, green, blue)]
+    result = out.reshape(channels[0].shape)
+    width = channels[0].shape[1]
+    rows = max(1, _CHUNK_PIXELS // width)
+
+    # Scratch buffers reused for every chunk
+    scratch = [np.empty((rows, width), dtype=dtype) for dtype in scratch_dtypes]
+
+    for start in range(0, channels[0].shape[0], rows):
+        r, g, b = [c[start:start + rows] for c in channels]
+        n = r.shape[0]
+        classify(r, g, b, result[start:start + n], *[buffer[:n] for buffer in scratch])
+        pass
+    if not np.shares_memory(result, out):
+        out[...] = result.reshape(out.shape)
+    return out
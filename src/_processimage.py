@@ -1,22 +1,24 @@
-import gc
 import itertools
-import shutil
+import math
+import os
 import struct
+import threading
 import time
 import traceback
 
 import numpy as np
 import tifffile
-from functools import partial
 from multiprocessing import Pool
 from os import makedirs, sep
 from os.path import *
-from typing import Callable, Optional
+from typing import Callable, Iterable, Optional
 
 from tqdm import tqdm
 
 from ._imagetiff import ImageTIFF
-from ._decompress import decompress, copy
+from ._decompress import _decompress_file
+from ._tilecache import tile_cache
+from ._tiles import tile_bounds, read_region, resolution_kwargs, map_contiguous, _segment_size
 
 
 def processimage(func: Callable,
@@ -28,6 +30,8 @@ def processimage(func: Callable,
                  hierarchy_inputDir=None,
                  tilesize: int = 0,
                  image_library: str = 'memmap',
+                 depth: int = 0,
+                 scheduler: str = 'threads',
                  **kwargs):
     file = basename(imagepath)
     filebase, ext = [splitext(file)[0], '.tif']
@@ -62,192 +66,86 @@ def processimage(func: Callable,
                 return imagepath
         elif image_library.lower() == 'dask':
             try:
-                img = ImageTIFF(imagepath, isbgr=isbgr, tilesize=tilesize, image_library=image_library)
-                img.map_blocks(func, **kwargs)
-                img.saveDask(out, newfile, ext='')
+                img = ImageTIFF(imagepath, isbgr=isbgr, tilesize=tilesize if tilesize else 1024,
+                                image_library=image_library)
+                # Blocks are extended by *depth* pixels for neighborhood filters and computed with *scheduler*
+                img.map_blocks(func, depth=depth, **kwargs)
+                img.saveDask(out, newfile, ext='', scheduler=scheduler)
                 return None
             except (MemoryError, struct.error) as err:
                 tqdm.write(f'memory/struct error: {file}')
                 return imagepath
-        elif image_library.lower() == 'tifffile':
-            try:
-                # Open the input TIFF file and read its dimensions
-                with tifffile.TiffFile(imagepath) as tif:
-                    width, height = tif.asarray().shape[-2:]
-
-                    # Define the tile size
-                    tile_width, tile_height = (256, 256)
-
-                    # Get number of tiles
-                    tiles_wide = range(0, width, tile_width)
-                    tiles_tall = range(0, height, tile_height)
-
-                    # Define output filename
-                    out_file = join(out, newfile)
-
-                    # Create an output TIFF file
-                    with tifffile.TiffWriter(out_file, bigtiff=True) as out_tif:
-                        # Loop over the tiles of the input file
-                        tqdm_iter = itertools.product(tiles_wide, tiles_tall)
-                        total = len(tiles_wide) * len(tiles_tall)
-                        for (start_width, start_height) in tqdm(tqdm_iter,
-                                                                total=total,
-                                                                unit='tile',
-                                                                desc='Progress bar for image'):
-                            # Get tile
-                            tile = tif.asarray()[
-                                   start_width:(start_width + tile_width),
-                                   start_height:(start_height + tile_height),
-                                   ...]
-
-                            # Process the tile
-                            processed_tile = func(tile, **kwargs)
-
-                            # Write the processed tile to the output file
-                            out_tif.write(processed_tile, tile=(start_width, start_height))
-                    return None
-                pass
-            except (MemoryError, struct.error) as err:
-                tqdm.write(f'memory/struct error: {file}')
-                return imagepath
-        elif image_library.lower() == 'memmap_slow':
-            # Slow but tries to lower the amount of memory usage
+        elif image_library.lower() == 'gdal':
             try:
-                # Copy and decompress file to output directory for modification
-                out_file = decompress(imagepath, out)
-
-                # Open the input file and read its dimensions
-                shape = tifffile.TiffFile(out_file).pages[0].shape
-                height, width = (shape[0], shape[1])
-
-                # Define the tile size
-                tile_height, tile_width = (1024, 1024)
-
-                # Get number of tiles
-                tiles_tall = np.arange(0, height, tile_height)
-                tiles_wide = np.arange(0, width, tile_width)
-
-                # Iterate over each tile
-                tqdm_iter = np.ndindex(len(tiles_tall), len(tiles_wide))
-                total = len(tiles_tall) * len(tiles_wide)
-                for [y, x] in tqdm(tqdm_iter,
-                                   total=total,
-                                   unit='tile',
-                                   desc='Progress bar for image',
-                                   leave=False,
-                                   position=1):
-                    start_height, start_width = (y * tile_height, x * tile_width)
-                    # Load specific tile into memmap memory
-                    tile = np.memmap(out_file, mode='r+', dtype=np.uint8)[
-                           start_height:(start_height + tile_width),
-                           start_width:(start_width + tile_height),
-                           ...]
-
-                    # Process the tile and set it as the value for the new tile
-                    tile_result = func(tile, **kwargs)
-
-                    # Process the tile and set it as the value for the new tile
-                    tile[...] = tile_result
-
-                    # Delete and flush the new image
-                    tile.flush()
-                    del tile
-                    gc.collect()
-                    pass
+                img = ImageTIFF(imagepath, isbgr=isbgr, tilesize=tilesize if tilesize else 1024,
+                                image_library=image_library)
+                # Windows aligned to the blocks of the image are read by GDAL and written as a tiled, compressed TIFF
+                img.map_blocks(func, depth=depth, **kwargs)
+                img.saveGDAL(out, newfile, ext='', scheduler=scheduler)
                 return None
             except (MemoryError, struct.error) as err:
                 tqdm.write(f'memory/struct error: {file}')
                 return imagepath
-        elif image_library.lower() == 'memmap_fast':
-            # Slow but tries to lower the amount of memory usage
+        elif image_library.lower() == 'tifffile':
             try:
-                # Copy and decompress file to output directory for modification
-                out_file = decompress(imagepath, out)
-
-                image = np.memmap(out_file, mode='r+', dtype=np.uint8)
-                shape = tifffile.TiffFile(out_file).pages[0].shape
-                height, width = (shape[0], shape[1])
+                # Define output filename
+                out_file = join(out, newfile)
 
-                # Define the tile size
-                tile_height, tile_width = (1024, 1024)
+                # Open the input TIFF file and read its dimensions from the header only
+                with tifffile.TiffFile(imagepath) as tif:
+                    page = tif.pages[0]
 
-                # Get number of tiles
-                tiles_tall = np.arange(0, height, tile_height)
-                tiles_wide = np.arange(0, width, tile_width)
+                    # Define the tile size (TIFF tiles must be multiples of 16)
+                    tile_size = -(-(tilesize if tilesize else 256) // 16) * 16
 
-                # Iterate over each tile
-                tqdm_iter = np.ndindex(len(tiles_tall), len(tiles_wide))
-                total = len(tiles_tall) * len(tiles_wide)
-                for [y, x] in tqdm(tqdm_iter,
-                                   total=total,
-                                   unit='tile',
-                                   desc='Progress bar for image',
-                                   leave=False,
-                                   position=1):
-                    start_height, start_width = (y * tile_height, x * tile_width)
+                    # Process the tiles one row of tiles at a time
+                    tiles = _process_tiles(func, page, tile_size, **kwargs)
+                    first_tile = next(tiles)
 
-                    # Process the tile and set it as the value for the new tile
-                    tile_result = func(image[
-                                       start_height:(start_height + tile_width),
-                                       start_width:(start_width + tile_height),
-                                       ...], **kwargs)
-
-                    # Process the tile and set it as the value for the new tile
-                    image[
-                    start_height:(start_height + tile_width),
-                    start_width:(start_width + tile_height),
-                    ...] = tile_result
+                    # Stream the processed tiles into a tiled output TIFF file
+                    with tifffile.TiffWriter(out_file, bigtiff=True) as out_tif:
+                        out_tif.write(itertools.chain([first_tile], tiles),
+                                      shape=(page.imagelength, page.imagewidth) + first_tile.shape[2:],
+                                      dtype=first_tile.dtype,
+                                      tile=(tile_size, tile_size),
+                                      photometric='rgb' if first_tile.ndim == 3 and first_tile.shape[2] in (3, 4)
+                                      else 'minisblack',
+                                      compression='zlib',
+                                      **resolution_kwargs(page))
                     pass
-                image.flush()
-                del image
-                gc.collect()
                 return None
             except (MemoryError, struct.error) as err:
                 tqdm.write(f'memory/struct error: {file}')
                 return imagepath
-        elif image_library.lower() == 'memmap_test':
-            # Slow but tries to lower the amount of memory usage
+        elif image_library.lower() in ['memmap', 'memmap_slow', 'memmap_fast', 'memmap_test']:
             try:
-                # Copy and decompress file to output directory for modification
-                # out_file = copy(imagepath, out)
-                out_file = join(out, basename(imagepath))
-
-                shape = tifffile.TiffFile(imagepath).pages[0].shape
-                image = np.memmap(out_file, shape=shape, mode='r+', dtype=np.uint8)
-                height, width = (shape[0], shape[1])
+                # Define output filename
+                out_file = join(out, newfile)
 
                 # Define the tile size
-                tile_size = int(2 ** 10)
+                tile_size = tilesize if tilesize else 1024
 
-                # Get number of tiles
-                tiles_tall = np.arange(0, height, tile_size)
-                tiles_wide = np.arange(0, width, tile_size)
+                # Write an uncompressed, contiguous copy of the image and map its pixels once
+                image = _contiguous_copy(imagepath, out_file)
+                height, width = image.shape[:2]
 
                 # Iterate over each tile
-                tqdm_iter = np.ndindex(len(tiles_tall), len(tiles_wide))
-                total = len(tiles_tall) * len(tiles_wide)
-                for [y, x] in tqdm(tqdm_iter,
-                                   total=total,
-                                   unit='tile',
-                                   desc='Progress bar for image',
-                                   leave=False,
-                                   position=1):
-                    # Define tile dimensions
-                    start_height, start_width = (y * tile_size, x * tile_size)
-                    end_height, end_width = (start_height + tile_size, start_width + tile_size)
-
+                tqdm_iter = tile_bounds(height, width, tile_size)
+                total = math.ceil(height / tile_size) * math.ceil(width / tile_size)
+                for [_, _, start_height, end_height, start_width, end_width] in tqdm(tqdm_iter,
+                                                                                     total=total,
+                                                                                     unit='tile',
+                                                                                     desc='Progress bar for image',
+                                                                                     leave=False,
+                                                                                     position=1):
                     # Get tile
                     tile = image[start_height:end_height, start_width:end_width, ...]
 
                     # Process the tile and set it as the value for the new tile
-                    tile_result = func(tile, **kwargs)
-
-                    # Process the tile and set it as the value for the new tile
-                    image[start_height:end_height, start_width:end_width, ...] = tile_result
+                    tile[...] = func(tile, **kwargs)
                     pass
                 image.flush()
                 del image
-                gc.collect()
                 return None
             except (MemoryError, struct.error) as err:
                 tqdm.write(f'memory/struct error: {file}')
@@ -261,100 +159,356 @@ def processimage(func: Callable,
     pass
 
 
+def _contiguous_copy(imagepath: str,
+                     out_file: str,
+                     /,
+                     *,
+                     workers: int | None = None) -> np.ndarray:
+    """
+    Copy a TIFF image into an uncompressed, contiguous BigTIFF and map the pixels of the copy. The tiles or strips of
+    the image are decoded in parallel straight into the copy, so memory stays bounded for compressed images.
+    :param imagepath: the path to the TIFF image
+    :param out_file: the path of the copy
+    :param workers: the number of threads decoding the image
+    :return: a writable memmap of the pixels of the copy with shape (height, width) or (height, width, samples)
+    """
+    image = _decompress_file(imagepath, out_file, workers=workers)
+    del image
+    # Map the pixel block using the offset and shape from the header of the copy
+    return map_contiguous(out_file, mode='r+')
+
+
+def _process_tiles(func: Callable,
+                   page: tifffile.TiffPage,
+                   tile_size: int,
+                   /,
+                   **kwargs):
+    """
+    Process a TIFF page tile by tile in the row-major order expected by *TiffWriter.write*. Each row of tiles is read
+    once with *read_region*, which only decodes the tiles or strips of the input that overlap the row, so every input
+    segment is decoded about once and only a single row of tiles is held in memory.
+    :param func: the function applied to each tile
+    :param page: the TIFF page to read from
+    :param tile_size: the height and width of the tiles
+    :param kwargs: the kwargs passed to *func*
+    :return: an iterator of the processed tiles
+    """
+    height, width = (page.imagelength, page.imagewidth)
+    for start_height in tqdm(range(0, height, tile_size),
+                             unit='row',
+                             desc='Progress bar for image',
+                             leave=False,
+                             position=1):
+        band = read_region(page, start_height, start_height + tile_size, 0, width)
+        for start_width in range(0, width, tile_size):
+            yield np.asarray(func(band[:, start_width:start_width + tile_size, ...], **kwargs))
+            pass
+        del band
+        pass
+    pass
+
+
 def processimages_loop(func: Callable,
                        imagepaths: list[str],
                        /,
                        *,
-                       logdir=Optional[str],
-                       **kwargs):
-    if logdir:
-        logname = f'log{time.time_ns()}.txt'
-        # with open(join(logdir, logname), 'w') as f:
-        #     pass
+                       logdir: Optional[str] = None,
+                       **kwargs) -> dict[str, dict]:
+    """
+    Process images one after another with *processimage*.
+    :param func: the function applied to each image
+    :param imagepaths: the paths to the images
+    :param logdir: the directory of the log of the images that failed
+    :param kwargs: the keyword arguments of *processimage* and *func*
+    :return: the summary of each image, see *processimages_pool*
+    """
+    with _ImageLog(logdir) as log:
         # Loop through each image with progress bar and perform function
         for imagepath in tqdm(imagepaths, unit='img', desc='Progress bar for process', position=0):
-            try:
-                out = processimage(func, imagepath, **kwargs)
-                if out is not None:
-                    with open(join(logdir, logname), 'a') as logfile:
-                        logfile.write(out)
-                        logfile.write('\n')
-                    pass
-            except Exception as e:
-                tqdm.write(f'{Exception} {imagepath} {e}')
-                tqdm.write(traceback.format_exc())
+            log.add(_process_one(func, imagepath, kwargs))
             pass
         pass
-    else:
-        # Loop through each image with progress bar and perform function
-        for imagepath in tqdm(imagepaths, unit='img', desc='Progress bar for process', position=0):
-            try:
-                processimage(func, imagepath, **kwargs)
-            except Exception as e:
-                tqdm.write(f'{Exception} {imagepath} {e}')
-                tqdm.write(traceback.format_exc())
-            pass
-        pass
-    pass
+    return log.summary
 
 
 def processimages_pool(func: Callable,
-                       imagepaths: list[str],
+                       imagepaths: Iterable[str],
                        /,
                        *,
                        processes=2,
                        chunksize=None,
                        aSync=False,
-                       logdir=Optional[str],
-                       **kwargs):
-    if logdir:
-        logname = f'log{time.time_ns()}.txt'
-        # with open(join(logdir, logname), 'w') as f:
-        #     pass
-        with Pool(processes=max(processes, 1)) as pool:
-            if aSync:
-                errs = pool.starmap_async(processimage,
-                                          [(partial(func, **kwargs), imagepath) for imagepath in
-                                           tqdm(imagepaths, unit='img', desc='Progress bar for process', position=0)],
-                                          chunksize=chunksize)
-                for err in errs.get():
-                    if err is not None:
-                        with open(join(logdir, logname), 'a') as logfile:
-                            logfile.write(err)
-                            logfile.write('\n')
-                            pass
-                        pass
-            else:
-                for err in pool.starmap(processimage,
-                                        [(partial(func, **kwargs), imagepath) for imagepath in
-                                         tqdm(imagepaths, unit='img', desc='Progress bar for process', position=0)],
-                                        chunksize=chunksize):
-                    if err is not None:
-                        with open(join(logdir, logname), 'a') as logfile:
-                            logfile.write(err)
-                            pass
-                        pass
-            pass
+                       logdir: Optional[str] = None,
+                       maxtasksperchild: int | None = 1,
+                       max_in_flight: int | None = None,
+                       memory_budget: int | str | None = None,
+                       **kwargs) -> dict[str, dict]:
+    """
+    Process images on a pool of processes with *processimage*. *func* and *kwargs* are sent once to each worker, and
+    the images are handed out with *imap_unordered* as the workers become free, so the progress bar advances as each
+    image completes and failures are written to the log as they happen.
+    :param func: the function applied to each image
+    :param imagepaths: the paths to the images
+    :param processes: the number of worker processes
+    :param chunksize: the number of images handed to a worker at once (default 1); must be 1 with a *memory_budget*,
+    since a chunk is only sent once it is full and the images admitted into it hold the budget until then
+    :param aSync: unused, the images are always processed asynchronously
+    :param logdir: the directory of the log of the images that failed
+    :param maxtasksperchild: the number of images a worker processes before it is replaced, which returns the memory
+    held by the worker to the system; None keeps the workers for the whole pool
+    :param max_in_flight: the maximum number of images submitted but not finished (default twice the number of
+    processes)
+    :param memory_budget: the RAM (in bytes, or e.g. '24g') that the images being processed may use at once. The peak
+    memory of each image is estimated from its TIFF header with *estimate_memory*, and an image is only submitted while
+    the total stays within the budget, largest images first; an image larger than the budget is processed on its own.
+    None submits the images in order without a budget
+    :param kwargs: the keyword arguments of *processimage* and *func*
+    :return: the summary of each image, a dictionary of imagepath: {'status': 'done' | 'failed' | 'error',
+    'seconds': float, 'error': str | None}
+    """
+    processes = max(processes, 1)
+    chunksize = chunksize if chunksize else 1
+    if memory_budget is not None and chunksize > 1:
+        raise ValueError('*chunksize* must be 1 with a *memory_budget*!')
+    max_in_flight = max(max_in_flight if max_in_flight else 2 * processes, chunksize)
+
+    if memory_budget is not None:
+        # Read the size of every image from its header up front
+        estimates = {imagepath: estimate_memory(imagepath,
+                                                image_library=kwargs.get('image_library', 'memmap'),
+                                                tilesize=kwargs.get('tilesize', 0),
+                                                depth=kwargs.get('depth', 0))
+                     for imagepath in tqdm(imagepaths, unit='img', desc='Reading image headers', leave=False)}
+        scheduler = _ImageScheduler(estimates, max_in_flight, _parse_bytes(memory_budget))
+    else:
+        scheduler = _ImageScheduler(imagepaths, max_in_flight)
+
+    with _ImageLog(logdir) as log, Pool(processes=processes,
+                                        initializer=_init_worker,
+                                        initargs=(func, kwargs),
+                                        maxtasksperchild=maxtasksperchild) as pool:
+        # The feeder thread of the pool takes an image only once the scheduler admits it
+        total = len(scheduler)
+        try:
+            for result in tqdm(pool.imap_unordered(_process_worker, scheduler.admit(), chunksize=chunksize),
+                               total=total, unit='img', desc='Progress bar for process', position=0):
+                scheduler.release(result[0])
+                log.add(result)
+                pass
+        finally:
+            # Release the feeder thread (e.g. on Ctrl-C) before the pool is terminated and joins it
+            scheduler.close()
         pass
+    return log.summary
+
+
+def estimate_memory(imagepath: str,
+                    /,
+                    *,
+                    image_library: str = 'memmap',
+                    tilesize: int = 0,
+                    depth: int = 0) -> int:
+    """
+    Estimate the peak working memory of processing an image with *processimage*, from the shape and data type in its
+    TIFF header. The estimate covers the pixels each engine holds at once (the whole image for 'pil', a band of tiles
+    for 'tifffile', a tile and the segments being decoded for 'memmap', the blocks in flight for 'dask' and 'gdal'),
+    with room for the temporaries of the function, plus the tile cache and the baseline of a worker process.
+    :param imagepath: the path to the TIFF image
+    :param image_library: the engine of *processimage*
+    :param tilesize: the tile size of *processimage*
+    :param depth: the depth of the blocks of *processimage*
+    :return: the estimated peak memory in bytes, or 0 if the header cannot be read
+    """
+    try:
+        with tifffile.TiffFile(imagepath) as tif:
+            page = tif.pages[0]
+            height, width, samples = (page.imagelength, page.imagewidth, page.samplesperpixel)
+            pixel = samples * page.dtype.itemsize
+            segment = math.prod(_segment_size(page)) * pixel
+    except (OSError, tifffile.TiffFileError, IndexError):
+        return 0
+
+    workers = os.cpu_count() or 1
+    library = image_library.lower()
+    if library == 'pil':
+        # The decoded image, the array of the image, and the temporaries of the function
+        working = 3 * height * width * pixel
+    elif library == 'tifffile':
+        tile_size = -(-(tilesize if tilesize else 256) // 16) * 16
+        working = 3 * min(tile_size, height) * width * pixel + tile_cache.max_bytes
+    elif library in ['dask', 'gdal']:
+        block = min((tilesize if tilesize else 1024) + 2 * depth, height) * \
+            min((tilesize if tilesize else 1024) + 2 * depth, width) * pixel
+        working = 3 * 2 * workers * block + tile_cache.max_bytes
     else:
-        # Create worker pools and process images with progress bar
-        with Pool(processes=max(processes, 1)) as pool:
-            if aSync:
-                pool.starmap_async(processimage,
-                                   [(partial(func, **kwargs), imagepath)
-                                    for imagepath in tqdm(imagepaths,
-                                                          unit='img',
-                                                          desc='Progress bar for process',
-                                                          position=0)],
-                                   chunksize=chunksize)
-            else:
-                pool.starmap(processimage,
-                             [(partial(func, **kwargs), imagepath)
-                              for imagepath in tqdm(imagepaths,
-                                                    unit='img',
-                                                    desc='Progress bar for process',
-                                                    position=0)],
-                             chunksize=chunksize)
-            pass
+        tile_size = tilesize if tilesize else 1024
+        working = 3 * min(tile_size, height) * min(tile_size, width) * pixel + 2 * workers * segment
+    return int(working + _PROCESS_BYTES)
+
+
+# The memory of a worker process before it reads an image
+_PROCESS_BYTES = int(2 ** 28)
+
+
+def _parse_bytes(size: int | str) -> int:
+    # A number of bytes, or a size such as '512m' or '24g'
+    if isinstance(size, (int, np.integer)):
+        return int(size)
+    units = {'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30, 't': 2 ** 40}
+    size = size.strip().lower().rstrip('b')
+    try:
+        if size[-1:] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise ValueError(f'Invalid memory size \'{size}\'!')
+
+
+class _ImageScheduler:
+    def __init__(self,
+                 images: Iterable[str] | dict[str, int],
+                 max_in_flight: int,
+                 memory_budget: int | None = None):
+        """
+        Admit images to the pool while at most *max_in_flight* images are in flight and, with a *memory_budget*, while
+        the estimated memory of the images in flight stays within the budget. With a budget, the largest image that
+        fits is admitted first, so big images run on their own and small images are packed around them; an image
+        larger than the budget is admitted once nothing else is in flight.
+        :param images: the paths to the images, or a dictionary of imagepath: estimated memory in bytes
+        :param max_in_flight: the maximum number of images in flight
+        :param memory_budget: the maximum total estimated memory of the images in flight
+        :return:
+        """
+        if memory_budget is None:
+            self._pending = iter(images)
+            self._estimates = {}
+        else:
+            self._pending = sorted(images, key=images.get, reverse=True)
+            self._estimates = dict(images)
+        self._total = len(images) if hasattr(images, '__len__') else None
+        self.max_in_flight = max_in_flight
+        self.memory_budget = memory_budget
+        self.in_flight = 0
+        self.memory = 0
+        self.closed = False
+        self._condition = threading.Condition()
         pass
+
+    def __len__(self) -> int | None:
+        return self._total
+
+    def admit(self):
+        if self.memory_budget is None:
+            for imagepath in self._pending:
+                with self._condition:
+                    self._condition.wait_for(lambda: self.closed or self.in_flight < self.max_in_flight)
+                    if self.closed:
+                        return
+                    self.in_flight += 1
+                yield imagepath
+            return
+
+        while self._pending:
+            with self._condition:
+                imagepath = None
+                while imagepath is None and not self.closed:
+                    imagepath = self._next()
+                    if imagepath is None:
+                        self._condition.wait()
+                    pass
+                if self.closed:
+                    return
+                self._pending.remove(imagepath)
+                self.in_flight += 1
+                self.memory += self._estimates[imagepath]
+            yield imagepath
+        pass
+
+    def _next(self) -> str | None:
+        # The largest pending image that fits in the memory left, or the largest image if nothing is in flight
+        if self.in_flight >= self.max_in_flight:
+            return None
+        if self.in_flight == 0:
+            return self._pending[0]
+        for imagepath in self._pending:
+            if self.memory + self._estimates[imagepath] <= self.memory_budget:
+                return imagepath
+        return None
+
+    def release(self, imagepath: str):
+        with self._condition:
+            self.in_flight -= 1
+            self.memory -= self._estimates.get(imagepath, 0)
+            self._condition.notify_all()
+        pass
+
+    def close(self):
+        # Stop admitting images, so that the feeder thread of the pool returns and the pool can be terminated
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        pass
+
+    pass
+
+
+# The function and keyword arguments of *processimages_pool*, set once in each worker
+_worker_task = None
+
+
+def _init_worker(func: Callable, kwargs: dict):
+    global _worker_task
+    _worker_task = (func, kwargs)
+    pass
+
+
+def _process_worker(imagepath: str) -> tuple[str, str, float, str | None]:
+    func, kwargs = _worker_task
+    return _process_one(func, imagepath, kwargs)
+
+
+def _process_one(func: Callable, imagepath: str, kwargs: dict) -> tuple[str, str, float, str | None]:
+    # Process an image, catching every error so that a single image never stops the batch
+    start = time.perf_counter()
+    try:
+        failed = processimage(func, imagepath, **kwargs)
+        status, error = ('failed', 'memory/struct error') if failed is not None else ('done', None)
+    except Exception as e:
+        status, error = ('error', f'{e.__class__.__name__}: {e}\n{traceback.format_exc()}')
+    return imagepath, status, time.perf_counter() - start, error
+
+
+class _ImageLog:
+    def __init__(self, logdir: Optional[str]):
+        """
+        The summary of processed images. Images that failed are written to a log file in *logdir* as soon as they are
+        reported.
+        :param logdir: the directory of the log file, or None to not write a log
+        :return:
+        """
+        self.logdir = logdir
+        self.summary = {}
+        self._file = None
+        pass
+
+    def __enter__(self):
+        if self.logdir:
+            self._file = open(join(self.logdir, f'log{time.time_ns()}.txt'), 'a')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._file is not None:
+            self._file.close()
+        pass
+
+    def add(self, result: tuple[str, str, float, str | None]):
+        imagepath, status, seconds, error = result
+        self.summary[imagepath] = {'status': status, 'seconds': seconds, 'error': error}
+        if status != 'done':
+            tqdm.write(f'{status}: {imagepath} {error}')
+            if self._file is not None:
+                self._file.write(f'{imagepath}\t{status}\t{error.splitlines()[0]}\n')
+                self._file.flush()
+        pass
+
     pass
@@ -0,0 +1,89 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+import numpy as np
+
+
+class TileCache:
+    def __init__(self, max_bytes: int = int(2 ** 28)):
+        """
+        A thread-safe cache of decoded TIFF tiles and strips with least-recently-used eviction. Tiles are keyed by
+        (path, mtime, page offset, tile index). The mtime is read when a file is first read from after it is opened, so
+        a file that is rewritten and opened again is never served from stale tiles.
+        :param max_bytes: the maximum number of bytes of decoded tiles held in the cache; 0 disables the cache
+        :return:
+        """
+        self.max_bytes = max_bytes
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        pass
+
+    def get(self, key: Hashable) -> np.ndarray | None:
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key: Hashable, tile: np.ndarray):
+        # Tiles larger than the whole budget are not cached
+        if tile.nbytes > self.max_bytes:
+            return
+        # Cached tiles are shared, so they must not be modified
+        tile.flags.writeable = False
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self.nbytes += tile.nbytes
+            self._evict()
+        pass
+
+    def resize(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+        pass
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+        pass
+
+    def info(self) -> dict:
+        """
+        The metrics of the cache, to size it.
+        :return: a dictionary of the hits, misses, evictions, number of tiles, bytes held and byte budget
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'tiles': len(self._tiles),
+                    'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes}
+
+    def _evict(self):
+        # Remove the least recently used tiles until the cache is within its budget
+        while self.nbytes > self.max_bytes and self._tiles:
+            _, tile = self._tiles.popitem(last=False)
+            self.nbytes -= tile.nbytes
+            self.evictions += 1
+            pass
+        pass
+
+    pass
+
+
+# The cache shared by every tile reader of the process (256 MiB unless set by IMAGEPROCESSING_TILE_CACHE_BYTES)
+tile_cache = TileCache(int(os.environ.get('IMAGEPROCESSING_TILE_CACHE_BYTES', 2 ** 28)))
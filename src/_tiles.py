@@ -0,0 +1,401 @@
+import math
+import os
+import weakref
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Iterable, Iterator, Any
+
+import numpy as np
+import tifffile
+
+from ._tilecache import tile_cache
+
+
+def tile_bounds(height: int, width: int, tile_size: tuple[int, int] | int):
+    """
+    Iterate over the tiles of an image of size (height, width), including the partial tiles at the right and bottom
+    edges of the image.
+    :param height: the height of the image in pixels
+    :param width: the width of the image in pixels
+    :param tile_size: an integer or a tuple (tile_height, tile_width) specifying the size of the tiles
+    :return: an iterator of (tile_row, tile_column, start_height, end_height, start_width, end_width)
+    """
+    if isinstance(tile_size, (int, np.integer)):
+        tile_size = (int(tile_size), int(tile_size))
+    tile_height, tile_width = tile_size
+    if tile_height <= 0 or tile_width <= 0:
+        raise ValueError('\'tile_size\' must be positive!')
+
+    # Get number of tiles
+    tiles_tall = math.ceil(height / tile_height)
+    tiles_wide = math.ceil(width / tile_width)
+
+    for [y, x] in np.ndindex(tiles_tall, tiles_wide):
+        start_height, start_width = (y * tile_height, x * tile_width)
+        end_height, end_width = (min(start_height + tile_height, height), min(start_width + tile_width, width))
+        yield y, x, start_height, end_height, start_width, end_width
+    pass
+
+
+def map_tiles(func: Callable[[Any], Any],
+              tiles: Iterable[Any],
+              /,
+              *,
+              workers: int | None = None,
+              executor: Executor | None = None,
+              max_in_flight: int | None = None,
+              ordered: bool = False) -> Iterator[tuple[Any, Any]]:
+    """
+    Apply *func* to every tile, optionally on a thread pool. NumPy and SciPy release the GIL for most of the work done
+    on a tile, so threads scale with the number of cores. At most *max_in_flight* tiles are submitted at once so that
+    the memory held by pending tiles stays bounded.
+    :param func: the function applied to each tile
+    :param tiles: an iterable of tiles (e.g. the bounds from *tile_bounds*)
+    :param workers: the number of threads; tiles are processed serially if None or 1 and no *executor* is supplied
+    :param executor: a shared executor to submit the tiles to in place of creating a new thread pool
+    :param max_in_flight: the maximum number of submitted but unfinished tiles (default twice the number of workers)
+    :param ordered: yield the tiles in the order of *tiles* (e.g. to stream them to a TIFF file) in place of the order
+    the tiles finish
+    :return: an iterator of (tile, func(tile)) in the order the tiles finish, or in the order of *tiles* if *ordered*
+    """
+    if executor is None and (not workers or workers <= 1):
+        for tile in tiles:
+            yield tile, func(tile)
+            pass
+        return
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    if not max_in_flight:
+        max_in_flight = 2 * (workers if workers else os.cpu_count() or 1)
+
+    if ordered:
+        yield from _map_ordered(func, tiles, executor, max_in_flight, own_executor)
+        return
+
+    pending = {}
+    try:
+        for tile in tiles:
+            pending[executor.submit(func, tile)] = tile
+            # wait for a tile to finish before submitting any more
+            while len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+                pass
+            pass
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+            pass
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+    pass
+
+
+def _map_ordered(func: Callable[[Any], Any],
+                 tiles: Iterable[Any],
+                 executor: Executor,
+                 max_in_flight: int,
+                 own_executor: bool) -> Iterator[tuple[Any, Any]]:
+    # The submitted tiles form a bounded queue, which is emptied from the front in the order of submission
+    pending = deque()
+    try:
+        for tile in tiles:
+            pending.append((tile, executor.submit(func, tile)))
+            while len(pending) >= max_in_flight:
+                tile, future = pending.popleft()
+                yield tile, future.result()
+            pass
+        while pending:
+            tile, future = pending.popleft()
+            yield tile, future.result()
+            pass
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+    pass
+
+
+def _segment_size(page: tifffile.TiffPage) -> tuple[int, int]:
+    # Tiles are stored in a grid, strips span the whole width of the image
+    if page.is_tiled:
+        return page.tilelength, page.tilewidth
+    rowsperstrip = page.rowsperstrip if page.rowsperstrip else page.imagelength
+    return min(rowsperstrip, page.imagelength), page.imagewidth
+
+
+# The (path, mtime) of each open TIFF file, read once per handle in place of once per segment
+_file_keys = weakref.WeakKeyDictionary()
+
+
+def _file_key(tif: tifffile.TiffFile) -> tuple[str, int]:
+    key = _file_keys.get(tif)
+    if key is None:
+        path = tif.filehandle.path
+        key = _file_keys[tif] = (path, os.stat(path).st_mtime_ns)
+    return key
+
+
+def _read_segment(page: tifffile.TiffPage, index: int) -> np.ndarray:
+    """
+    Read and decode a single tile or strip of a TIFF page. Decoded segments are kept in the process-wide *tile_cache*,
+    so reading the same region again (e.g. thresholding and then finding maxima on the same image) decodes it once.
+    :param page: the TIFF page
+    :param index: the index of the segment in *page.dataoffsets*
+    :return: the decoded segment with shape (length, width, samples), which must not be modified
+    """
+    fh = page.parent.filehandle
+    key = None
+    if tile_cache.max_bytes > 0 and fh.path:
+        # The offset of the IFD tells apart the pages and SubIFDs of the file, whose indexes can be the same
+        key = _file_key(page.parent) + (page.offset, index)
+        segment = tile_cache.get(key)
+        if segment is not None:
+            return segment
+    with fh.lock:
+        fh.seek(page.dataoffsets[index])
+        data = fh.read(page.databytecounts[index])
+    segment, _, _ = page.decode(data, index, jpegtables=page.jpegtables)
+    segment = segment[0]
+    if key is not None:
+        tile_cache.put(key, segment)
+    return segment
+
+
+def _contiguous_array(page: tifffile.TiffPage, mode: str = 'r') -> np.ndarray:
+    # Map the uncompressed pixel block of the page in place of decoding it
+    dtype = page.dtype.newbyteorder(page.parent.byteorder)
+    return np.memmap(page.parent.filehandle.path, dtype=dtype, mode=mode, offset=page.dataoffsets[0],
+                     shape=page.shape)
+
+
+def map_contiguous(imagepath: os.PathLike | str, mode: str = 'r+') -> np.ndarray:
+    """
+    Map the pixels of an uncompressed, contiguous TIFF image. The offset of the pixel block is read from the header,
+    so the header is never treated as pixels, and the memmap has the shape of the page.
+    :param imagepath: the path to the TIFF image
+    :param mode: the mode of the memmap
+    :return: a memmap of shape (height, width) or (height, width, samples)
+    """
+    with tifffile.TiffFile(imagepath) as tif:
+        page = tif.pages[0]
+        if not page.is_contiguous or page.fillorder != 1:
+            raise ValueError('The image must be uncompressed and contiguous to be mapped!')
+        if page.samplesperpixel > 1 and page.planarconfig == tifffile.PLANARCONFIG.SEPARATE:
+            raise ValueError('The samples of the image must be interleaved to be mapped!')
+        return _contiguous_array(page, mode=mode)
+
+
+def read_region(page: tifffile.TiffPage,
+                start_height: int,
+                end_height: int,
+                start_width: int,
+                end_width: int,
+                channel: int | None = None) -> np.ndarray:
+    """
+    Read a rectangular region of a TIFF page, decoding only the tiles or strips that overlap the region.
+    :param page: the TIFF page to read from
+    :param start_height: first row of the region
+    :param end_height: last row (exclusive) of the region
+    :param start_width: first column of the region
+    :param end_width: last column (exclusive) of the region
+    :param channel: if supplied, only this channel of the region is returned
+    :return: an array of shape (rows, columns, samples), or (rows, columns) if *channel* is supplied or the page only
+    has a single sample
+    """
+    height, width = (page.imagelength, page.imagewidth)
+    start_height, end_height = (max(start_height, 0), min(end_height, height))
+    start_width, end_width = (max(start_width, 0), min(end_width, width))
+    samples = page.samplesperpixel
+    separate = samples > 1 and page.planarconfig == tifffile.PLANARCONFIG.SEPARATE
+
+    if page.is_contiguous and page.fillorder == 1:
+        data = _contiguous_array(page)
+        if separate:
+            data = np.moveaxis(data, 0, -1)
+        region = data[start_height:end_height, start_width:end_width, ...]
+        if channel is not None and samples > 1:
+            region = region[..., channel]
+        return np.array(region)
+
+    # Locate the segments overlapping the region
+    segment_height, segment_width = _segment_size(page)
+    segments_tall = math.ceil(height / segment_height)
+    segments_wide = math.ceil(width / segment_width)
+    rows = range(start_height // segment_height, math.ceil(end_height / segment_height))
+    cols = range(start_width // segment_width, math.ceil(end_width / segment_width))
+    if separate:
+        planes = [channel] if channel is not None else range(samples)
+    else:
+        planes = [0]
+
+    # Generate blank output matrix
+    out_samples = 1 if channel is not None or samples == 1 else samples
+    out = np.zeros((end_height - start_height, end_width - start_width, out_samples), dtype=page.dtype)
+
+    for plane in planes:
+        for [row, col] in np.ndindex(len(rows), len(cols)):
+            segment_y, segment_x = (rows[row] * segment_height, cols[col] * segment_width)
+            index = (plane * segments_tall + rows[row]) * segments_wide + cols[col]
+            segment = _read_segment(page, index)
+            if channel is not None and not separate and samples > 1:
+                segment = segment[..., channel:channel + 1]
+
+            # Intersect the segment with the region
+            y0, y1 = (max(segment_y, start_height), min(segment_y + segment.shape[0], end_height))
+            x0, x1 = (max(segment_x, start_width), min(segment_x + segment.shape[1], end_width))
+            if y0 >= y1 or x0 >= x1:
+                continue
+            target = slice(plane, plane + 1) if separate and channel is None else slice(None)
+            out[y0 - start_height:y1 - start_height, x0 - start_width:x1 - start_width, target] = \
+                segment[y0 - segment_y:y1 - segment_y, x0 - segment_x:x1 - segment_x, ...]
+            pass
+        pass
+    return out[..., 0] if out_samples == 1 else out
+
+
+def resolution_kwargs(page: tifffile.TiffPage) -> dict:
+    """
+    Get the resolution of a TIFF page as keyword arguments for *TiffWriter.write*, so that a rewritten image keeps its
+    physical pixel size.
+    :param page: the TIFF page
+    :return: a dictionary with 'resolution' and 'resolutionunit', or an empty dictionary if the page has no resolution
+    """
+    tags = page.tags
+    if 'XResolution' not in tags or 'YResolution' not in tags:
+        return {}
+    kwargs = {'resolution': (tags['XResolution'].value, tags['YResolution'].value)}
+    if 'ResolutionUnit' in tags:
+        kwargs['resolutionunit'] = tags['ResolutionUnit'].value
+    return kwargs
+
+
+def _index_window(key, shape: tuple[int, ...], name: str, negative_steps: bool = True) -> tuple[list[int], tuple]:
+    """
+    Split a NumPy index of an image of *shape* into the window of rows and columns to read and the index applied to
+    the window afterward, so that reading the window and indexing it gives the same result as indexing the whole image.
+    :param key: an index of integers, slices and at most one Ellipsis
+    :param shape: the (height, width) or (height, width, samples) of the image
+    :param name: the name of the indexed object in the error messages
+    :param negative_steps: whether slices of the rows and columns may have negative steps
+    :return: the window (start_height, end_height, start_width, end_width) and the index of the window
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if Ellipsis in key:
+        index = key.index(Ellipsis)
+        key = key[:index] + (slice(None),) * (len(shape) - len(key) + 1) + key[index + 1:]
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    # Read the bounding rows and columns, then apply the steps and any integer indices
+    bounds, rest = ([], [])
+    for axis in range(2):
+        k = key[axis]
+        if isinstance(k, (int, np.integer)):
+            k = range(shape[axis])[k]
+            bounds += [k, k + 1]
+            rest.append(0)
+        elif isinstance(k, slice):
+            start, stop, step = k.indices(shape[axis])
+            if step < 0:
+                if not negative_steps:
+                    raise ValueError(f'Negative steps cannot index {name}!')
+                start, stop = (stop + 1, start + 1)
+            bounds += [start, max(stop, start)]
+            rest.append(slice(None, None, step) if step != 1 else slice(None))
+        else:
+            raise TypeError(f'Only integers and slices can index {name}!')
+        pass
+    return bounds, tuple(rest) + key[2:]
+
+
+class TiffArray:
+    def __init__(self, path: os.PathLike | str):
+        """
+        A lazy array over the first page of a TIFF image. Indexing reads only the requested rows and columns with
+        *read_region*, so it can be wrapped by *dask.array.from_array* or sliced like a memmap without loading the image.
+        The file is reopened in each process, so the array can be pickled.
+        :param path: the path to the TIFF image
+        :return:
+        """
+        self.path = path
+        self._tif = None
+        page = self._page()
+        samples = page.samplesperpixel
+        self.shape = (page.imagelength, page.imagewidth, samples) if samples > 1 else (page.imagelength,
+                                                                                        page.imagewidth)
+        self.dtype = np.dtype(page.dtype)
+        pass
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def _page(self) -> tifffile.TiffPage:
+        if self._tif is None:
+            self._tif = tifffile.TiffFile(self.path)
+            self._tif.filehandle.set_lock(True)
+        return self._tif.pages[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        bounds, rest = _index_window(key, self.shape, 'a TiffArray')
+        region = read_region(self._page(), *bounds)
+        if region.ndim < self.ndim:
+            region = region[..., np.newaxis] if self.ndim == 3 else region
+        return region[rest]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_tif'] = None
+        return state
+
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+        pass
+
+    pass
+
+
+@contextmanager
+def open_tiles(image: os.PathLike | str | tifffile.TiffFile | np.ndarray):
+    """
+    Open an image for reading regions of it. TIFF files are read with *read_region*, so only the tiles or strips that
+    overlap a region are decoded, and arrays (including memmaps) are sliced.
+    :param image: a path to a TIFF image, an open TiffFile, or an array or lazy array of shape (height, width, ...)
+    :return: a context manager yielding a function read(start_height, end_height, start_width, end_width) and the
+    (height, width) of the image
+    """
+    if isinstance(image, (os.PathLike, str)):
+        with tifffile.TiffFile(image) as tif:
+            with open_tiles(tif) as opened:
+                yield opened
+            pass
+    elif isinstance(image, tifffile.TiffFile):
+        page = image.pages[0]
+        image.filehandle.set_lock(True)
+        yield partial(read_region, page), (page.imagelength, page.imagewidth)
+    elif hasattr(image, 'shape') and hasattr(image, '__getitem__'):
+        # Arrays, memmaps and lazy arrays (e.g. TiffArray or Dask arrays) are sliced
+        def read(start_height, end_height, start_width, end_width):
+            return np.asarray(image[start_height:end_height, start_width:end_width, ...])
+
+        yield read, image.shape[:2]
+    else:
+        raise TypeError(f'Invalid type for *image*: {image.__class__}')
+    pass
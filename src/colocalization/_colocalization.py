@@ -1,56 +1,122 @@
 import math
+import os
+from concurrent.futures import Executor
 
 import numpy as np
 import scipy.stats as stats
 
-from .. import ImageTIFF
-
-
-def costesthresholds(img: ImageTIFF, channel1: str, channel2: str):
-    threshold1 = img.maxvalue // 10
-    threshold2 = img.maxvalue // 10
-    c1_values = np.array([])
-    c2_values = np.array([])
-    temparr_copy = img.copyArray()
-    c1_temparr = np.ravel(temparr_copy[:, :, img.colors[channel1]], order='C')
-    c2_temparr = np.ravel(temparr_copy[:, :, img.colors[channel2]], order='C')
-    for i in range(img.maxvalue // 10):
-        list1 = np.where(c1_temparr > threshold1 - i)
-        list2 = np.where(c2_temparr > threshold2 - i)
-        indices = np.intersect1d(list1, list2)
-        c1_values = np.concatenate((c1_values, c1_temparr[indices]))
-        c2_values = np.concatenate((c2_values, c2_temparr[indices]))
-        c1_temparr[indices] = 0
-        c2_temparr[indices] = 0
-        if not (np.size(c1_values) < 2 or np.size(c2_values) < 2):
-            r, p = stats.pearsonr(c1_values, c2_values)
-            print(f'r = {r}, p = {p}')
+from .. import ImageTIFF, channel_histograms
+from .._tiles import tile_bounds, map_tiles, open_tiles
+
+
+class _JointMoments:
+    def __init__(self, joint: np.ndarray):
+        """
+        Prefix sums of the moments of a 256x256 joint histogram, so the Pearson correlation of the pixels inside any
+        rectangle of intensities is computed in constant time.
+        :param joint: the joint histogram indexed by [channel1 value, channel2 value]
+        :return:
+        """
+        x = np.arange(256, dtype=np.int64)[:, None]
+        y = np.arange(256, dtype=np.int64)[None, :]
+        joint = np.asarray(joint, dtype=np.int64)
+        self._prefix = {k: self._cumulate(v) for k, v in {'n': joint,
+                                                           'x': joint * x,
+                                                           'y': joint * y,
+                                                           'xx': joint * x * x,
+                                                           'yy': joint * y * y,
+                                                           'xy': joint * x * y}.items()}
+        pass
+
+    @staticmethod
+    def _cumulate(values: np.ndarray) -> np.ndarray:
+        # prefix[a, b] is the sum of values[:a, :b]
+        prefix = np.zeros((257, 257), dtype=np.int64)
+        prefix[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+        return prefix
+
+    def below(self, threshold1: int, threshold2: int) -> dict[str, int]:
+        # moments of the pixels with channel1 < threshold1 and channel2 < threshold2
+        a, b = (min(max(threshold1, 0), 256), min(max(threshold2, 0), 256))
+        return {k: int(v[a, b]) for k, v in self._prefix.items()}
+
+    def above(self, threshold1: int, threshold2: int) -> dict[str, int]:
+        # moments of the pixels with channel1 > threshold1 and channel2 > threshold2
+        a, b = (min(max(threshold1 + 1, 0), 256), min(max(threshold2 + 1, 0), 256))
+        return {k: int(v[256, 256] - v[a, 256] - v[256, b] + v[a, b]) for k, v in self._prefix.items()}
+
+    pass
+
+
+def _pearson(moments: dict[str, int]) -> float:
+    # Pearson's r from the sums of a set of pixels; the integer sums keep the numerator exact
+    n = moments['n']
+    numerator = n * moments['xy'] - moments['x'] * moments['y']
+    denominator = (n * moments['xx'] - moments['x'] ** 2) * (n * moments['yy'] - moments['y'] ** 2)
+    if denominator <= 0:
+        return math.nan
+    return numerator / math.sqrt(denominator)
+
+
+def costesthresholds(img: ImageTIFF | np.ndarray | os.PathLike | str, channel1: str | int, channel2: str | int,
+                     tile_size: tuple[int, int] | int = (1024, 1024)):
+    """
+    Lower the thresholds of both channels together until the pixels above both thresholds are no longer positively
+    correlated. The search runs on the joint histogram of the two channels, so each candidate costs O(1).
+    :param img: an ImageTIFF, an array or memmap, or a path to a TIFF image
+    :param channel1:
+    :param channel2:
+    :param tile_size: the size of the tiles the joint histogram is built from
+    :return: the thresholds [threshold1, threshold2]
+    """
+    histograms, joint = channel_histograms(img, [channel1, channel2], joint=(channel1, channel2), tile_size=tile_size)
+    maxvalue = img.maxvalue if isinstance(img, ImageTIFF) else int(np.flatnonzero(histograms.sum(axis=0)).max())
+    moments = _JointMoments(joint)
+
+    threshold1 = maxvalue // 10
+    threshold2 = maxvalue // 10
+    for i in range(maxvalue // 10):
+        selected = moments.above(threshold1 - i, threshold2 - i)
+        if selected['n'] >= 2:
+            r = _pearson(selected)
             if r <= 0:
                 return [threshold1 - i + 1, threshold2 - i + 1]
     return [threshold1, threshold2]
 
 
-def costesthresholdsfast(image: ImageTIFF, channel1: str, channel2: str):
+def costesthresholdsfast(image: ImageTIFF | np.ndarray | os.PathLike | str, channel1: str | int, channel2: str | int,
+                         tile_size: tuple[int, int] | int = (1024, 1024)):
+    """
+    Bisect the thresholds of both channels until the pixels below both thresholds are uncorrelated. The search runs
+    on the joint histogram of the two channels, so each candidate costs O(1).
+    :param image: an ImageTIFF, an array or memmap, or a path to a TIFF image
+    :param channel1:
+    :param channel2:
+    :param tile_size: the size of the tiles the joint histogram is built from
+    :return: the thresholds [threshold1, threshold2]
+    """
     rthreshold = math.pow(10, -13)
-    c1_values = np.ravel(ImageTIFF.getChannel(image, channel1), order='C')
-    c2_values = np.ravel(ImageTIFF.getChannel(image, channel2), order='C')
+    histograms, joint = channel_histograms(image, [channel1, channel2], joint=(channel1, channel2),
+                                           tile_size=tile_size)
+    maxvalue = image.maxvalue if isinstance(image, ImageTIFF) else int(np.flatnonzero(histograms.sum(axis=0)).max())
+    moments = _JointMoments(joint)
+    levels = np.arange(256)
 
-    threshold1 = (np.max(c1_values) + np.mean(c1_values)) // 2
-    threshold2 = (np.max(c2_values) + np.mean(c2_values)) // 2
+    # start halfway between the maximum and the mean of each channel
+    threshold1 = (np.flatnonzero(histograms[0]).max() + (histograms[0] @ levels) / histograms[0].sum()) // 2
+    threshold2 = (np.flatnonzero(histograms[1]).max() + (histograms[1] @ levels) / histograms[1].sum()) // 2
     previousT1 = threshold1
     previousT2 = threshold2
     lastpositivet1 = threshold1
     lastpositivet2 = threshold2
     stopBoolean = False
-    niter = math.ceil(math.log2(image.maxvalue))
+    niter = math.ceil(math.log2(maxvalue))
     while not stopBoolean:
-        list1 = np.where(c1_values < threshold1)
-        list2 = np.where(c2_values < threshold2)
-        indices = np.intersect1d(list1, list2)
-        # print(f'T1 = {threshold1}, T2 = {threshold2}, size(indices) = {np.size(indices)}')
-        if np.size(indices) > 1:
-            r, p = stats.pearsonr(c1_values[indices], c2_values[indices])
-            # print(f'r = {r}, p = {p}')
+        selected = moments.below(math.ceil(threshold1), math.ceil(threshold2))
+        # print(f'T1 = {threshold1}, T2 = {threshold2}, size(indices) = {selected["n"]}')
+        if selected['n'] > 1:
+            r = _pearson(selected)
+            # print(f'r = {r}')
             if abs(r) < rthreshold or (threshold1 == 0 and threshold2 == 0) or niter < 1:
                 stopBoolean = True
                 pass
@@ -78,6 +144,10 @@ def costesthresholdsfast(image: ImageTIFF, channel1: str, channel2: str):
                 threshold2 = (threshold2 + lastpositivet2) // 2
                 pass
             pass
+        elif threshold1 == 0 and threshold2 == 0:
+            # no pixels are left below the thresholds
+            stopBoolean = True
+            pass
         else:
             threshold1 = threshold1 // 2
             threshold2 = threshold2 // 2
@@ -88,15 +158,68 @@ def costesthresholdsfast(image: ImageTIFF, channel1: str, channel2: str):
     return [threshold1, threshold2]
 
 
-def colocalization(img: ImageTIFF, channel1: str, threshold1: int, channel2: str, threshold2: int):
-    c1_values = np.ravel(ImageTIFF.getChannel(img, channel1), order='C')
-    c2_values = np.ravel(ImageTIFF.getChannel(img, channel2), order='C')
-    list1 = np.where(c1_values >= threshold1)
-    list2 = np.where(c2_values >= threshold2)
-    indices = np.intersect1d(list1, list2)
-    outr, outp = stats.pearsonr(c1_values[indices], c2_values[indices])
-    outm1 = np.sum(c1_values[indices]) / np.sum(c1_values)
-    outm2 = np.sum(c2_values[indices]) / np.sum(c2_values)
+def colocalization(img: ImageTIFF | np.ndarray | os.PathLike | str,
+                   channel1: str | int,
+                   threshold1: int,
+                   channel2: str | int,
+                   threshold2: int,
+                   tile_size: tuple[int, int] | int = (1024, 1024),
+                   workers: int | None = None,
+                   executor: Executor | None = None):
+    """
+    Pearson's correlation and Manders' coefficients of the pixels at or above both thresholds. The image is streamed
+    in tiles and only the sums, sums of squares and cross-products of each tile are kept, so memory does not depend on
+    the size of the image and the results are exact.
+    :param img: an ImageTIFF, an array or memmap, or a path to a TIFF image
+    :param channel1:
+    :param threshold1:
+    :param channel2:
+    :param threshold2:
+    :param tile_size: the size of the tiles
+    :param workers: the number of threads to process the tiles on
+    :param executor: a shared executor to process the tiles on in place of *workers*
+    :return: Pearson's r and its p-value, and Manders' M1 and M2
+    """
+    colors = img.colors if isinstance(img, ImageTIFF) else {'red': 0, 'green': 1, 'blue': 2}
+    channel1 = colors[channel1] if isinstance(channel1, str) else channel1
+    channel2 = colors[channel2] if isinstance(channel2, str) else channel2
+
+    sums = {'n': 0, 'x': 0, 'y': 0, 'xx': 0, 'yy': 0, 'xy': 0, 'x_total': 0, 'y_total': 0}
+    with open_tiles(img.lazyArray() if isinstance(img, ImageTIFF) else img) as (read, shape):
+        def tile_sums(tile):
+            return _colocalization_sums(read(*tile[2:]), channel1, threshold1, channel2, threshold2)
+
+        for _, result in map_tiles(tile_sums, tile_bounds(*shape, tile_size), workers=workers, executor=executor):
+            for k, v in result.items():
+                sums[k] += v
+            pass
+        pass
+
+    n = sums['n']
+    if n < 2:
+        raise ValueError('At least 2 pixels must be above both thresholds!')
+    outr = max(min(_pearson(sums), 1.0), -1.0)
+    # two-sided p-value of r under the null hypothesis, as in scipy.stats.pearsonr
+    outp = float(2 * stats.beta(n / 2 - 1, n / 2 - 1, loc=-1, scale=2).sf(abs(outr))) if n > 2 else 1.0
+    outm1 = sums['x'] / sums['x_total']
+    outm2 = sums['y'] / sums['y_total']
     return outr, outp, outm1, outm2
 
 
+def _colocalization_sums(tile: np.ndarray, channel1: int, threshold1: int, channel2: int,
+                         threshold2: int) -> dict[str, int | float]:
+    # sufficient statistics of a tile for Pearson's r and Manders' coefficients
+    c1_values = tile[..., channel1]
+    c2_values = tile[..., channel2]
+    dtype = np.int64 if np.issubdtype(tile.dtype, np.integer) else np.float64
+    selected = (c1_values >= threshold1) & (c2_values >= threshold2)
+    x = c1_values[selected].astype(dtype)
+    y = c2_values[selected].astype(dtype)
+    return {'n': x.size,
+            'x': x.sum().item(),
+            'y': y.sum().item(),
+            'xx': (x @ x).item(),
+            'yy': (y @ y).item(),
+            'xy': (x @ y).item(),
+            'x_total': c1_values.sum(dtype=dtype).item(),
+            'y_total': c2_values.sum(dtype=dtype).item()}
@@ -1,3 +1,10 @@
 from ._test_ImageJ import *
 from ._test_decompress import *
 from ._test_units import *
+from ._test_histogram import *
+from ._test_colocalization import *
+from ._test_processimage import *
+from ._test_imagetiff import *
+from ._test_tilecache import *
+from ._test_RNAscope import *
+from ._test_lut import *
@@ -1,10 +1,14 @@
 import inspect
 
+from concurrent.futures import ThreadPoolExecutor
 from os.path import dirname, join, splitext
+from tempfile import TemporaryDirectory
 
 import numpy as np
+import tifffile
 from PIL import Image
-from ..src.ImageJ import threshold_huang, ParticleAnalyzer, FindMaxima, convert_pixel_to_area, image_size_microns, pixels_per_micron
+from ..src.ImageJ import threshold_huang, ParticleAnalyzer, FindMaxima, convert_pixel_to_area, image_size_microns, pixels_per_micron, \
+    threshold_from_histogram, auto_threshold
 
 
 def test_imagej():
@@ -31,11 +35,55 @@ def _test_maxima():
     # Find Maxima tests
     chunk_size = int(2 ** 14)
     assert 639082 == FindMaxima(image_path, maxima_channel='red', noise_tolerance=1.0)
-    assert 639116 == FindMaxima(image_path, maxima_channel='red', noise_tolerance=1.0,
+    assert 639082 == FindMaxima(image_path, maxima_channel='red', noise_tolerance=1.0,
                                 tile_size=(chunk_size, chunk_size))
     pass
 
 
+def test_maxima_tiles():
+    # Maxima cut by tile borders must be counted once, so every tiling gives the untiled count
+    rng = np.random.default_rng(0)
+    data = np.zeros((300, 400, 3), dtype=np.uint8)
+    points = rng.integers(0, (300, 400), size=(1000, 2))
+    data[points[:, 0], points[:, 1], 0] = rng.integers(50, 255, size=1000)
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'maxima.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', tile=(64, 64), compression='zlib')
+
+        expected = FindMaxima(data, maxima_channel='red', noise_tolerance=20)
+        for tile_size in [(50, 50), (64, 64), (97, 131), (300, 17)]:
+            assert expected == FindMaxima(image_path, maxima_channel='red', noise_tolerance=20, tile_size=tile_size)
+            assert expected == FindMaxima(data, maxima_channel='red', noise_tolerance=20, tile_size=tile_size)
+            pass
+        pass
+    pass
+
+
+def test_maxima_tiles_parallel():
+    # Tiles processed on a thread pool, or on a shared executor, give the serial count
+    rng = np.random.default_rng(0)
+    data = np.zeros((300, 400, 3), dtype=np.uint8)
+    points = rng.integers(0, (300, 400), size=(1000, 2))
+    data[points[:, 0], points[:, 1], 0] = rng.integers(50, 255, size=1000)
+
+    with TemporaryDirectory() as folder_path, ThreadPoolExecutor(max_workers=3) as executor:
+        image_path = join(folder_path, 'maxima.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', tile=(64, 64), compression='zlib')
+
+        for image in [data, image_path]:
+            expected = FindMaxima(image, maxima_channel='red', noise_tolerance=20, tile_size=(64, 64))
+            assert expected == FindMaxima(image, maxima_channel='red', noise_tolerance=20, tile_size=(64, 64),
+                                          workers=4)
+            assert expected == FindMaxima(image, maxima_channel='red', noise_tolerance=20, tile_size=(97, 131),
+                                          workers=4, max_in_flight=2)
+            assert expected == FindMaxima(image, maxima_channel='red', noise_tolerance=20, tile_size=(64, 64),
+                                          executor=executor)
+            pass
+        pass
+    pass
+
+
 def _test_threshold():
     test_image = r"SP-012102_1001.22 adrenal gland_Mfa-SSB-O1_Default_Extendedlf_UNCOMPRESSED.tif"
 
@@ -45,14 +93,169 @@ def _test_threshold():
 
     # Threshold test
     thresholded_image_array = threshold_huang(image_path, threshold_channel='blue')
-    assert 92304771 == np.count_nonzero(thresholded_image_array)
-    assert np.round(5732015.582172504) == np.round(convert_pixel_to_area(np.count_nonzero(thresholded_image_array),
-                                                                         image=image_path))
-    # currently not working in chunks
-    # chunk_size = int(2 ** 12)
-    # thresholded_image_array = threshold_huang(image_path, color_channel='blue', tile_size=(chunk_size, chunk_size))
-    # filebase, ext = splitext(test_image)
-    # threshold_image = join(folder_path, f'{filebase}_THRESHOLD{ext}')
-    # Image.fromarray(thresholded_image_array).save(threshold_image)
-    # print(np.count_nonzero(thresholded_image_array))
+    assert np.round(5732015.582172504) == np.round(convert_pixel_to_area(92304771, image=image_path))
+    chunk_size = int(2 ** 12)
+    tiled_image_array = threshold_huang(image_path, threshold_channel='blue', tile_size=(chunk_size, chunk_size))
+    assert np.count_nonzero(thresholded_image_array) == np.count_nonzero(tiled_image_array)
+    pass
+
+
+def test_threshold_tiles():
+    # Streaming the tiles against one global histogram gives the whole-image mask for every tiling
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(300, 400, 3), dtype=np.uint8)
+    data[..., 2] = np.where(rng.random((300, 400)) < 0.3, rng.normal(180, 15, (300, 400)),
+                            rng.normal(60, 10, (300, 400))).clip(0, 255).astype(np.uint8)
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'threshold.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', tile=(64, 64), compression='zlib')
+
+        for method, white_background in [('huang', True), ('otsu', False)]:
+            expected = auto_threshold(image_path, 'blue', method=method, white_background=white_background)
+            assert 0 < np.count_nonzero(expected) < expected.size
+            for tile_size in [(64, 64), (97, 131), (300, 17)]:
+                tiled = auto_threshold(image_path, 'blue', method=method, tile_size=tile_size,
+                                       white_background=white_background)
+                assert np.array_equal(expected, tiled)
+                pass
+            pass
+
+        # The mask is written into an existing memmap, or into a new TIFF file
+        expected = threshold_huang(image_path, threshold_channel='blue')
+        out = np.memmap(join(folder_path, 'mask.bin'), dtype=bool, mode='w+', shape=(300, 400))
+        assert threshold_huang(image_path, threshold_channel='blue', tile_size=(64, 64), out=out) is out
+        assert np.array_equal(expected, out)
+        del out
+        threshold_huang(image_path, threshold_channel='blue', tile_size=(97, 131), out=join(folder_path, 'mask.tif'))
+        assert np.array_equal(expected, tifffile.imread(join(folder_path, 'mask.tif')).astype(bool))
+        pass
+    pass
+
+
+def test_threshold_methods():
+    # Two well separated modes must be split between the modes by every method
+    rng = np.random.default_rng(0)
+    values = np.concatenate([rng.normal(60, 10, size=20000), rng.normal(180, 15, size=10000)])
+    hist = np.bincount(values.clip(0, 255).astype(np.uint8), minlength=256)
+    for method in ['huang', 'otsu', 'triangle', 'li', 'default']:
+        assert 60 < threshold_from_histogram(hist, method=method) < 180
+        pass
+
+    # Values of ImageJ's AutoThresholder for the same histogram
+    assert 112 == threshold_from_histogram(hist, method='huang')
+    assert 126 == threshold_from_histogram(hist, method='otsu')
+    assert 87 == _reference_triangle(hist) == threshold_from_histogram(hist, method='triangle')
+    assert 109 == _reference_li(hist) == threshold_from_histogram(hist, method='li')
+    assert 119 == _reference_isodata(hist) == threshold_from_histogram(hist, method='isodata')
+    assert 120 == threshold_from_histogram(hist, method='default')
+
+    # The ports match the loops of AutoThresholder on skewed, narrow and sparse histograms, and empty histograms give 0
+    for seed in range(20):
+        rng = np.random.default_rng(seed)
+        values = np.concatenate([rng.normal(rng.uniform(20, 120), rng.uniform(2, 30), size=rng.integers(10, 5000)),
+                                 rng.normal(rng.uniform(120, 240), rng.uniform(2, 30), size=rng.integers(10, 5000))])
+        hist = np.bincount(values.clip(0, 255).astype(np.uint8), minlength=256)
+        assert _reference_triangle(hist) == threshold_from_histogram(hist, method='triangle')
+        assert _reference_li(hist) == threshold_from_histogram(hist, method='li')
+        assert _reference_isodata(hist) == threshold_from_histogram(hist, method='isodata')
+        pass
+    for method in ['huang', 'triangle', 'li', 'isodata']:
+        assert 0 == threshold_from_histogram(np.zeros(256, dtype=np.int64), method=method)
+        pass
+    pass
+
+
+def _reference_triangle(hist: np.ndarray) -> int:
+    # AutoThresholder.Triangle of ImageJ, loop for loop
+    data = [int(v) for v in hist]
+    low = next((i for i in range(256) if data[i] > 0), 0)
+    if low > 0:
+        low -= 1
+    high = next((i for i in range(255, 0, -1) if data[i] > 0), 0)
+    if high < 255:
+        high += 1
+    peak, peak_count = (0, 0)
+    for i in range(256):
+        if data[i] > peak_count:
+            peak, peak_count = (i, data[i])
+        pass
+    inverted = (peak - low) < (high - peak)
+    if inverted:
+        data.reverse()
+        low, peak = (255 - high, 255 - peak)
+    if low == peak:
+        return low
+    nx, ny = (float(data[peak]), float(low - peak))
+    d = (nx * nx + ny * ny) ** 0.5
+    nx, ny = (nx / d, ny / d)
+    d = nx * low + ny * data[low]
+    split, split_distance = (low, 0.0)
+    for i in range(low + 1, peak + 1):
+        distance = nx * i + ny * data[i] - d
+        if distance > split_distance:
+            split, split_distance = (i, distance)
+        pass
+    split -= 1
+    return 255 - split if inverted else split
+
+
+def _reference_li(hist: np.ndarray) -> int:
+    # AutoThresholder.Li of ImageJ, loop for loop
+    data = [int(v) for v in hist]
+    num_pixels = sum(data)
+    if num_pixels == 0:
+        return 0
+    new_thresh = sum(i * data[i] for i in range(256)) / num_pixels
+    while True:
+        old_thresh = new_thresh
+        threshold = int(old_thresh + 0.5)
+        num_back = sum(data[:threshold + 1])
+        sum_back = sum(i * data[i] for i in range(threshold + 1))
+        num_obj = sum(data[threshold + 1:])
+        sum_obj = sum(i * data[i] for i in range(threshold + 1, 256))
+        mean_back = sum_back / num_back if num_back else 0.0
+        mean_obj = sum_obj / num_obj if num_obj else 0.0
+        temp = (mean_back - mean_obj) / (np.log(mean_back) - np.log(mean_obj))
+        new_thresh = int(temp - 0.5) if temp < -2.220446049250313e-16 else int(temp + 0.5)
+        if abs(new_thresh - old_thresh) <= 0.5:
+            return threshold
+        pass
+
+
+def _reference_isodata(hist: np.ndarray) -> int:
+    # AutoThresholder.IsoData of ImageJ, loop for loop
+    data = [int(v) for v in hist]
+    g = next((i + 1 for i in range(1, 256) if data[i] > 0), 0)
+    while True:
+        total_low = sum(data[:g + 1])
+        low = sum(i * data[i] for i in range(g + 1))
+        total_high = sum(data[g + 1:])
+        high = sum(i * data[i] for i in range(g + 1, 256))
+        if total_low > 0 and total_high > 0:
+            low //= total_low
+            high //= total_high
+            if g == int(np.floor((low + high) / 2.0 + 0.5)):
+                return g
+        g += 1
+        if g > 254:
+            return 0
+        pass
+
+
+def test_threshold_16bit():
+    # 16-bit data cannot be binned into 256 levels, so the tiled and untiled paths both reject it
+    data = np.random.default_rng(0).integers(0, 65536, size=(64, 80, 3), dtype=np.uint16)
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'image16.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', tile=(32, 32))
+        for tile_size in [None, (32, 32)]:
+            try:
+                threshold_huang(image_path, threshold_channel='blue', tile_size=tile_size)
+                raise AssertionError('16-bit data was not rejected')
+            except TypeError:
+                pass
+            pass
+        pass
     pass
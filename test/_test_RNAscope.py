@@ -0,0 +1,213 @@
+import csv
+import os
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import tifffile
+
+from ..src import ImageTIFF, compile_lut, apply_lut
+from ..src.ImageJ import FindMaxima, threshold_huang, options, convert_pixel_to_area, image_size_microns
+from ..src.RNAscope import thresholdchannel, redish, getcounts
+from ..src.RNAscope._getcounts import _getcounts_fused, _worker_memory
+from ..src.RNAscope._thesholdchannel import _redish
+
+
+def test_thresholdchannel():
+    # Red dots are inverted on a white background, everything else is cleared
+    pixels = np.array([[[200, 50, 50], [50, 50, 50], [200, 200, 200], [90, 200, 80]]], dtype=np.uint8)
+    assert [55, 0, 0, 0] == thresholdchannel(pixels, loop=False)[0, :, 0].tolist()
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(300, 500, 3), dtype=np.uint8)
+    expected = thresholdchannel(data, loop=False)
+    assert np.array_equal(data[..., 1:], expected[..., 1:])
+    mask = redish(data[..., 0], data[..., 1], data[..., 2])
+    assert np.array_equal(np.where(mask, 255 - data[..., 0], 0), expected[..., 0])
+    assert np.array_equal(np.where(mask, data[..., 0], 0), thresholdchannel(data, whitebackground=False)[..., 0])
+
+    # The result is written into the image itself or into the buffer given
+    inplace = data.copy()
+    assert thresholdchannel(inplace, inplace=True) is inplace
+    assert np.array_equal(expected, inplace)
+    out = np.empty_like(data)
+    assert thresholdchannel(data, out=out) is out
+    assert np.array_equal(expected, out)
+    view = data.copy()
+    assert np.array_equal(expected, thresholdchannel(view, out=view[...]))
+    try:
+        overlap = np.concatenate([data, data[:1]])
+        thresholdchannel(overlap[1:], out=overlap[:-1])
+        raise AssertionError('the overlapping buffer was not rejected')
+    except ValueError:
+        pass
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'image.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb')
+
+        # A memmap is thresholded in place
+        memmap = tifffile.memmap(join(folder_path, 'memmap.tif'), shape=data.shape, dtype=data.dtype,
+                                 photometric='rgb')
+        memmap[...] = data
+        thresholdchannel(memmap, inplace=True)
+        memmap.flush()
+        assert np.array_equal(expected, tifffile.imread(join(folder_path, 'memmap.tif')))
+        del memmap
+
+        # Tiles of the tile view and the whole image give the same result
+        for loop in [True, False]:
+            img = ImageTIFF(image_path, isbgr=False, tilesize=128, image_library='PIL')
+            assert np.array_equal(expected, thresholdchannel(img, loop=loop).image)
+            pass
+        pass
+    pass
+
+
+def test_getcounts_fused():
+    # Bright dots on the red channel and a dark tissue blob on the blue channel of a white background
+    rng = np.random.default_rng(0)
+    height, width = (300, 260)
+    data = np.full((height, width, 3), 230, dtype=np.uint8)
+    y, x = np.mgrid[:height, :width]
+    tissue = (y - 150) ** 2 / 100 ** 2 + (x - 130) ** 2 / 90 ** 2 < 1
+    data[..., 2] = np.where(tissue, rng.integers(40, 120, size=(height, width)), rng.integers(200, 256,
+                                                                                               size=(height, width)))
+    data[..., 0] = rng.integers(0, 60, size=(height, width))
+    dots = (rng.integers(0, height, size=80), rng.integers(0, width, size=80))
+    data[..., 0][dots] = 250
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'image.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', tile=(64, 64), compression='zlib',
+                         resolution=(20000, 20000), resolutionunit='CENTIMETER')
+        num_maxima = FindMaxima(image_path, 'red', noise_tolerance=20, neighborhood_size=3)
+        height_microns, width_microns = image_size_microns(image_path)
+
+        for options_size, save in [(1, False), (3, False), (3, True)]:
+            save_dir = folder_path if save else None
+            result = _getcounts_fused(image_path, threshold_channel='blue', maxima_channel='red',
+                                      tile_size=(100, 100), options_size=options_size, iterations=2,
+                                      save_threshold_image_dir=save_dir)
+
+            # The unfused pipeline: Huang threshold, dilate and close, then count the nonzero pixels
+            mask = threshold_huang(image_path, 'blue').astype(np.uint8) * np.uint8(255)
+            mask = options(mask, option='dilate', options_size=options_size, iterations=2)
+            mask = options(mask, option='dilate', options_size=options_size, iterations=2)
+            tissue_area = convert_pixel_to_area(np.count_nonzero(mask), image=image_path)
+
+            assert result[:3] == ['image.tif', folder_path, num_maxima]
+            assert np.isclose(tissue_area, result[3])
+            assert np.isclose(height_microns * width_microns, result[4])
+            if save:
+                assert np.array_equal(mask, tifffile.imread(join(folder_path, 'image_THRESHOLD.tif')))
+            pass
+        pass
+    pass
+
+
+def test_getcounts_resume():
+    with TemporaryDirectory() as folder_path:
+        inputdir, outputdir = (join(folder_path, 'input'), join(folder_path, 'output'))
+        os.makedirs(inputdir)
+        os.makedirs(outputdir)
+        imagepaths = [join(inputdir, f'image{i}.tif') for i in range(3)]
+        for imagepath in imagepaths:
+            tifffile.imwrite(imagepath, np.zeros((16, 16, 3), dtype=np.uint8), photometric='rgb')
+            pass
+
+        # An interrupted run: the first image is done and the row of the second was cut short by a crash
+        output_file = join(outputdir, 'counts.csv')
+        with open(output_file, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(['Image Name', 'Directory Path', 'Dot Maxima'])
+            writer.writerow(['image0.tif', inputdir, 'done'])
+            f.write(f'image1.tif\t{inputdir}')
+            pass
+
+        getcounts(inputdir, outputdir, output_file='counts.csv', func=_count_row)
+        with open(output_file, 'r', encoding='utf-8', newline='') as f:
+            rows = [row for row in csv.reader(f, delimiter='\t') if len(row) == 3]
+        assert [['image0.tif', inputdir, 'done']] + [[f'image{i}.tif', inputdir, 'counted'] for i in [1, 2]] == \
+            sorted(rows[1:])
+        pass
+    pass
+
+
+def _count_row(imagepath, **kwargs) -> list:
+    return [os.path.basename(imagepath), os.path.dirname(imagepath), 'counted']
+
+
+def test_worker_memory():
+    # Half of the physical memory is shared between the workers, up to 24 GB each
+    gb = 2 ** 30
+    assert '8192m' == _worker_memory(None, total=16 * gb)
+    assert '8192m' == _worker_memory(1, total=16 * gb)
+    assert '2048m' == _worker_memory(4, total=16 * gb)
+    assert '24576m' == _worker_memory(2, total=256 * gb)
+    assert '1m' == _worker_memory(8, total=2 ** 20)
+    assert 0 < int(_worker_memory(2)[:-1]) <= 24 * 1024
+    pass
+
+
+def test_redish_reference():
+    # Every color of the RGB cube, in blocks of 16 red levels
+    levels = np.arange(256, dtype=np.uint8)
+    lut = compile_lut(redish, cache_dir='')
+    for start in range(0, 256, 16):
+        red, green, blue = np.meshgrid(levels[start:start + 16], levels, levels, indexing='ij')
+        expected = _reference_redish(red, green, blue)
+        assert np.array_equal(expected, _redish(red, green, blue))
+        assert np.array_equal(expected, redish(red, green, blue))
+        assert np.array_equal(expected, apply_lut(lut, red, green, blue))
+        pass
+
+    # Channels that are not 8-bit cannot be looked up, so they are classified directly
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 1024, size=(3, 200, 300), dtype=np.uint16)
+    expected = redish(*colors)
+    assert np.array_equal(expected, _redish(*colors))
+    out = np.zeros(colors.shape[1:], dtype=bool)
+    assert _redish(*colors, out=out) is out and np.array_equal(expected, out)
+    pass
+
+
+def _reference_redish(r, g, b):
+    # The per-pixel classifier of thresholdchannel before the table lookups
+    cutoff = np.uint(85)
+    red_mask = r > cutoff
+
+    def isnotred_greencorrection(red, green, blue, mask):
+        result = np.zeros_like(red, dtype=bool)
+        result[mask] = np.logical_and.reduce([green[mask] > cutoff,
+                                              blue[mask] > cutoff,
+                                              red[mask] > green[mask] * 1,
+                                              green[mask] > blue[mask] * 1.15])
+        return result
+
+    def isred_bluecorrection(red, green, blue, mask):
+        red_blue_max = np.maximum(red[mask], blue[mask])
+        result = np.zeros_like(red, dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[mask] = np.logical_and.reduce([red[mask] > green[mask] * 1.1,
+                                                  red[mask] > blue[mask] * 1.1,
+                                                  1 - (red[mask] / red_blue_max) <= 0.15,
+                                                  1 - (blue[mask] / red_blue_max) <= 0.15])
+        return result
+
+    def isred(red, green, blue, mask):
+        mean = np.mean(np.stack((green[mask], blue[mask]), axis=-1), axis=-1)
+        green_diff = np.abs(green[mask] - mean)
+        blue_diff = np.abs(blue[mask] - mean)
+        red_green_condition = np.logical_and(red[mask] > green[mask] * 1.3, red[mask] > blue[mask] * 1.3)
+        red_offset_condition = np.logical_and.reduce([green_diff < mean * 0.15,
+                                                      blue_diff < mean * 0.15,
+                                                      red[mask] > green[mask] * 1.15,
+                                                      red[mask] > blue[mask] * 1.15])
+        result = np.zeros_like(red, dtype=bool)
+        result[mask] = np.logical_or(red_green_condition, red_offset_condition)
+        return result
+
+    return np.logical_and(np.logical_not(isnotred_greencorrection(r, g, b, red_mask)),
+                          np.logical_or(isred(r, g, b, red_mask), isred_bluecorrection(r, g, b, red_mask)))
+
@@ -0,0 +1,130 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import math
+import warnings
+
+import numpy as np
+import scipy.stats as stats
+import tifffile
+
+from ..src.colocalization import colocalization, costesthresholds, costesthresholdsfast
+
+
+def test_colocalization():
+    rng = np.random.default_rng(0)
+    c1 = rng.integers(0, 256, size=(300, 400))
+    c2 = (0.5 * c1 + rng.normal(60, 40, size=c1.shape)).clip(0, 255)
+    data = np.stack([c1, c2, np.zeros_like(c1)], axis=-1).astype(np.uint8)
+
+    # Reference values from the whole channels
+    selected = (data[..., 0] >= 50) & (data[..., 1] >= 70)
+    x, y = (data[..., 0][selected].astype(float), data[..., 1][selected].astype(float))
+    r, p = stats.pearsonr(x, y)
+    m1, m2 = (x.sum() / data[..., 0].sum(), y.sum() / data[..., 1].sum())
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'colocalization.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', tile=(64, 64), compression='zlib')
+
+        for image, workers in [(image_path, None), (data, None), (image_path, 4)]:
+            result = colocalization(image, 'red', 50, 'green', 70, tile_size=(100, 150), workers=workers)
+            assert np.allclose((r, p, m1, m2), result, rtol=1e-12, atol=0)
+            pass
+        pass
+    pass
+
+
+def test_costes():
+    # Anti-correlated channels stop the search at the first step
+    rng = np.random.default_rng(0)
+    c1 = rng.integers(0, 256, size=(200, 300))
+    c2 = (255 - c1 + rng.normal(0, 60, size=c1.shape)).clip(0, 255)
+    data = np.stack([c1, c2, np.zeros_like(c1)], axis=-1).astype(np.uint8)
+    threshold = int(data.max()) // 10
+    assert [threshold + 1, threshold + 1] == costesthresholds(data, 'red', 'green')
+    pass
+
+
+def test_costes_search():
+    rng = np.random.default_rng(0)
+    shape = (200, 300)
+
+    # Weakly correlated bright pixels with anti-correlated pairs at 12 and 240, which only count below a threshold of 12
+    c1 = rng.integers(30, 256, size=shape).astype(float)
+    c2 = (0.3 * c1 + rng.integers(30, 180, size=shape)).clip(0, 255)
+    anti, flip = (rng.random(shape) < 0.3, rng.random(shape) < 0.5)
+    c1, c2 = (np.where(anti, np.where(flip, 12, 240), c1), np.where(anti, np.where(flip, 240, 12), c2))
+    data = np.stack([c1, c2, np.zeros_like(c1)], axis=-1).astype(np.uint8)
+    assert [12, 12] == _costes_reference(data) == costesthresholds(data, 'red', 'green')
+
+    # Correlated channels, with and without an uncorrelated background
+    for seed in range(4):
+        rng = np.random.default_rng(seed)
+        c1 = rng.integers(0, 256, size=shape)
+        c2 = (0.6 * c1 + rng.normal(40, 30, size=shape)).clip(0, 255)
+        if seed % 2:
+            background = rng.random(shape) < 0.5
+            c1 = np.where(background, rng.integers(0, 26, size=shape), c1)
+            c2 = np.where(background, (25 - c1 + rng.normal(0, 3, size=shape)).clip(0, 255), c2)
+        data = np.stack([c1, c2, np.zeros_like(c1)], axis=-1).astype(np.uint8)
+        assert _costes_reference(data) == costesthresholds(data, 'red', 'green')
+        assert _costes_fast_reference(data) == costesthresholdsfast(data, 'red', 'green')
+        pass
+
+    # No pixels are ever below both thresholds, so the bisection stops once both thresholds reach 0
+    data = np.zeros((20, 20, 3), dtype=np.uint8)
+    data[::2, :, :2] = (200, 10)
+    data[1::2, :, :2] = (10, 200)
+    assert [0, 0] == _costes_fast_reference(data) == costesthresholdsfast(data, 'red', 'green')
+    pass
+
+
+def _pearsonr(x: np.ndarray, y: np.ndarray) -> float:
+    with warnings.catch_warnings():
+        # constant inputs give nan
+        warnings.simplefilter('ignore')
+        return stats.pearsonr(x.astype(float), y.astype(float))[0]
+
+
+def _costes_reference(data: np.ndarray) -> list:
+    # costesthresholds with masks of the pixels in place of the joint histogram
+    c1, c2 = (data[..., 0], data[..., 1])
+    threshold = int(data[..., :2].max()) // 10
+    for i in range(threshold):
+        selected = (c1 > threshold - i) & (c2 > threshold - i)
+        if selected.sum() >= 2 and _pearsonr(c1[selected], c2[selected]) <= 0:
+            return [threshold - i + 1, threshold - i + 1]
+    return [threshold, threshold]
+
+
+def _costes_fast_reference(data: np.ndarray) -> list:
+    # costesthresholdsfast with masks of the pixels in place of the joint histogram
+    c1, c2 = (data[..., 0], data[..., 1])
+    threshold1, threshold2 = ((int(c1.max()) + c1.mean()) // 2, (int(c2.max()) + c2.mean()) // 2)
+    previous1, previous2, positive1, positive2 = (threshold1, threshold2, threshold1, threshold2)
+    niter = math.ceil(math.log2(int(data[..., :2].max())))
+    while True:
+        selected = (c1 < math.ceil(threshold1)) & (c2 < math.ceil(threshold2))
+        if selected.sum() > 1:
+            r = _pearsonr(c1[selected], c2[selected])
+            if abs(r) < 1e-13 or (threshold1 == 0 and threshold2 == 0) or niter < 1:
+                break
+            elif r > 0:
+                if previous1 < threshold1 and previous2 < threshold2:
+                    positive1, positive2 = (threshold1, threshold2)
+                    threshold1, threshold2 = ((threshold1 + previous1) // 2, (threshold2 + previous2) // 2)
+                else:
+                    positive1, positive2 = (threshold1, threshold2)
+                    threshold1, threshold2 = (threshold1 // 2, threshold2 // 2)
+                previous1, previous2 = (positive1, positive2)
+            elif r < 0:
+                previous1, previous2 = (threshold1, threshold2)
+                threshold1, threshold2 = ((threshold1 + positive1) // 2, (threshold2 + positive2) // 2)
+        elif threshold1 == 0 and threshold2 == 0:
+            break
+        else:
+            threshold1, threshold2 = (threshold1 // 2, threshold2 // 2)
+            previous1, previous2 = (threshold1, threshold2)
+        niter -= 1
+    return [threshold1, threshold2]
@@ -1,7 +1,13 @@
+import os
 from os.path import dirname, join, getsize
 from os import remove
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import tifffile
 
 from ..src import decompress, copy, copy_image
+from ..src import _decompress
 
 
 def test_decompress():
@@ -22,3 +28,118 @@ def test_decompress():
     # print(f'size: {getsize(copy_image_file)}')
     # assert 670433680 == getsize(copy_image_file)
     pass
+
+
+def test_decompress_segments():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(300, 250, 3), dtype=np.uint8)
+
+    with TemporaryDirectory() as folder_path:
+        # Compressed tiles and strips with partial segments at the edges, and separate color planes
+        writes = {'tiled.tif': dict(tile=(64, 64), compression='zlib'),
+                  'strips.tif': dict(rowsperstrip=70, compression='lzw'),
+                  'planar.tif': dict(tile=(32, 48), compression='zstd', planarconfig='separate')}
+        for name, kwargs in writes.items():
+            image = np.moveaxis(data, -1, 0) if kwargs.get('planarconfig') else data
+            tifffile.imwrite(join(folder_path, name), image, photometric='rgb', resolution=(4, 4), **kwargs)
+            decompress_file = decompress(join(folder_path, name), join(folder_path, 'out'), workers=3,
+                                         use_tqdm=False)
+            with tifffile.TiffFile(decompress_file) as tif:
+                page = tif.pages[0]
+                assert page.is_contiguous and page.compression == 1
+                assert page.tags['XResolution'].value == (4, 1)
+                assert np.array_equal(data, page.asarray())
+            pass
+        pass
+    pass
+
+
+def test_copy():
+    data = np.random.default_rng(0).integers(0, 256, size=int(2 ** 20) + 123, dtype=np.uint8).tobytes()
+
+    with TemporaryDirectory() as folder_path:
+        src_file = join(folder_path, 'file.bin')
+        with open(src_file, 'wb') as f:
+            f.write(data)
+            pass
+
+        # Copies in the same directory are suffixed, and chunks smaller than the file are copied in several steps
+        for dest_dir, chunk_size in [(folder_path, int(2 ** 16)), (join(folder_path, 'out'), int(2 ** 24))]:
+            copy_file = copy(src_file, dest_dir, chunk_size=chunk_size, use_tqdm=False)
+            assert copy_file == join(dest_dir, 'file_COPY.bin' if dest_dir == folder_path else 'file.bin')
+            with open(copy_file, 'rb') as f:
+                assert data == f.read()
+            pass
+
+        # Without reflinks or in-kernel copies, the bytes are copied through a buffer
+        patched = {name: getattr(os, name) for name in ('copy_file_range', 'sendfile') if hasattr(os, name)}
+        fcntl = _decompress.fcntl
+        _decompress.fcntl = None
+        for name in patched:
+            setattr(os, name, _unsupported)
+            pass
+        try:
+            copy_file = copy(src_file, join(folder_path, 'buffered'), chunk_size=int(2 ** 16), use_tqdm=False)
+            with open(copy_file, 'rb') as f:
+                assert data == f.read()
+            pass
+        finally:
+            _decompress.fcntl = fcntl
+            for name, method in patched.items():
+                setattr(os, name, method)
+                pass
+        pass
+    pass
+
+
+def _unsupported(*args):
+    raise OSError('unsupported')
+
+
+def test_copy_image():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(300, 250, 3), dtype=np.uint8)
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'image.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', rowsperstrip=70, compression='lzw', resolution=(4, 4))
+
+        # Strips are re-tiled and re-encoded, and partial tiles at the edges are kept
+        copy_file = copy_image(image_path, join(folder_path, 'out'), tile_size=64, compression='zstd', workers=3,
+                               max_in_flight=2, use_tqdm=False)
+        with tifffile.TiffFile(copy_file) as tif:
+            page = tif.pages[0]
+            assert (page.tilelength, page.tilewidth) == (64, 64)
+            assert page.compression == tifffile.COMPRESSION.ZSTD
+            assert page.tags['XResolution'].value == (4, 1)
+            assert np.array_equal(data, page.asarray())
+
+        # Pyramid levels in SubIFDs and associated pages are copied with their descriptions
+        pyramid_path = join(folder_path, 'pyramid.tif')
+        description = 'Aperio Image Library v12.0.15\n300x250 [0,0 300x250] (256x256) JPEG/RGB Q=70|MPP = 0.2498'
+        levels = [data, data[::2, ::2], data[::4, ::4]]
+        label = rng.integers(0, 256, size=(40, 60, 3), dtype=np.uint8)
+        with tifffile.TiffWriter(pyramid_path) as tif:
+            tif.write(levels[0], photometric='rgb', tile=(32, 32), subifds=2, description=description, metadata=None,
+                      software='Aperio')
+            for level in levels[1:]:
+                tif.write(level, photometric='rgb', tile=(32, 32), subfiletype=1, metadata=None)
+                pass
+            tif.write(label, photometric='rgb', subfiletype=1, description='label 60x40', metadata=None)
+            pass
+        copy_file = copy_image(pyramid_path, join(folder_path, 'out'), tile_size=None, workers=3, use_tqdm=False)
+        with tifffile.TiffFile(copy_file) as tif:
+            assert 2 == len(tif.pages)
+            page = tif.pages[0]
+            assert description == page.description
+            assert 'Aperio' == page.tags['Software'].value
+            assert np.array_equal(data, page.asarray())
+            assert 2 == len(page.pages)
+            for level, subifd in zip(levels[1:], page.pages):
+                assert subifd.subfiletype == 1
+                assert np.array_equal(level, subifd.asarray())
+                pass
+            assert 'label 60x40' == tif.pages[1].description
+            assert np.array_equal(label, tif.pages[1].asarray())
+        pass
+    pass
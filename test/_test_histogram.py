@@ -0,0 +1,51 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import tifffile
+
+from ..src import channel_histograms
+
+
+def test_histogram():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(300, 400, 3), dtype=np.uint8)
+    expected = np.stack([np.bincount(data[..., c].ravel(), minlength=256) for c in range(3)])
+    expected_joint, _, _ = np.histogram2d(data[..., 0].ravel(), data[..., 1].ravel(),
+                                          bins=256, range=[[0, 256], [0, 256]])
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'histogram.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', tile=(64, 64), compression='zlib')
+
+        # Tiles read from the TIFF, tiles sliced from the array, and tiles counted on threads must agree
+        for image, workers in [(image_path, None), (data, None), (image_path, 4)]:
+            histograms, joint = channel_histograms(image, ['red', 'green', 'blue'], joint=('red', 'green'),
+                                                   tile_size=(100, 150), workers=workers)
+            assert np.array_equal(expected, histograms)
+            assert np.array_equal(expected_joint, joint)
+            pass
+        pass
+    pass
+
+
+def test_histogram_grayscale():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(64, 80), dtype=np.uint8)
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'grayscale.tif')
+        tifffile.imwrite(image_path, data, tile=(32, 32))
+
+        # Single-channel tiles are 2-D, so the whole tile is counted
+        histograms, _ = channel_histograms(image_path, [0], tile_size=(40, 50))
+        assert np.array_equal(np.bincount(data.ravel(), minlength=256), histograms[0])
+        for channel, image, error in [(1, image_path, IndexError), (0, data.astype(np.uint16) * 256, TypeError)]:
+            try:
+                channel_histograms(image, [channel])
+                raise AssertionError(f'{error.__name__} was not raised')
+            except error:
+                pass
+            pass
+        pass
+    pass
@@ -0,0 +1,117 @@
+import threading
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import tifffile
+
+from ..src import ImageTIFF
+from ..src._imagetiff import _GDALArray
+
+
+def test_imagetiff_lazy():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 200, size=(300, 500, 3), dtype=np.uint8)
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'image.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', tile=(64, 64), compression='zlib')
+
+        # Nothing but the header is read until the pixels are used
+        img = ImageTIFF(image_path, isbgr=False)
+        assert not img.isLoaded()
+        assert (300, 500, 3) == img.shape()
+        assert np.array_equal(data[..., 2], img.getChannel('blue'))
+        assert np.array_equal(data, img.getTile(0, 0))
+        assert int(data.max()) == img.maxvalue
+        assert not img.isLoaded()
+
+        assert np.array_equal(data, img.image)
+        assert img.isLoaded()
+
+        # Tiles at the edges of the image are partial
+        img = ImageTIFF(image_path, isbgr=False, tilesize=128, image_library='dask')
+        assert np.array_equal(data[256:, 384:], img.getTile(2, 3))
+        assert int(data.max()) == img.maxvalue
+
+        # The file is closed once the image is saved, and by the context manager
+        img.saveDask(folder_path, 'saved')
+        assert img.source._tif is None
+        with ImageTIFF(image_path, isbgr=False) as img:
+            assert np.array_equal(data[..., 0], img.getChannel('red'))
+            pass
+        assert img.source._tif is None
+        pass
+    pass
+
+
+def test_imagetiff_tiles():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(300, 500, 3), dtype=np.uint8)
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'image.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb')
+
+        # The tiles, including the partial tiles at the edges, are views of the image
+        img = ImageTIFF(image_path, isbgr=False, tilesize=128, image_library='PIL')
+        assert (3, 4) == img.num_tiles
+        assert np.array_equal(data[256:, 384:], img.tiles[2, 3, :44, :116])
+        img.tiles[2, 3] = 0
+        assert not img.image[256:, 384:].any()
+        assert np.shares_memory(img.collapse(), img.tiles)
+
+        img.saveRGB(folder_path, 'saved')
+        data[256:, 384:] = 0
+        assert np.array_equal(data, tifffile.imread(join(folder_path, 'saved.tif')))
+        pass
+    pass
+
+
+def test_gdal_array_indexing():
+    data = np.arange(5 * 7 * 3).reshape((5, 7, 3))
+
+    # Only the windows read by ReadAsArray are indexed, so an in-memory dataset stands in for GDAL
+    class _Dataset:
+        def ReadAsArray(self, xoff, yoff, xsize, ysize):
+            # GDAL rejects empty windows
+            assert xsize > 0 and ysize > 0
+            return np.moveaxis(data[yoff:yoff + ysize, xoff:xoff + xsize], -1, 0)
+        pass
+
+    arr = object.__new__(_GDALArray)
+    arr.path, arr._ds, arr._lock, arr.shape, arr.dtype = ('', _Dataset(), threading.Lock(), data.shape, data.dtype)
+    for key in [-1, (-1, -2), (slice(1, None, 2), 3), (Ellipsis, 1), (slice(-3, None), slice(5, 2)), slice(5, 5),
+                (slice(2, 4), slice(3, 3), 0)]:
+        assert data[key].shape == arr[key].shape
+        assert np.array_equal(data[key], arr[key])
+        pass
+    for key, error in [(slice(None, None, -1), ValueError), (5, IndexError), ((0, 'a'), TypeError)]:
+        try:
+            arr[key]
+            raise AssertionError(f'{key} was not rejected')
+        except error:
+            pass
+        pass
+    pass
+
+
+def test_imagetiff_gdal():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(300, 500, 3), dtype=np.uint8)
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'image.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', tile=(64, 64), compression='zlib')
+
+        # Windows of the raster are read by GDAL and indexed like the array
+        img = ImageTIFF(image_path, isbgr=False, tilesize=128, image_library='gdal')
+        for key in [-1, (slice(10, 250, 3), slice(-40, None)), (Ellipsis, 2), slice(5, 5)]:
+            assert np.array_equal(data[key], img.source[key])
+            pass
+        assert np.array_equal(data, img.asarray())
+
+        img.saveGDAL(folder_path, 'saved')
+        assert np.array_equal(data, tifffile.imread(join(folder_path, 'saved.tif')))
+        pass
+    pass
@@ -0,0 +1,49 @@
+from os import listdir
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from ..src import compile_lut, apply_lut
+from ..src._lut import _compile_lut
+
+
+def _bright(red, green, blue, cutoff=100):
+    return (red.astype(np.uint16) + green + blue) > 3 * cutoff
+
+
+def test_lut():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(300, 500, 3), dtype=np.uint8)
+    red, green, blue = (data[..., 0], data[..., 1], data[..., 2])
+
+    with TemporaryDirectory() as folder_path:
+        # Each set of parameters is compiled once and cached on disk
+        for cutoff in [100, 150]:
+            lut = compile_lut(_bright, cache_dir=folder_path, cutoff=cutoff)
+            assert np.array_equal(_bright(red, green, blue, cutoff=cutoff), apply_lut(lut, red, green, blue))
+            pass
+        assert 2 == len(listdir(folder_path))
+
+        # Closures of the same factory are different predicates, also when their tables are read from disk
+        def above(cutoff):
+            return lambda r, g, b: r > cutoff
+
+        pixel = np.full((1, 1), 150, dtype=np.uint8)
+        for cutoff in [100, 200]:
+            _compile_lut.cache_clear()
+            lut = compile_lut(above(cutoff), cache_dir=folder_path)
+            assert (150 > cutoff) == apply_lut(lut, pixel, pixel, pixel)[0, 0]
+            pass
+
+        # Unhashable parameters skip the memory cache, and each version of a predicate has its own table on disk
+        lut = compile_lut(_weighted, cache_dir=folder_path, weights=[1, 0, 0])
+        assert np.array_equal(red > 100, apply_lut(lut, red, green, blue))
+        count = len(listdir(folder_path))
+        compile_lut(_bright, cache_dir=folder_path, version=2, cutoff=100)
+        assert count + 1 == len(listdir(folder_path))
+        pass
+    pass
+
+
+def _weighted(red, green, blue, weights=(1, 1, 1)):
+    return (red * weights[0] + green.astype(np.uint16) * weights[1] + blue.astype(np.uint16) * weights[2]) > 100
@@ -0,0 +1,151 @@
+import threading
+from os import listdir
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import tifffile
+
+from ..src._processimage import processimage, processimages_pool, estimate_memory, _ImageScheduler, \
+    _ImageLog
+
+
+def _invert(tile: np.ndarray) -> np.ndarray:
+    return 255 - tile
+
+
+def test_processimage_engines():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(300, 500, 3), dtype=np.uint8)
+    expected = _invert(data)
+
+    for image_library in ['tifffile', 'memmap', 'dask']:
+        for layout in [dict(tile=(64, 64), compression='zlib'), dict(rowsperstrip=37), {}]:
+            with TemporaryDirectory() as folder_path:
+                image_path = join(folder_path, 'image.tif')
+                tifffile.imwrite(image_path, data, photometric='rgb', resolution=(1000, 2000),
+                                 resolutionunit='CENTIMETER', **layout)
+
+                processimage(_invert, image_path, out=folder_path, tilesize=100, image_library=image_library)
+                with tifffile.TiffFile(join(folder_path, 'image_Processed.tif')) as tif:
+                    assert np.array_equal(expected, tif.asarray())
+                    assert (1000, 1) == tif.pages[0].tags['XResolution'].value
+                    pass
+                pass
+            pass
+        pass
+    pass
+
+
+def test_processimages_pool():
+    data = np.random.default_rng(0).integers(0, 256, size=(100, 120, 3), dtype=np.uint8)
+
+    with TemporaryDirectory() as folder_path:
+        imagepaths = []
+        for i in range(3):
+            imagepaths.append(join(folder_path, f'image{i}.tif'))
+            tifffile.imwrite(imagepaths[-1], data, photometric='rgb')
+            pass
+        imagepaths.append(join(folder_path, 'missing.tif'))
+
+        # Every image is summarized and the image that fails is logged
+        summary = processimages_pool(_invert, imagepaths, processes=2, max_in_flight=2, logdir=folder_path,
+                                     out=folder_path, image_library='tifffile')
+        assert set(imagepaths) == set(summary)
+        assert ['done'] * 3 + ['error'] == [summary[imagepath]['status'] for imagepath in imagepaths]
+        for i in range(3):
+            assert np.array_equal(_invert(data), tifffile.imread(join(folder_path, f'image{i}_Processed.tif')))
+            pass
+        logname = [name for name in listdir(folder_path) if name.startswith('log')][0]
+        with open(join(folder_path, logname)) as logfile:
+            assert logfile.read().startswith(imagepaths[-1])
+        pass
+    pass
+
+
+def test_memory_scheduler():
+    # The largest image that fits is admitted first, and an image runs on its own when nothing else fits
+    scheduler = _ImageScheduler({'a': 60, 'b': 50, 'c': 30, 'd': 20, 'e': 150}, 10, 100)
+    admitted = scheduler.admit()
+    assert 'e' == next(admitted)
+    scheduler.release('e')
+    assert ['a', 'c'] == [next(admitted), next(admitted)]
+    scheduler.release('a')
+    assert 'b' == next(admitted)
+    assert (2, 80) == (scheduler.in_flight, scheduler.memory)
+    scheduler.release('b')
+    assert 'd' == next(admitted)
+    scheduler.release('c')
+    scheduler.release('d')
+    assert (0, 0) == (scheduler.in_flight, scheduler.memory)
+
+    # Closing the scheduler returns from an admission that is waiting for memory
+    for images, budget in [({'a': 60, 'b': 50}, 100), (['a', 'b'], None)]:
+        scheduler = _ImageScheduler(images, 1, budget)
+        admitted = scheduler.admit()
+        assert 'a' == next(admitted)
+        waiting = threading.Thread(target=list, args=(admitted,))
+        waiting.start()
+        scheduler.close()
+        waiting.join(timeout=10)
+        assert not waiting.is_alive()
+        pass
+
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'image.tif')
+        tifffile.imwrite(image_path, np.zeros((4096, 4096, 3), dtype=np.uint8), photometric='rgb', tile=(256, 256))
+
+        # Whole images are held by PIL, tiles by the memmap engine
+        assert estimate_memory(image_path, image_library='pil') > 3 * 4096 * 4096 * 3
+        assert estimate_memory(image_path, image_library='memmap') < estimate_memory(image_path, image_library='pil')
+        assert 0 == estimate_memory(join(folder_path, 'missing.tif'))
+
+        summary = processimages_pool(_invert, [image_path], processes=2, memory_budget='1g', out=folder_path)
+        assert 'done' == summary[image_path]['status']
+
+        # A budget that fits one image at a time hands out single images, since a chunk would wait to be filled
+        imagepaths = []
+        for i in range(3):
+            imagepaths.append(join(folder_path, f'small{i}.tif'))
+            tifffile.imwrite(imagepaths[-1], np.zeros((64, 64, 3), dtype=np.uint8), photometric='rgb')
+            pass
+        summary = processimages_pool(_invert, imagepaths, processes=2, memory_budget=1, out=folder_path)
+        assert all('done' == summary[imagepath]['status'] for imagepath in imagepaths)
+        try:
+            processimages_pool(_invert, imagepaths, processes=2, chunksize=2, memory_budget=1, out=folder_path)
+            raise AssertionError('a chunksize with a budget was not rejected')
+        except ValueError:
+            pass
+        pass
+    pass
+
+
+def test_processimages_pool_interrupted():
+    data = np.zeros((64, 64, 3), dtype=np.uint8)
+
+    with TemporaryDirectory() as folder_path:
+        imagepaths = []
+        for i in range(4):
+            imagepaths.append(join(folder_path, f'image{i}.tif'))
+            tifffile.imwrite(imagepaths[-1], data, photometric='rgb')
+            pass
+
+        # An error in the result loop stops the pool instead of leaving it waiting for the next image
+        for memory_budget in [None, '1g']:
+            add = _ImageLog.add
+            _ImageLog.add = _raise
+            try:
+                processimages_pool(_invert, imagepaths, processes=1, max_in_flight=1, memory_budget=memory_budget,
+                                   out=folder_path)
+                raise AssertionError('the error was not raised')
+            except KeyboardInterrupt:
+                pass
+            finally:
+                _ImageLog.add = add
+            pass
+        pass
+    pass
+
+
+def _raise(*args):
+    raise KeyboardInterrupt
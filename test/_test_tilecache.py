@@ -0,0 +1,51 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import tifffile
+
+from ..src import TileCache, channel_histograms, tile_cache
+from ..src._tiles import read_region
+
+
+def test_tile_cache():
+    # Least recently used tiles are evicted once the budget is exceeded
+    cache = TileCache(max_bytes=300)
+    for key in range(3):
+        cache.put(key, np.zeros(100, dtype=np.uint8))
+        pass
+    assert cache.get(0) is not None
+    cache.put(3, np.zeros(100, dtype=np.uint8))
+    assert cache.get(1) is None
+    assert {'hits': 1, 'misses': 1, 'evictions': 1, 'tiles': 3, 'nbytes': 300} == \
+           {k: v for k, v in cache.info().items() if k != 'max_bytes'}
+
+    # Reading the same image twice decodes each tile once
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(300, 400, 3), dtype=np.uint8)
+    with TemporaryDirectory() as folder_path:
+        image_path = join(folder_path, 'cache.tif')
+        tifffile.imwrite(image_path, data, photometric='rgb', tile=(64, 64), compression='zlib')
+
+        tile_cache.clear()
+        misses = tile_cache.info()['misses']
+        first, _ = channel_histograms(image_path, ['red'], tile_size=(100, 100))
+        assert 5 * 7 == tile_cache.info()['misses'] - misses
+        second, _ = channel_histograms(image_path, ['red'], tile_size=(100, 100))
+        assert 5 * 7 == tile_cache.info()['misses'] - misses
+        assert np.array_equal(first, second)
+
+        # SubIFDs have their own indexes, so they are cached apart from the pages with the same index
+        levels = [data, data[::2, ::2]]
+        with tifffile.TiffWriter(image_path) as tif:
+            tif.write(levels[0], photometric='rgb', tile=(64, 64), subifds=1)
+            tif.write(levels[1], photometric='rgb', tile=(64, 64), subfiletype=1)
+            pass
+        with tifffile.TiffFile(image_path) as tif:
+            for page, level in zip([tif.pages[0], tif.pages[0].pages[0]], levels):
+                assert np.array_equal(level, read_region(page, 0, page.imagelength, 0, page.imagewidth))
+                pass
+            pass
+        tile_cache.clear()
+        pass
+    pass